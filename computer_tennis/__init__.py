@@ -1,3 +1,10 @@
-from computer_tennis.env import TennisEnv
-
 __all__ = ["TennisEnv"]
+
+
+def __getattr__(name):
+    # importing the env imports gym3, so wait until it is used
+    if name in ("Rect", "TennisEnv"):
+        from computer_tennis import env
+
+        return getattr(env, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,115 @@
+import concurrent.futures
+
+import gym3
+import numpy as np
+
+
+class ThreadAsyncEnv(gym3.Env):
+    """
+    Runs the environment created by `make_env()` on a background thread, `act_async()` starts a
+    step and returns right away and `observe_wait()` waits for the step to finish and returns the
+    observation.  The observation is made on the background thread as well, so rendering overlaps
+    with whatever the caller is doing.
+
+    Every call to the environment is made from the same thread, including creating it, since an
+    opengl context can only be current on one thread.
+    """
+
+    def __init__(self, make_env):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self.env = self._executor.submit(make_env).result()
+        super().__init__(
+            ob_space=self.env.ob_space, ac_space=self.env.ac_space, num=self.env.num
+        )
+
+    def _call(self, fn, *args, **kwargs):
+        self._finish_step()
+        return self._executor.submit(fn, *args, **kwargs).result()
+
+    def _finish_step(self):
+        if self._pending is not None:
+            future = self._pending
+            self._pending = None
+            return future.result()
+
+    def _step(self, ac):
+        self.env.act(ac)
+        return self.env.observe()
+
+    def act_async(self, ac):
+        self._finish_step()
+        # the caller may reuse the action array while we are stepping
+        ac = gym3.types.multimap(np.array, ac)
+        self._pending = self._executor.submit(self._step, ac)
+
+    def observe_wait(self):
+        if self._pending is not None:
+            return self._finish_step()
+        return self._call(self.env.observe)
+
+    def observe(self):
+        return self.observe_wait()
+
+    def act(self, ac):
+        self.act_async(ac)
+        self._finish_step()
+
+    def get_info(self):
+        return self._call(self.env.get_info)
+
+    def callmethod(self, method, *args, **kwargs):
+        return self._call(self.env.callmethod, method, *args, **kwargs)
+
+    def close(self):
+        self._finish_step()
+        if hasattr(self.env, "close"):
+            self._call(self.env.close)
+        self._executor.shutdown()
+
+
+class DoubleBufferedEnv:
+    """
+    Steps groups of environments in turn, so that while one group is stepping the policy can
+    run on the observations from another group:
+
+        env = DoubleBufferedEnv([
+            ThreadAsyncEnv(lambda: TennisEnv(num=64)),
+            ThreadAsyncEnv(lambda: TennisEnv(num=64)),
+        ])
+        while True:
+            rew, ob, first = env.observe_wait()
+            env.act_async(policy(ob))
+
+    Each group needs `act_async()` and `observe_wait()`, like `ThreadAsyncEnv` or a
+    `TennisEnv` with `num_workers` set.  `observe_wait()` returns the observation from the
+    group with the index `group`, and the next call to `act_async()` steps that same group.
+    """
+
+    def __init__(self, envs):
+        assert len(envs) >= 2
+        for env in envs:
+            if not hasattr(env, "act_async"):
+                raise Exception("environments must support act_async()")
+        self.envs = envs
+        self.ob_space = envs[0].ob_space
+        self.ac_space = envs[0].ac_space
+        self.num = envs[0].num
+        assert all(env.num == self.num for env in envs)
+        self.group = None
+        self._next_group = 0
+
+    def observe_wait(self):
+        assert self.group is None, "call act_async() for the last observation first"
+        self.group = self._next_group
+        self._next_group = (self._next_group + 1) % len(self.envs)
+        return self.envs[self.group].observe_wait()
+
+    def act_async(self, ac):
+        assert self.group is not None, "call observe_wait() first"
+        self.envs[self.group].act_async(ac)
+        self.group = None
+
+    def close(self):
+        for env in self.envs:
+            env.close()
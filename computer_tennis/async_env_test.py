@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from computer_tennis.async_env import DoubleBufferedEnv, ThreadAsyncEnv
+from computer_tennis.batch_env_test import assert_equal
+from computer_tennis.env import BUTTONS, TennisEnv
+
+
+@pytest.mark.parametrize("surface_type", ["opengl", "numpy"])
+def test_matches_sync_env(surface_type):
+    """
+    Stepping on the background thread should give the same results as stepping directly
+    """
+    env = TennisEnv(num=2, surface_type=surface_type, seed=0)
+    async_env = ThreadAsyncEnv(
+        lambda: TennisEnv(num=2, surface_type=surface_type, seed=0)
+    )
+
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        for expected, actual in zip(env.observe(), async_env.observe_wait()):
+            assert_equal(expected, actual)
+        ac = rng.randint(0, 2, size=(2, len(BUTTONS)), dtype=np.uint8)
+        async_env.act_async(ac)
+        # the env should have made a copy of the action
+        env.act(ac.copy())
+        ac[:] = 0
+    async_env.close()
+
+
+def test_double_buffered():
+    """
+    The groups should take turns and each one should only be stepped with its own actions
+    """
+    env = DoubleBufferedEnv(
+        [
+            ThreadAsyncEnv(lambda: TennisEnv(num=2, surface_type="numpy")),
+            TennisEnv(num=2, num_workers=1, surface_type="numpy"),
+        ]
+    )
+    steps = [0, 0]
+    for i in range(20):
+        rew, ob, first = env.observe_wait()
+        assert env.group == i % 2
+        assert ob.shape == (2, 210, 160, 3)
+        assert first.all() == (steps[env.group] == 0)
+        steps[env.group] += 1
+        env.act_async(np.zeros((2, len(BUTTONS)), dtype=np.uint8))
+    with pytest.raises(AssertionError):
+        env.act_async(np.zeros((2, len(BUTTONS)), dtype=np.uint8))
+    env.close()
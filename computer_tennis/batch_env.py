@@ -0,0 +1,551 @@
+import gym3
+import numpy as np
+
+from computer_tennis.env import (
+    BALL_RECT,
+    BOTTOM_BAR_RECT,
+    BUTTONS,
+    GAME_STATE_SIZE,
+    MAX_SCORE,
+    PADDLE_RECT,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    STATE_SIZE,
+    TOP_BAR_RECT,
+    FrameStack,
+    ObservationBuffers,
+    frame_colors,
+    make_ob,
+    make_ob_space,
+    make_palette,
+    make_seeds,
+    random_serve,
+    surface_options,
+    view_options,
+)
+from computer_tennis.batch_render import build_batch_renderer
+from computer_tennis.physics import compiled_step_games, use_numba
+from computer_tennis.rng import CounterRandom
+
+
+def _button_accel(action, accel):
+    up = action[:, 4] != 0
+    down = action[:, 5] != 0
+    return np.where(up & ~down, -accel, np.where(down & ~up, accel, 0.0))
+
+
+def _button_directions(action):
+    up = action[:, 4] != 0
+    down = action[:, 5] != 0
+    return np.where(up & ~down, -1, np.where(down & ~up, 1, 0)).astype(np.int8)
+
+
+def _overlaps(ball_x, ball_y, x, y, rect):
+    """
+    Vectorized version of SingleTennisEnv._ball_overlaps
+    """
+    ball_x = ball_x + BALL_RECT.x
+    ball_y = ball_y + BALL_RECT.y
+    x = x + rect.x
+    y = y + rect.y
+    return (
+        (ball_x <= x + rect.w)
+        & (x <= ball_x + BALL_RECT.w)
+        & (ball_y <= y + rect.h)
+        & (y <= ball_y + BALL_RECT.h)
+    )
+
+
+class BatchTennisEnv(gym3.Env):
+    """
+    Runs many games at once with the game state stored in numpy arrays of shape (num_games, ...)
+    so that the physics for all games is done with array operations.
+
+    The results are the same as a `ConcatTennisEnv` of `SingleTennisEnv`s with the same seeds.
+
+    All games are rendered into a single (num_games, height, width, channels) array when `observe()` is
+    called and for single player games `observe()` returns that array without copying it, so the
+    observation is only valid until the next call to `act()`.
+
+    If numba is installed, the physics is done by the compiled `physics.step_games()` kernel,
+    which is faster than the array operations for any number of games.  Numba is imported the
+    first time the kernel runs, set the `COMPUTER_TENNIS_DISABLE_NUMBA` environment variable to
+    1 to use the array operations instead.
+
+    With `num_ob_buffers` set, observations are written into a ring of `ObservationBuffers`
+    and single player games are rendered directly into the current buffer.
+    """
+
+    def __init__(
+        self,
+        num,
+        surface_type,
+        num_players,
+        egl_device_index,
+        async_readback=False,
+        readback_delay=0,
+        ob_mode="pixels",
+        frame_skip=1,
+        max_pool_last=1,
+        ob_size=None,
+        grayscale=False,
+        crop=None,
+        aspect_correct=False,
+        ob_format="rgb",
+        seeds=None,
+        instrumentation=None,
+        num_ob_buffers=None,
+        frame_stack=1,
+    ):
+        assert num % num_players == 0
+        self.buttons = BUTTONS
+        view_kwargs = view_options(
+            ob_size,
+            grayscale=grayscale,
+            crop=crop,
+            aspect_correct=aspect_correct,
+            ob_format=ob_format,
+        )
+        self.palette = make_palette(ob_format)
+        rgb_shape = (
+            view_kwargs["pixel_height"],
+            view_kwargs["pixel_width"],
+            view_kwargs["channels"],
+        )
+        self._num_games = num // num_players
+        self._frame_stack = None
+        self._frame_stacked = False
+        ob_rgb_shape = rgb_shape
+        if frame_stack > 1 and ob_mode != "state":
+            self._frame_stack = FrameStack(self._num_games, rgb_shape, frame_stack)
+            ob_rgb_shape = (frame_stack,) + rgb_shape
+        ob_space = make_ob_space(ob_mode, rgb_shape=ob_rgb_shape)
+        ac_space = gym3.types.TensorType(
+            eltype=gym3.types.Discrete(2, dtype_name="uint8"),
+            shape=(len(self.buttons),),
+        )
+        super().__init__(ob_space=ob_space, ac_space=ac_space, num=num)
+
+        self._num_players = num_players
+
+        self._ob_mode = ob_mode
+        self._frame_skip = frame_skip
+        self._max_pool_last = max_pool_last
+        self._renderer = None
+        self._frames = None
+        self._frames_rendered = False
+        # positions from earlier steps that are max pooled with the current frame
+        self._pool_positions = []
+        self._pool_frames = None
+        if ob_mode != "state":
+            surface_kwargs = surface_options(
+                surface_type,
+                egl_device_index=egl_device_index,
+                async_readback=async_readback,
+                readback_delay=readback_delay,
+            )
+            self._renderer = build_batch_renderer(
+                surface_type,
+                num_games=self._num_games,
+                colors=frame_colors(grayscale, ob_format),
+                **view_kwargs,
+                **surface_kwargs,
+            )
+            self._frames = np.zeros((self._num_games,) + rgb_shape, dtype=np.uint8)
+
+        self._ob_buffers = None
+        if num_ob_buffers is not None:
+            self._ob_buffers = ObservationBuffers.allocate(ob_space, num, num_ob_buffers)
+            self._buffer_views = [
+                self._make_buffer_views(*buffers) for buffers in self._ob_buffers.buffers
+            ]
+            self._observed = False
+            if self._renders_into_buffers():
+                # render straight into the observation
+                self._frames = self._buffer_views[0]["rgb"]
+
+        self._p1_accel = 1
+        if num_players == 2:
+            self._p2_accel = 1
+        else:
+            # make computer a bit slower so it's easier to score
+            self._p2_accel = 0.8
+
+        shape = (self._num_games, 2)
+        self._ball_pos = np.zeros(shape, dtype=np.float64)
+        self._ball_vel = np.zeros(shape, dtype=np.float64)
+        self._p1_pos = np.zeros(shape, dtype=np.float64)
+        self._p1_vel = np.zeros(shape, dtype=np.float64)
+        self._p2_pos = np.zeros(shape, dtype=np.float64)
+        self._p2_vel = np.zeros(shape, dtype=np.float64)
+        self._p1_score = np.zeros(self._num_games, dtype=np.int64)
+        self._p2_score = np.zeros(self._num_games, dtype=np.int64)
+
+        self._rew = np.zeros(self._num_games, dtype=np.float32)
+        self._first = np.ones(self._num_games, dtype=bool)
+
+        self._use_numba = use_numba()
+        self._kernel = None
+        self._all_active = np.ones(self._num_games, dtype=bool)
+        # the computer player ignores the directions
+        self._no_directions = np.zeros(self._num_games, dtype=np.int8)
+        self._scored = np.zeros(self._num_games, dtype=np.int8)
+
+        if seeds is None:
+            seeds = make_seeds(None, self._num_games)
+        assert len(seeds) == self._num_games
+        self._rngs = [CounterRandom(seed) for seed in seeds]
+        for game in range(self._num_games):
+            self._reset_state(game, serve_to_player=2, full_reset=True)
+
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.wrap_methods(
+                self,
+                {
+                    "act": "act",
+                    "physics": "_step",
+                    "observe": "observe",
+                    "render": "_get_rgb",
+                },
+            )
+            if self._renderer is not None:
+                self._renderer.instrument(instrumentation)
+
+    def _reset_state(self, game, serve_to_player, full_reset):
+        ball_pos, ball_vel, p1_y, p2_y = random_serve(
+            self._rngs[game],
+            serve_to_player,
+            p1_y=self._p1_pos[game, 1],
+            full_reset=full_reset,
+        )
+        self._ball_pos[game] = (ball_pos.x, ball_pos.y)
+        self._ball_vel[game] = (ball_vel.x, ball_vel.y)
+
+        if full_reset:
+            self._p1_pos[game] = (140, p1_y)
+            self._p1_vel[game] = 0
+
+        self._p2_pos[game] = (16, p2_y)
+        self._p2_vel[game] = 0
+
+    def _get_positions(self):
+        return dict(
+            p1_score=self._p1_score.copy(),
+            p2_score=self._p2_score.copy(),
+            ball_pos=self._ball_pos.copy(),
+            p1_pos=self._p1_pos.copy(),
+            p2_pos=self._p2_pos.copy(),
+        )
+
+    def _get_rgb(self):
+        # frames are rendered lazily since many steps are never observed
+        if not self._frames_rendered:
+            self._renderer.render(
+                self._frames,
+                p1_score=self._p1_score,
+                p2_score=self._p2_score,
+                ball_pos=self._ball_pos,
+                p1_pos=self._p1_pos,
+                p2_pos=self._p2_pos,
+            )
+            if len(self._pool_positions) > 0 and self._pool_frames is None:
+                self._pool_frames = np.zeros_like(self._frames)
+            # don't pool frames from before the end of the episode
+            not_first = ~self._first[:, np.newaxis, np.newaxis, np.newaxis]
+            for positions in self._pool_positions:
+                self._renderer.render(self._pool_frames, **positions)
+                np.maximum(
+                    self._frames, self._pool_frames, out=self._frames, where=not_first
+                )
+            self._frames_rendered = True
+        return self._frames
+
+    def _get_ob_rgb(self):
+        if self._frame_stack is None:
+            return self._get_rgb()
+        if not self._frame_stacked:
+            self._frame_stack.push(self._get_rgb(), self._first)
+            self._frame_stacked = True
+        return self._frame_stack.get()
+
+    def _physics_arrays(self):
+        return [
+            self._ball_pos,
+            self._ball_vel,
+            self._p1_pos,
+            self._p1_vel,
+            self._p2_pos,
+            self._p2_vel,
+        ]
+
+    def _write_state(self, state):
+        # the physics and score columns, which are the state observation
+        for i, arr in enumerate(self._physics_arrays()):
+            state[:, 2 * i : 2 * i + 2] = arr
+        state[:, 12] = self._p1_score
+        state[:, 13] = self._p2_score
+
+    def _get_state(self):
+        # the rng columns of `get_state()` take a python loop over the games, so leave them out
+        state = np.empty((self._num_games, STATE_SIZE), dtype=np.float32)
+        self._write_state(state)
+        return state
+
+    def get_state(self):
+        """
+        The state of every game as a (num_games, GAME_STATE_SIZE) float64 array
+        """
+        state = np.empty((self._num_games, GAME_STATE_SIZE), dtype=np.float64)
+        self._write_state(state)
+        state[:, 14] = self._rew
+        state[:, 15] = self._first
+        state[:, 16] = [rng.seed for rng in self._rngs]
+        state[:, 17] = [rng.counter for rng in self._rngs]
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a state from `get_state()`, the frames are not rendered until they are observed
+        """
+        assert state.shape == (self._num_games, GAME_STATE_SIZE)
+        for i, arr in enumerate(self._physics_arrays()):
+            arr[:] = state[:, 2 * i : 2 * i + 2]
+        self._p1_score[:] = state[:, 12]
+        self._p2_score[:] = state[:, 13]
+        self._rew[:] = state[:, 14]
+        self._first[:] = state[:, 15]
+        for game, (seed, counter) in enumerate(state[:, 16:].astype(np.int64).tolist()):
+            if self._rngs[game].seed == seed:
+                self._rngs[game].counter = counter
+            else:
+                self._rngs[game] = CounterRandom(seed, counter=counter)
+        self._pool_positions = []
+        self._frames_rendered = False
+        if self._frame_stack is not None:
+            self._frame_stack.clear()
+            self._frame_stacked = False
+        self._next_ob_buffer()
+
+    def _make_buffer_views(self, rew, ob, first):
+        # views of one buffer with shape (num_games, num_players, ...)
+        shape = (self._num_games, self._num_players)
+        views = dict(rew=rew.reshape(shape), first=first.reshape(shape))
+        if self._ob_mode == "pixels":
+            views["rgb"] = ob
+        elif self._ob_mode == "state":
+            views["state"] = ob
+        else:
+            views.update(ob)
+        for key in ["rgb", "state"]:
+            if key in views:
+                views[key + "_games"] = views[key].reshape(shape + views[key].shape[1:])
+        return views
+
+    def _observe_into_buffer(self):
+        views = self._buffer_views[self._ob_buffers.index]
+        views["rew"][:, 0] = self._rew
+        if self._num_players == 2:
+            np.negative(self._rew, out=views["rew"][:, 1])
+        views["first"][:] = self._first[:, np.newaxis]
+        if "rgb" in views:
+            frames = self._get_ob_rgb()
+            if frames is not views["rgb"]:
+                views["rgb_games"][:] = frames[:, np.newaxis]
+        if "state" in views:
+            state = views["state_games"]
+            for i, arr in enumerate(self._physics_arrays()):
+                state[:, :, 2 * i : 2 * i + 2] = arr[:, np.newaxis]
+            state[:, :, 12] = self._p1_score[:, np.newaxis]
+            state[:, :, 13] = self._p2_score[:, np.newaxis]
+
+    def _renders_into_buffers(self):
+        return (
+            self._num_players == 1
+            and self._renderer is not None
+            and self._frame_stack is None
+        )
+
+    def _next_ob_buffer(self):
+        if self._ob_buffers is None:
+            return
+        self._ob_buffers.advance()
+        self._observed = False
+        if self._renders_into_buffers():
+            self._frames = self._buffer_views[self._ob_buffers.index]["rgb"]
+
+    def observe(self):
+        if self._ob_buffers is not None:
+            if not self._observed:
+                self._observe_into_buffer()
+                self._observed = True
+            return self._ob_buffers.current()
+        ob = make_ob(self._ob_mode, get_rgb=self._get_ob_rgb, get_state=self._get_state)
+        if self._num_players == 2:
+            rew = np.stack([self._rew, -self._rew], axis=1).reshape(-1)
+            return (
+                rew,
+                gym3.types.multimap(lambda x: np.repeat(x, 2, axis=0), ob),
+                np.repeat(self._first, 2, axis=0),
+            )
+        else:
+            return self._rew.copy(), ob, self._first.copy()
+
+    def act(self, ac):
+        if self._frame_stack is not None:
+            # every frame is part of a later observation
+            self._get_ob_rgb()
+            self._frame_stacked = False
+        ac = np.asarray(ac)
+        self._rew[:] = 0.0
+        self._first[:] = False
+        self._pool_positions = []
+        active = None
+        for step in range(self._frame_skip):
+            self._step(ac, active)
+            if self._frame_skip - self._max_pool_last <= step < self._frame_skip - 1:
+                self._pool_positions.append(self._get_positions())
+            if self._first.any():
+                # games stop at the end of an episode, the rest keep going
+                if self._first.all():
+                    break
+                active = ~self._first
+        self._frames_rendered = False
+        self._next_ob_buffer()
+
+    def _step(self, ac, active):
+        """
+        Run a single step of physics, games where `active` is False are left unchanged
+        """
+        if self._kernel is None and self._use_numba:
+            # numba takes a while to import, so wait until the kernel is needed
+            self._kernel = compiled_step_games()
+        if self._kernel is not None:
+            p1_scored, p2_scored = self._move_kernel(ac, active)
+        else:
+            p1_scored, p2_scored = self._move(ac, active)
+
+        self._p1_score += p1_scored
+        self._p2_score += p2_scored
+        self._rew += np.where(p1_scored, 1.0, np.where(p2_scored, -1.0, 0.0))
+        first = (p1_scored & (self._p1_score >= MAX_SCORE)) | (
+            p2_scored & (self._p2_score >= MAX_SCORE)
+        )
+        self._first |= first
+
+        # serves are rare, so do them one at a time
+        for game in np.flatnonzero(p1_scored | p2_scored):
+            self._reset_state(
+                game,
+                serve_to_player=2 if p1_scored[game] else 1,
+                full_reset=first[game],
+            )
+
+    def _move_kernel(self, ac, active):
+        if self._num_players == 2:
+            p2_direction = _button_directions(ac[1::2])
+        else:
+            p2_direction = self._no_directions
+        self._kernel(
+            *self._physics_arrays(),
+            _button_directions(ac[0 :: self._num_players]),
+            p2_direction,
+            self._num_players == 1,
+            float(self._p1_accel),
+            float(self._p2_accel),
+            self._all_active if active is None else active,
+            self._scored,
+        )
+        return self._scored == 1, self._scored == 2
+
+    def _move(self, ac, active):
+        """
+        Array operation version of `physics.step_games()`, returns which games each player
+        scored in
+        """
+        if active is not None:
+            physics_arrays = self._physics_arrays()
+            saved = [arr[~active] for arr in physics_arrays]
+
+        self._p1_vel[:, 1] += _button_accel(ac[0 :: self._num_players], self._p1_accel)
+
+        if self._num_players == 2:
+            self._p2_vel[:, 1] += _button_accel(ac[1::2], self._p2_accel)
+        else:
+            # AI
+            paddle_mid_y = self._p2_pos[:, 1] + PADDLE_RECT.h / 2
+            ball_mid_y = self._ball_pos[:, 1] + BALL_RECT.h / 2
+            diff_mid_y = paddle_mid_y - ball_mid_y
+            self._p2_vel[:, 1] += np.where(
+                np.abs(diff_mid_y) < 2,
+                # dead zone
+                0.0,
+                np.where(paddle_mid_y > ball_mid_y, -self._p2_accel, self._p2_accel),
+            )
+
+        for vel in [self._p1_vel, self._p2_vel]:
+            vel[:, 1] *= 0.8
+            np.clip(vel[:, 1], -2, 2, out=vel[:, 1])
+
+        self._ball_pos += self._ball_vel
+        self._p1_pos += self._p1_vel
+        self._p2_pos += self._p2_vel
+
+        for pos in [self._p1_pos, self._p2_pos]:
+            np.clip(pos[:, 1], 24, SCREEN_HEIGHT, out=pos[:, 1])
+
+        ball_x = self._ball_pos[:, 0]
+        ball_y = self._ball_pos[:, 1]
+
+        for (player, pos) in [(1, self._p1_pos), (2, self._p2_pos)]:
+            hit = _overlaps(ball_x, ball_y, pos[:, 0], pos[:, 1], PADDLE_RECT)
+            # depending on where we collide with the paddle, send the ball back out
+            diff_y = pos[:, 1] + PADDLE_RECT.h / 2 - (ball_y + BALL_RECT.h / 2)
+            dist_y = np.abs(diff_y)
+            v_y = np.where(dist_y <= 2, 0.0, np.where(dist_y <= 4, 1.0, 2.0))
+            # send upward
+            v_y = np.where(diff_y > 0, -v_y, v_y)
+            # reverse x velocity for player 1
+            v_x = -1.0 if player == 1 else 1.0
+            self._ball_vel[hit, 0] = v_x
+            self._ball_vel[hit, 1] = v_y[hit]
+
+        for rect in [BOTTOM_BAR_RECT, TOP_BAR_RECT]:
+            # bars are at the top and bottom, so just invert y velocity
+            hit = _overlaps(ball_x, ball_y, 0, 0, rect)
+            self._ball_vel[hit, 1] = -self._ball_vel[hit, 1]
+
+        out = (ball_x < 0) | (ball_x > 160)
+        self._ball_vel[out, 0] = -self._ball_vel[out, 0]
+
+        p1_scored = ball_x < 0
+        p2_scored = ~p1_scored & (ball_x > SCREEN_WIDTH)
+        if active is not None:
+            p1_scored &= active
+            p2_scored &= active
+            for arr, saved_arr in zip(physics_arrays, saved):
+                arr[~active] = saved_arr
+        return p1_scored, p2_scored
+
+    def stats(self):
+        """
+        Time spent in each phase if this env is instrumented, see `Instrumentation.stats()`
+        """
+        if self._instrumentation is None:
+            return {}
+        return self._instrumentation.stats()
+
+    def get_info(self):
+        return [{} for _ in range(self.num)]
+
+    def keys_to_act(self, keys_list):
+        result = []
+        for keys in keys_list:
+            act = np.zeros(shape=self.ac_space.shape, dtype=np.uint8)
+            key_to_button = {"UP": "UP", "DOWN": "DOWN"}
+            for key, button in key_to_button.items():
+                if key in keys:
+                    act[self.buttons.index(button)] = 1
+                    break
+            result.append(np.expand_dims(act, axis=0))
+        return result
@@ -0,0 +1,64 @@
+import gym3
+import numpy as np
+import pytest
+
+from computer_tennis.env import TennisEnv
+
+
+def assert_equal(expected, actual):
+    def check(expected, actual):
+        assert expected.dtype == actual.dtype
+        assert np.array_equal(expected, actual)
+
+    gym3.types.multimap(check, expected, actual)
+
+
+@pytest.mark.parametrize(
+    "num_games, num_players, surface_type, env_kwargs, num_steps",
+    [
+        (3, 1, "opengl", {}, 500),
+        (3, 2, "opengl", {}, 500),
+        (3, 1, "numpy", {}, 500),
+        (3, 2, "numpy", {}, 500),
+        (
+            3,
+            1,
+            "numpy",
+            dict(ob_size=(84, 84), grayscale=True, crop=(0, 34, 160, 160)),
+            500,
+        ),
+        # long enough for the game to end partway through a step
+        (3, 1, "numpy", dict(frame_skip=4, max_pool_last=2), 1000),
+    ],
+)
+def test_matches_scalar_env(num_games, num_players, surface_type, env_kwargs, num_steps):
+    """
+    Make sure the batched env produces exactly the same results as the scalar one
+    """
+    num = num_games * num_players
+    env_kwargs = dict(
+        num=num,
+        num_players=num_players,
+        surface_type=surface_type,
+        ob_mode="both",
+        seed=0,
+        **env_kwargs,
+    )
+    scalar_env = TennisEnv(**env_kwargs)
+    batch_env = TennisEnv(batched=True, **env_kwargs)
+
+    rng = np.random.RandomState(0)
+    num_firsts = 0
+    for _ in range(num_steps):
+        for expected, actual in zip(scalar_env.observe(), batch_env.observe()):
+            assert_equal(expected, actual)
+        num_firsts += batch_env.observe()[2].sum()
+        ac = rng.randint(0, 2, size=(num, len(batch_env.buttons)), dtype=np.uint8)
+        scalar_env.act(ac)
+        batch_env.act(ac)
+
+    scores = [(e._p1_score, e._p2_score) for e in scalar_env.envs]
+    assert sum(sum(s) for s in scores) > 0
+    assert scores == list(zip(batch_env._p1_score, batch_env._p2_score))
+    if num_steps >= 1000:
+        assert num_firsts > 0
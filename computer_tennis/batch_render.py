@@ -0,0 +1,125 @@
+import math
+
+import numpy as np
+
+from computer_tennis import numpy_draw
+from computer_tennis.env import (
+    BALL_RECT,
+    COLORS,
+    PADDLE_RECT,
+    assign_devices,
+    draw_frame,
+)
+from computer_tennis.sprite_render import get_sprite_cache, score_keys
+from computer_tennis.types import Vec2
+from computer_tennis.util import build_surface
+
+
+class NumpyBatchRenderer:
+    """
+    Renders every game at once into a (num_games, height, width, channels) array
+
+    The parts of the frame that only change when someone scores come from a `SpriteCache`, so a
+    frame is a copy of the background, a lookup of the score images and a vectorized fill for the
+    ball and paddles.
+    """
+
+    def __init__(self, colors=COLORS, **view_kwargs):
+        self._sprites = get_sprite_cache(colors=colors, **view_kwargs)
+
+    def instrument(self, instrumentation):
+        instrumentation.wrap_methods(self, {"draw": "render"})
+
+    def _fill_rects(self, frames, pos, rect, pixel):
+        num_games, height, width, _ = frames.shape
+        sprites = self._sprites
+        # vectorized version of SpriteCache.rect_region
+        x_start, x_end = numpy_draw.pixel_spans(
+            ((rect.x + pos[:, 0]) - sprites.view_x) * sprites.scale_x,
+            (((rect.x + rect.w) + pos[:, 0]) - sprites.view_x) * sprites.scale_x,
+            width,
+        )
+        y_start, y_end = numpy_draw.pixel_spans(
+            ((rect.y + pos[:, 1]) - sprites.view_y) * sprites.scale_y,
+            (((rect.y + rect.h) + pos[:, 1]) - sprites.view_y) * sprites.scale_y,
+            height,
+        )
+        max_w = math.ceil(rect.w * sprites.scale_x) + 1
+        max_h = math.ceil(rect.h * sprites.scale_y) + 1
+        cols = x_start[:, np.newaxis] + np.arange(max_w)
+        rows = y_start[:, np.newaxis] + np.arange(max_h)
+        mask = (rows < y_end[:, np.newaxis])[:, :, np.newaxis] & (
+            cols < x_end[:, np.newaxis]
+        )[:, np.newaxis, :]
+        index = (
+            np.arange(num_games)[:, np.newaxis, np.newaxis] * height
+            + rows[:, :, np.newaxis]
+        ) * width + cols[:, np.newaxis, :]
+        frames.reshape(-1, frames.shape[-1])[index[mask]] = pixel
+
+    def render(self, frames, p1_score, p2_score, ball_pos, p1_pos, p2_pos):
+        sprites = self._sprites
+        frames[:] = sprites.background
+        frames[(slice(None),) + sprites.p1_score_region] = sprites.p1_scores[
+            score_keys(p1_score)
+        ]
+        frames[(slice(None),) + sprites.p2_score_region] = sprites.p2_scores[
+            score_keys(p2_score)
+        ]
+        self._fill_rects(frames, ball_pos, BALL_RECT, sprites.white_pixel)
+        self._fill_rects(frames, p1_pos, PADDLE_RECT, sprites.p1_pixel)
+        self._fill_rects(frames, p2_pos, PADDLE_RECT, sprites.p2_pixel)
+        # the bars are drawn on top of everything else
+        for region in sprites.bar_regions:
+            frames[(slice(None),) + region] = sprites.background[region]
+
+
+class SurfaceBatchRenderer:
+    """
+    Renders each game with its own surface, for backends that can only draw one frame at a time
+
+    If `egl_device_index` is a list, the opengl surfaces are spread over the devices
+    round-robin.
+    """
+
+    def __init__(self, num_games, surface_type, colors=COLORS, **surface_kwargs):
+        self._colors = colors
+        kwargs_list = [surface_kwargs] * num_games
+        if "egl_device_index" in surface_kwargs:
+            devices = assign_devices(surface_kwargs["egl_device_index"], num_games)
+            kwargs_list = [
+                dict(surface_kwargs, egl_device_index=device) for device in devices
+            ]
+        self._surfaces = [
+            build_surface(surface_type, origin_at_center=False, **kwargs)
+            for kwargs in kwargs_list
+        ]
+
+    def instrument(self, instrumentation):
+        for surface in self._surfaces:
+            instrumentation.wrap_methods(surface, surface.PHASE_METHODS)
+
+    def render(self, frames, p1_score, p2_score, ball_pos, p1_pos, p2_pos):
+        for game, surface in enumerate(self._surfaces):
+            draw_frame(
+                surface,
+                p1_score=int(p1_score[game]),
+                p2_score=int(p2_score[game]),
+                ball_pos=Vec2(*ball_pos[game].tolist()),
+                p1_pos=Vec2(*p1_pos[game].tolist()),
+                p2_pos=Vec2(*p2_pos[game].tolist()),
+                colors=self._colors,
+            )
+            surface.get_image(out=frames[game])
+
+
+def build_batch_renderer(surface_type, num_games, colors=COLORS, **surface_kwargs):
+    if surface_type == "numpy":
+        return NumpyBatchRenderer(colors=colors, **surface_kwargs)
+    else:
+        return SurfaceBatchRenderer(
+            num_games=num_games,
+            surface_type=surface_type,
+            colors=colors,
+            **surface_kwargs,
+        )
@@ -16,19 +16,34 @@ class Surface:
     https://www.cairographics.org/documentation/pycairo/2/reference/context.html
     """
 
+    # methods that `Instrumentation` times
+    PHASE_METHODS = {"draw": "draw_polygon", "readback": "get_image"}
+
     def __init__(
-        self, pixel_width, pixel_height, view_width, view_height, origin_at_center=True
+        self,
+        pixel_width,
+        pixel_height,
+        view_width,
+        view_height,
+        origin_at_center=True,
+        view_x=0,
+        view_y=0,
+        channels=3,
     ):
+        assert channels in (1, 3)
+        self._channels = channels
         self.data = np.ones((pixel_height, pixel_width, 4), dtype=np.uint8) * 255
         cairo_surface = cairo.ImageSurface.create_for_data(
             self.data, cairo.Format.RGB24, pixel_width, pixel_height
         )
         self.c = cairo.Context(cairo_surface)
         if origin_at_center:
+            assert view_x == 0 and view_y == 0
             self.c.translate(pixel_width // 2, pixel_height // 2)
             self.c.scale(pixel_width / view_width, -pixel_height / view_height)
         else:
             self.c.scale(pixel_width / view_width, pixel_height / view_height)
+            self.c.translate(-view_x, -view_y)
         # don't antialias to match opengl backend
         self.c.set_antialias(cairo.ANTIALIAS_NONE)
         # make line widths somewhere around 1 pixel
@@ -39,8 +54,16 @@ class Surface:
         self.c.set_source_rgb(color.r, color.g, color.b)
         self.c.paint()
 
-    def get_image(self):
-        return self.data[:, :, 2::-1].copy()
+    def get_image(self, out=None):
+        # the data is in BGRA order
+        if self._channels == 1:
+            image = self.data[:, :, 2:3]
+        else:
+            image = self.data[:, :, 2::-1]
+        if out is None:
+            return image.copy()
+        out[:] = image
+        return out
 
     def draw_polygon(self, vertices, color):
         for p in vertices:
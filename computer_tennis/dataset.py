@@ -0,0 +1,171 @@
+import collections
+import concurrent.futures
+import threading
+
+import numpy as np
+
+from computer_tennis.batch_env import BatchTennisEnv
+from computer_tennis.recorder import Recording, stacked_steps
+
+
+def _pad(x, size):
+    # repeat the first row for the games of the env that are not used
+    if len(x) == size:
+        return x
+    return np.concatenate([x, np.repeat(x[:1], size - len(x), axis=0)])
+
+
+class OfflineDataset:
+    """
+    Transitions from a recording made with `RecordingEnv`, the observations are rendered from
+    the recorded states when they are read so no frames are stored
+
+    Transition `i` is agent `i % num` at step `i // num`, see `get_batch()`.  Make the recording
+    with `compress=False` so that the states are memory mapped instead of being decompressed a
+    chunk at a time.
+
+    Rendering is done by a `BatchTennisEnv` for each thread, with `num_threads` set
+    `sample_batches()` renders batches on a thread pool ahead of time.  Each thread keeps one
+    env with enough games for the largest batch it has rendered, smaller batches use the first
+    games of it and the rest are padding.
+    """
+
+    def __init__(self, directory, surface_type="numpy", num_threads=0, cache_chunks=16):
+        self.recording = Recording(directory, cache_chunks=cache_chunks)
+        self._surface_type = surface_type
+        self._env_kwargs = dict(self.recording.env_kwargs)
+        # the frames are stacked by `render()`
+        self._frame_stack = self._env_kwargs.pop("frame_stack", 1)
+        self._num_players = self._env_kwargs["num_players"]
+        self._pooled = self._env_kwargs.get("max_pool_last", 1) > 1
+        self._local = threading.local()
+        self._executor = None
+        if num_threads > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=num_threads
+            )
+        self._num_threads = num_threads
+
+    def __len__(self):
+        # the last step has no next observation
+        return max(self.recording.num_steps - 1, 0) * self.recording.num
+
+    def _get_env(self, num_games):
+        env = getattr(self._local, "env", None)
+        if env is None or env.num < num_games * self._num_players:
+            env = BatchTennisEnv(
+                num=num_games * self._num_players,
+                surface_type=self._surface_type,
+                egl_device_index=None,
+                seeds=[0] * num_games,
+                **self._env_kwargs,
+            )
+            self._local.env = env
+        return env
+
+    def _game_states(self, steps, games):
+        return self.recording.read("state", steps)[np.arange(len(steps)), games]
+
+    def render(self, steps, games):
+        """
+        Pixel observations for `games` at `steps`, from before the action at each step, with
+        `frame_stack` the older frames are rendered from their own steps
+        """
+        if self._frame_stack == 1:
+            return self._render_frames(steps, games)
+        frame_steps = stacked_steps(self.recording, steps, games, self._frame_stack)
+        result = None
+        for i in range(self._frame_stack):
+            valid = frame_steps[:, i] >= 0
+            if not valid.any():
+                continue
+            frames = self._render_frames(frame_steps[valid, i], games[valid])
+            if result is None:
+                shape = (len(steps), self._frame_stack) + frames.shape[1:]
+                result = np.zeros(shape, dtype=frames.dtype)
+            result[valid, i] = frames
+        return result
+
+    def _render_frames(self, steps, games):
+        recording = self.recording
+        # pooled frames come from the steps taken by the previous action, so take those steps
+        # again, the first step has no previous action and is just rendered
+        if self._pooled:
+            pooled = steps > 0
+        else:
+            pooled = np.zeros(len(steps), dtype=bool)
+        result = None
+        for is_pooled, mask in [(False, ~pooled), (True, pooled)]:
+            num_games = int(mask.sum())
+            if num_games == 0:
+                continue
+            env = self._get_env(num_games)
+            env_games = env.num // self._num_players
+            if is_pooled:
+                prev_steps = steps[mask] - 1
+                states = self._game_states(prev_steps, games[mask])
+                env.set_state(_pad(states, env_games))
+                agents = games[mask, np.newaxis] * self._num_players + np.arange(
+                    self._num_players
+                )
+                ac = recording.read("ac", prev_steps)[
+                    np.arange(num_games)[:, np.newaxis], agents
+                ]
+                env.act(_pad(ac.reshape(num_games * self._num_players, -1), env.num))
+            else:
+                states = self._game_states(steps[mask], games[mask])
+                env.set_state(_pad(states, env_games))
+            _, ob, _ = env.observe()
+            ob = ob[: num_games * self._num_players : self._num_players]
+            if num_games == len(steps):
+                # copying with a mask is much slower than a plain copy
+                return ob.copy()
+            if result is None:
+                result = np.empty((len(steps),) + ob.shape[1:], dtype=ob.dtype)
+            result[mask] = ob
+        return result
+
+    def get_batch(self, indices):
+        """
+        A dict of arrays for the transitions `indices`:
+            "ob": observation
+            "ac": action taken after the observation
+            "rew": reward for the action
+            "next_ob": observation after the action
+            "next_first": True if the action ended the episode, then "next_ob" is the start of
+                the next episode
+        """
+        indices = np.asarray(indices)
+        assert ((0 <= indices) & (indices < len(self))).all()
+        num = self.recording.num
+        steps = indices // num
+        agents = indices % num
+        games = agents // self._num_players
+        rows = np.arange(len(indices))
+        return dict(
+            ob=self.render(steps, games),
+            ac=self.recording.read("ac", steps)[rows, agents],
+            rew=self.recording.read("rew", steps + 1)[rows, agents],
+            next_ob=self.render(steps + 1, games),
+            next_first=self.recording.read("first", steps + 1)[rows, agents],
+        )
+
+    def sample_batches(self, batch_size, seed=None):
+        """
+        Yield batches of transitions sampled uniformly with replacement, with `num_threads` set
+        up to twice that many batches are rendered ahead of time
+        """
+        rng = np.random.RandomState(seed)
+        if self._executor is None:
+            while True:
+                yield self.get_batch(rng.randint(len(self), size=batch_size))
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * self._num_threads:
+                indices = rng.randint(len(self), size=batch_size)
+                pending.append(self._executor.submit(self.get_batch, indices))
+            yield pending.popleft().result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
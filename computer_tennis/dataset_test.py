@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from computer_tennis.batch_env_test import assert_equal
+from computer_tennis.dataset import OfflineDataset
+from computer_tennis.env import BUTTONS
+from computer_tennis.recorder import RecordingEnv
+
+
+def record(directory, num_steps, **env_kwargs):
+    env = RecordingEnv(
+        directory,
+        chunk_size=64,
+        compress=False,
+        surface_type="numpy",
+        seed=0,
+        **env_kwargs
+    )
+    rng = np.random.RandomState(0)
+    observations = []
+    actions = []
+    for _ in range(num_steps):
+        observations.append(env.observe())
+        actions.append(rng.randint(0, 2, size=(env.num, len(BUTTONS)), dtype=np.uint8))
+        env.act(actions[-1])
+    env.close()
+    return observations, actions
+
+
+@pytest.mark.parametrize(
+    "env_kwargs",
+    [
+        dict(num=3),
+        dict(num=4, num_players=2),
+        dict(num=2, frame_skip=4, max_pool_last=2, grayscale=True),
+        dict(num=2, frame_skip=8, frame_stack=3, grayscale=True),
+    ],
+)
+def test_get_batch(tmp_path, env_kwargs):
+    """
+    Transitions should match what the environment returned while recording
+    """
+    num_steps = 300
+    observations, actions = record(str(tmp_path), num_steps, **env_kwargs)
+    dataset = OfflineDataset(str(tmp_path))
+    num = env_kwargs["num"]
+    assert len(dataset) == (num_steps - 1) * num
+
+    indices = np.random.RandomState(1).randint(len(dataset), size=64)
+    # include the first and last transitions
+    indices[:2] = [0, len(dataset) - 1]
+    # and the transitions after an episode starts, where the older stacked frames are zero
+    first = np.array([o[2] for o in observations])
+    (first_steps,) = np.nonzero(first[1:-1].any(axis=1))
+    if "frame_stack" in env_kwargs:
+        assert len(first_steps) > 0
+    first_indices = (first_steps[:, np.newaxis] + 1) * num + np.arange(num)
+    indices = np.concatenate([indices, first_indices.reshape(-1)])
+    batch = dataset.get_batch(indices)
+    for i, index in enumerate(indices):
+        step, agent = divmod(index, num)
+        rew, ob, _ = observations[step]
+        next_rew, next_ob, next_first = observations[step + 1]
+        assert np.array_equal(batch["ob"][i], ob[agent])
+        assert np.array_equal(batch["ac"][i], actions[step][agent])
+        assert batch["rew"][i] == next_rew[agent]
+        assert np.array_equal(batch["next_ob"][i], next_ob[agent])
+        assert batch["next_first"][i] == next_first[agent]
+
+
+def test_prefetch(tmp_path):
+    """
+    Rendering on threads should give the same batches
+    """
+    record(str(tmp_path), 100, num=2)
+    datasets = [OfflineDataset(str(tmp_path), num_threads=n) for n in [0, 2]]
+    iterators = [dataset.sample_batches(batch_size=16, seed=0) for dataset in datasets]
+    for _ in range(10):
+        expected, actual = [next(it) for it in iterators]
+        assert_equal(expected, actual)
+    for dataset in datasets:
+        dataset.close()
@@ -1,20 +1,61 @@
 import collections
-import random
 import math
 
 import gym3
 import numpy as np
+from gym3 import types_np
 
+from computer_tennis.instrument import Instrumentation
+from computer_tennis.rng import CounterRandom
 from computer_tennis.types import Color, Vec2
 from computer_tennis.util import build_surface
 
 
 Rect = collections.namedtuple("Rect", "x, y, w, h")
+Colors = collections.namedtuple("Colors", "bg, white, p1, p2")
 
 SCREEN_WIDTH = 160
 SCREEN_HEIGHT = 210
 MAX_SCORE = 20
 
+# same buttons as retro atari
+BUTTONS = [
+    "BUTTON",
+    None,
+    "SELECT",
+    "RESET",
+    "UP",
+    "DOWN",
+    "LEFT",
+    "RIGHT",
+]
+
+WHITE_COLOR = Color(236 / 255, 236 / 255, 236 / 255)
+# BG_COLOR = Color(144 / 255, 72 / 255, 17 / 255)
+# P1_COLOR = Color(92 / 255, 186 / 255, 92 / 255)
+# P2_COLOR = Color(213 / 255, 130 / 255, 74 / 255)
+BG_COLOR = Color(114 / 255, 106 / 255, 149 / 255)
+P1_COLOR = Color(246 / 255, 167 / 255, 193 / 255)
+P2_COLOR = Color(151 / 255, 242 / 255, 243 / 255)
+COLORS = Colors(bg=BG_COLOR, white=WHITE_COLOR, p1=P1_COLOR, p2=P2_COLOR)
+
+# the atari displayed its 160x210 frame at a 4:3 aspect ratio, so pixels are wider than they
+# are tall
+DISPLAY_ASPECT_RATIO = 4 / 3
+PIXEL_ASPECT_RATIO = DISPLAY_ASPECT_RATIO / (SCREEN_WIDTH / SCREEN_HEIGHT)
+
+OB_MODES = ["pixels", "state", "both"]
+# ball pos, ball vel, p1 pos, p1 vel, p2 pos, p2 vel, p1 score, p2 score
+STATE_SIZE = 14
+# the state from `get_state()`, which is the observed state followed by the last reward, the last
+# first, and the seed and counter of the random number generator
+GAME_STATE_SIZE = STATE_SIZE + 4
+
+BALL_RECT = Rect(0, 0, 2, 4)
+PADDLE_RECT = Rect(0, 0, 4, 16)
+BOTTOM_BAR_RECT = Rect(0, SCREEN_HEIGHT - 16, SCREEN_WIDTH, 16)
+TOP_BAR_RECT = Rect(0, 24, SCREEN_WIDTH, 10)
+
 DIGITS = {
     0: [Rect(0, 0, 12, 4), Rect(0, 16, 12, 4), Rect(0, 0, 4, 20), Rect(8, 0, 4, 20)],
     1: [Rect(4, 0, 4, 20)],
@@ -56,38 +97,627 @@ def _clamp(v, low, high):
         return v
 
 
-def TennisEnv(num=1, surface_type="opengl", num_players=1, egl_device_index=None):
+def _button_direction(ac, player):
+    """
+    -1 to move up, 1 to move down and 0 if neither or both buttons are pressed
+    """
+    up = ac.item(player, 4)
+    down = ac.item(player, 5)
+    if up and not down:
+        return -1
+    elif down and not up:
+        return 1
+    else:
+        return 0
+
+
+def to_grayscale(color):
+    """
+    Convert a color to gray using the ITU-R 601 luma weights
+    """
+    l = 0.299 * color.r + 0.587 * color.g + 0.114 * color.b
+    return Color(l, l, l)
+
+
+GRAYSCALE_COLORS = Colors(*[to_grayscale(c) for c in COLORS])
+
+# with ob_format="indexed" each color is drawn as its index into the palette, every pixel of a
+# frame is one of these colors since the digits use the player colors
+INDEXED_COLORS = Colors(*[Color(i / 255, i / 255, i / 255) for i in range(len(COLORS))])
+# the rgb color for each palette index as a (len(COLORS), 3) uint8 array
+PALETTE = np.array(
+    [[round(c.r * 255), round(c.g * 255), round(c.b * 255)] for c in COLORS],
+    dtype=np.uint8,
+)
+
+
+def frame_colors(grayscale, ob_format):
+    """
+    The `Colors` to draw frames with
+    """
+    if ob_format == "indexed":
+        if grayscale:
+            raise Exception("grayscale can't be used with indexed observations")
+        return INDEXED_COLORS
+    assert ob_format == "rgb"
+    return GRAYSCALE_COLORS if grayscale else COLORS
+
+
+def make_palette(ob_format):
+    """
+    The palette for observations in `ob_format`, or None if the observations are not indexed
+    """
+    return PALETTE.copy() if ob_format == "indexed" else None
+
+
+def _rect_corners(rect):
+    return (
+        (rect.x, rect.y),
+        (rect.x + rect.w, rect.y),
+        (rect.x + rect.w, rect.y + rect.h),
+        (rect.x, rect.y + rect.h),
+    )
+
+
+def _rect_to_vertices(rect):
+    return [Vec2(x, y) for x, y in _rect_corners(rect)]
+
+
+def _digit_polygons(pos):
+    """
+    The polygons for each digit drawn at `pos`
+    """
+    return [
+        [[v + pos for v in _rect_to_vertices(rect)] for rect in DIGITS[digit]]
+        for digit in range(10)
+    ]
+
+
+# the geometry is computed once so that drawing a frame only has to offset the moving rects
+_BALL_CORNERS = _rect_corners(BALL_RECT)
+_PADDLE_CORNERS = _rect_corners(PADDLE_RECT)
+_BAR_POLYGONS = [_rect_to_vertices(BOTTOM_BAR_RECT), _rect_to_vertices(TOP_BAR_RECT)]
+# the ones and tens digits of the scores for each player
+_P1_DIGIT_POLYGONS = (_digit_polygons(Vec2(116, 1)), _digit_polygons(Vec2(100, 1)))
+_P2_DIGIT_POLYGONS = (_digit_polygons(Vec2(36, 1)), _digit_polygons(Vec2(20, 1)))
+
+
+def _draw_rect(surface, corners, pos, color):
+    surface.draw_polygon([Vec2(x + pos.x, y + pos.y) for x, y in corners], color)
+
+
+def _draw_score(surface, score, digit_polygons, color):
+    ones, tens = digit_polygons
+    for polygon in ones[score % 10]:
+        surface.draw_polygon(polygon, color)
+    if score >= 10:
+        for polygon in tens[int(score / 10) % 10]:
+            surface.draw_polygon(polygon, color)
+
+
+def draw_scores(surface, p1_score, p2_score, colors=COLORS):
+    _draw_score(surface, p1_score, _P1_DIGIT_POLYGONS, colors.p1)
+    _draw_score(surface, p2_score, _P2_DIGIT_POLYGONS, colors.p2)
+
+
+def draw_bars(surface, colors=COLORS):
+    for polygon in _BAR_POLYGONS:
+        surface.draw_polygon(polygon, colors.white)
+
+
+def draw_frame(surface, p1_score, p2_score, ball_pos, p1_pos, p2_pos, colors=COLORS):
+    """
+    Draw a single frame of the game onto `surface`, the positions should be `Vec2`s
+    """
+    surface.reset(color=colors.bg)
+    draw_scores(surface, p1_score, p2_score, colors=colors)
+
+    _draw_rect(surface, _BALL_CORNERS, ball_pos, colors.white)
+    _draw_rect(surface, _PADDLE_CORNERS, p1_pos, colors.p1)
+    _draw_rect(surface, _PADDLE_CORNERS, p2_pos, colors.p2)
+
+    draw_bars(surface, colors=colors)
+
+
+def random_serve(rng, serve_to_player, p1_y, full_reset):
+    """
+    Pick a random serve using the `CounterRandom` `rng`
+
+    Returns (ball_pos, ball_vel, p1_y, p2_y) where p1_y is None unless `full_reset` is set
+    """
+    ball_pos = Vec2(
+        78, rng.randrange(115 - SCREEN_HEIGHT // 4, 115 + SCREEN_HEIGHT // 4)
+    )
+
+    if serve_to_player == 1:
+        if p1_y > 100:
+            start_angle = 0
+            end_angle = 45
+        else:
+            start_angle = 315
+            end_angle = 360
+    elif serve_to_player == 2:
+        start_angle = 135
+        end_angle = 225
+    else:
+        raise Exception("invalid player")
+
+    ball_angle = rng.uniform(start_angle / 180 * math.pi, end_angle / 180 * math.pi)
+    ball_dir = Vec2(math.cos(ball_angle), math.sin(ball_angle))
+    ball_vel = ball_dir * rng.uniform(0.5, 2.0)
+
+    new_p1_y = None
+    if full_reset:
+        new_p1_y = 168 + rng.uniform(-10, 10)
+
+    p2_y = 115 + rng.uniform(-10, 10)
+    return ball_pos, ball_vel, new_p1_y, p2_y
+
+
+def TennisEnv(
+    num=1,
+    surface_type="opengl",
+    num_players=1,
+    egl_device_index=None,
+    batched=False,
+    async_readback=False,
+    readback_delay=0,
+    ob_mode="pixels",
+    frame_skip=1,
+    max_pool_last=1,
+    ob_size=None,
+    grayscale=False,
+    crop=None,
+    aspect_correct=False,
+    ob_format="rgb",
+    num_workers=None,
+    seed=None,
+    instrument=False,
+    trace=None,
+    num_ob_buffers=None,
+    frame_stack=1,
+):
+    """
+    Create a gym3 environment with `num` agents
+
+    If `batched` is set, all games are run by a single `BatchTennisEnv` which keeps the game
+    state in numpy arrays, otherwise each game is a separate `SingleTennisEnv`.
+
+    With `num_workers` the games are split between that many worker processes, see
+    `SubprocTennisEnv`.
+
+    Each game has its own random number generator, seeded from `seed` so that the results only
+    depend on `seed` and the actions.  `get_state()` returns the state of every game, including
+    the random number generator, as a (num_games, GAME_STATE_SIZE) array that can be passed to
+    `set_state()` to restore it.  After `set_state()` the frame is rendered the next time it is
+    observed, the max pooling from `frame_skip` is not part of the state.
+
+    `async_readback` and `readback_delay` are passed to the opengl surface, with a
+    `readback_delay` of 1 each observation is the frame from the previous step.
+
+    `egl_device_index` picks the egl device that the opengl surfaces render on.  It can also be
+    a list of device indices or "all" for every device, then the games are spread over the
+    devices round-robin, or with `num_workers` each worker renders all of its games on one
+    device.  With `instrument` set, the time spent rendering on each device is recorded as the
+    "render/egl_device_<index>" phases.
+
+    `ob_mode` is one of:
+        "pixels": observations are rgb images
+        "state": observations are float32 vectors of the game state, see `STATE_SIZE`,
+            and nothing is ever rendered
+        "both": observations are dicts with "rgb" and "state" keys
+
+    Frames are only rendered when `observe()` is called.
+
+    With `frame_skip` each call to `act()` repeats the action for `frame_skip` steps, stopping
+    early at the end of an episode, and returns the total reward.  The pixel observation is the
+    elementwise max over the last `max_pool_last` of those steps, or just the last frame if the
+    episode ended.
+
+    The pixel observations can be preprocessed with:
+        `crop`: a `Rect` (x, y, w, h) in screen coordinates, only this part of the screen is
+            observed, for instance `Rect(0, 34, 160, 160)` removes the scores and bars
+        `ob_size`: (height, width) of the observation, defaults to the size of the crop
+        `grayscale`: observations have a single channel, see `to_grayscale()`
+        `aspect_correct`: stretch the observation horizontally so that it has the 4:3 aspect
+            ratio of the original display, this picks the width so it can't be used with `ob_size`
+
+    The frame is rendered directly at the observation size, the full size frame is never built.
+
+    With `ob_format="indexed"` the pixel observations have a single channel that holds the index
+    of each pixel's color in `env.palette`, a (num_colors, 3) uint8 array of rgb colors, so
+    `env.palette[ob[..., 0]]` is the rgb observation.  The frames are drawn with the indices
+    as colors, so this is as fast as grayscale.  Max pooling would mix colors, so this can't be
+    used with `max_pool_last`.
+
+    With `frame_stack` greater than 1, the pixel observation is the last `frame_stack` frames
+    with shape (frame_stack, height, width, channels), oldest first, see `FrameStack`.  Frames
+    from before the start of the episode or before a call to `set_state()` are zero.  Every
+    frame has to be rendered for this, so frames are rendered on each call to `act()`.
+
+    With `instrument` set, the time spent in each phase of a step (physics, render, draw,
+    readback, observe and so on) is recorded and returned by `env.stats()`, see
+    `Instrumentation.stats()`.  `trace` is called with (name, start, duration) for every
+    recorded call, for instance with a `ChromeTrace`, and turns on `instrument`.  Without
+    `instrument` nothing is recorded and the environment runs the same code as before.
+
+    By default `observe()` returns new arrays.  With `num_ob_buffers` set, the environment
+    preallocates a ring of that many sets of observation, reward and first arrays.  The games
+    are rendered directly into them, and `observe()` returns the arrays without copying.  The
+    arrays are reused, so an observation is overwritten by the `num_ob_buffers`th call to
+    `act()` or `set_state()` after it.
+    """
     assert num % num_players == 0
-    num = num // num_players
-    envs = []
-    for _ in range(num):
-        envs.append(
+    assert 1 <= max_pool_last <= frame_skip
+    assert frame_stack >= 1
+    if ob_format == "indexed" and max_pool_last > 1:
+        # the max of two colors is usually not in the palette
+        raise Exception("max_pool_last can't be used with indexed observations")
+    if surface_type == "opengl" and ob_mode != "state":
+        egl_device_index = egl_device_list(egl_device_index)
+    # pooled frames are rendered one after the other, which doesn't work with delayed frames
+    assert max_pool_last == 1 or readback_delay == 0
+    env_kwargs = dict(
+        surface_type=surface_type,
+        num_players=num_players,
+        egl_device_index=egl_device_index,
+        async_readback=async_readback,
+        readback_delay=readback_delay,
+        ob_mode=ob_mode,
+        frame_skip=frame_skip,
+        max_pool_last=max_pool_last,
+        ob_size=ob_size,
+        grayscale=grayscale,
+        crop=crop,
+        aspect_correct=aspect_correct,
+        ob_format=ob_format,
+        frame_stack=frame_stack,
+        instrument=instrument or trace is not None,
+    )
+    seeds = make_seeds(seed, num // num_players)
+    if num_workers is not None:
+        from computer_tennis.subproc_env import SubprocTennisEnv
+
+        if trace is not None:
+            raise Exception("trace is not supported with num_workers")
+        return SubprocTennisEnv(
+            num=num,
+            num_workers=num_workers,
+            seeds=seeds,
+            batched=batched,
+            num_ob_buffers=num_ob_buffers,
+            **env_kwargs,
+        )
+    return build_env(
+        num=num,
+        seeds=seeds,
+        batched=batched,
+        trace=trace,
+        num_ob_buffers=num_ob_buffers,
+        **env_kwargs,
+    )
+
+
+def egl_device_list(egl_device_index):
+    """
+    The list of devices for an `egl_device_index` of "all" or a list, otherwise
+    `egl_device_index` is a single device and is returned unchanged
+    """
+    if egl_device_index == "all":
+        from computer_tennis.opengl_draw import egl_device_count
+
+        return list(range(egl_device_count()))
+    if isinstance(egl_device_index, (list, tuple)):
+        assert len(egl_device_index) > 0
+        return list(egl_device_index)
+    return egl_device_index
+
+
+def assign_devices(egl_device_index, count):
+    """
+    The device for each of `count` games or workers, a list of devices is used round-robin
+    """
+    if isinstance(egl_device_index, list):
+        return [egl_device_index[i % len(egl_device_index)] for i in range(count)]
+    return [egl_device_index] * count
+
+
+def make_seeds(seed, num_games):
+    """
+    A different seed for each game derived from `seed`, or from fresh entropy if `seed` is None
+    """
+    return np.random.SeedSequence(seed).generate_state(num_games).tolist()
+
+
+def build_env(
+    num, seeds, batched, instrument=False, trace=None, num_ob_buffers=None, **env_kwargs
+):
+    """
+    Create an environment that runs all of its games in this process
+    """
+    instrumentation = Instrumentation(trace=trace) if instrument else None
+    if batched:
+        from computer_tennis.batch_env import BatchTennisEnv
+
+        return BatchTennisEnv(
+            num=num,
+            seeds=seeds,
+            instrumentation=instrumentation,
+            num_ob_buffers=num_ob_buffers,
+            **env_kwargs,
+        )
+    devices = assign_devices(env_kwargs.pop("egl_device_index"), len(seeds))
+    return ConcatTennisEnv(
+        [
             SingleTennisEnv(
-                surface_type=surface_type,
-                num_players=num_players,
-                egl_device_index=egl_device_index,
+                seed=seed,
+                instrumentation=instrumentation,
+                egl_device_index=device,
+                **env_kwargs,
             )
+            for seed, device in zip(seeds, devices)
+        ],
+        instrumentation=instrumentation,
+        num_ob_buffers=num_ob_buffers,
+    )
+
+
+class ObservationBuffers:
+    """
+    A ring of preallocated (rew, ob, first) arrays, `rew`, `ob` and `first` have shape
+    (num_buffers, num, ...) and `current()` returns the arrays for buffer `index`
+    """
+
+    def __init__(self, rew, ob, first):
+        self.rew = rew
+        self.ob = ob
+        self.first = first
+        self.num_buffers = len(rew)
+        self.index = 0
+        self.buffers = [
+            (rew[i], gym3.types.multimap(lambda x: x[i], ob), first[i])
+            for i in range(self.num_buffers)
+        ]
+
+    @classmethod
+    def allocate(cls, ob_space, num, num_buffers):
+        assert num_buffers >= 1
+        return cls(
+            rew=np.zeros((num_buffers, num), dtype=np.float32),
+            ob=types_np.zeros(ob_space, bshape=(num_buffers, num)),
+            first=np.zeros((num_buffers, num), dtype=bool),
         )
-    return gym3.ConcatEnv(envs)
+
+    def current(self):
+        return self.buffers[self.index]
+
+    def advance(self):
+        self.index = (self.index + 1) % self.num_buffers
+
+
+class ConcatTennisEnv(gym3.ConcatEnv):
+    """
+    `gym3.ConcatEnv` of `SingleTennisEnv`s that can get and set the state of all the games
+
+    If `instrumentation` is set, it should be the one shared by all the envs and the time
+    spent in this env is recorded as the "concat_act" and "concat_observe" phases.
+
+    With `num_ob_buffers` set, each env writes its observation into a ring of
+    `ObservationBuffers` with `SingleTennisEnv.observe_into()` and `observe()` returns the
+    current buffer.
+    """
+
+    def __init__(self, envs, instrumentation=None, num_ob_buffers=None):
+        super().__init__(envs)
+        self.palette = envs[0].palette
+        self._ob_buffers = None
+        if num_ob_buffers is not None:
+            self._ob_buffers = ObservationBuffers.allocate(
+                self.ob_space, self.num, num_ob_buffers
+            )
+            # the part of each buffer for each env, made once so observe() doesn't make views
+            self._env_buffers = []
+            for rew, ob, first in self._ob_buffers.buffers:
+                env_buffers = []
+                start = 0
+                for env in envs:
+                    end = start + env.num
+                    env_buffers.append(
+                        (
+                            rew[start:end],
+                            gym3.types.multimap(lambda x: x[start:end], ob),
+                            first[start:end],
+                        )
+                    )
+                    start = end
+                self._env_buffers.append(env_buffers)
+            self._observed = False
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.wrap_methods(
+                self, {"concat_act": "act", "concat_observe": "observe"}
+            )
+
+    def stats(self):
+        if self._instrumentation is None:
+            return {}
+        return self._instrumentation.stats()
+
+    def observe(self):
+        if self._ob_buffers is None:
+            return super().observe()
+        if not self._observed:
+            for env, (rew, ob, first) in zip(
+                self.envs, self._env_buffers[self._ob_buffers.index]
+            ):
+                env.observe_into(rew, ob, first)
+            self._observed = True
+        return self._ob_buffers.current()
+
+    def _next_ob_buffer(self):
+        if self._ob_buffers is not None:
+            self._ob_buffers.advance()
+            self._observed = False
+
+    def act(self, ac):
+        super().act(ac)
+        self._next_ob_buffer()
+
+    def get_state(self):
+        return np.concatenate([env.get_state() for env in self.envs])
+
+    def set_state(self, state):
+        assert state.shape == (len(self.envs), GAME_STATE_SIZE)
+        for env, game_state in zip(self.envs, state):
+            env.set_state(game_state[np.newaxis])
+        self._next_ob_buffer()
+
+
+def make_ob_space(ob_mode, rgb_shape=(SCREEN_HEIGHT, SCREEN_WIDTH, 3)):
+    rgb_space = gym3.types.TensorType(
+        eltype=gym3.types.Discrete(256, dtype_name="uint8"), shape=rgb_shape
+    )
+    state_space = gym3.types.TensorType(
+        eltype=gym3.types.Real(), shape=(STATE_SIZE,)
+    )
+    if ob_mode == "pixels":
+        return rgb_space
+    elif ob_mode == "state":
+        return state_space
+    elif ob_mode == "both":
+        return gym3.types.DictType(rgb=rgb_space, state=state_space)
+    else:
+        raise Exception("invalid ob mode")
+
+
+def make_ob(ob_mode, get_rgb, get_state):
+    """
+    Build an observation for `ob_mode`, only calling `get_rgb()` if pixels are needed
+    """
+    if ob_mode == "pixels":
+        return get_rgb()
+    elif ob_mode == "state":
+        return get_state()
+    else:
+        return {"rgb": get_rgb(), "state": get_state()}
+
+
+class FrameStack:
+    """
+    The last `k` frames of each of `num` games, stored twice in a (num, 2 * k, ...) array so
+    that the last `k` frames are always a contiguous range of it
+
+    `push()` writes the new frame for every game to both of its slots instead of moving the
+    older frames and `get()` returns a (num, k, ...) view of the frames, oldest first.
+    """
+
+    def __init__(self, num, frame_shape, k):
+        self.k = k
+        self.frames = np.zeros((num, 2 * k) + tuple(frame_shape), dtype=np.uint8)
+        # slot of the newest frame
+        self.index = k - 1
+
+    def push(self, frames, first):
+        """
+        Add `frames` for every game, games where `first` is True lose their older frames
+        """
+        self.index = (self.index + 1) % self.k
+        if np.any(first):
+            self.frames[first] = 0
+        self.frames[:, self.index] = frames
+        self.frames[:, self.index + self.k] = frames
+
+    def get(self):
+        return self.frames[:, self.index + 1 : self.index + 1 + self.k]
+
+    def clear(self):
+        self.frames[:] = 0
+
+
+def view_options(ob_size, grayscale, crop, aspect_correct, ob_format="rgb"):
+    """
+    Keyword arguments for `build_surface()` that draw the `crop` region of the screen at the
+    observation size
+    """
+    if crop is None:
+        crop = Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+    else:
+        crop = Rect(*crop)
+    if ob_size is None:
+        height = crop.h
+        width = crop.w
+        if aspect_correct:
+            width = crop.w * PIXEL_ASPECT_RATIO
+        ob_size = (int(round(height)), int(round(width)))
+    elif aspect_correct:
+        raise Exception("aspect_correct picks the observation width, don't pass ob_size")
+    height, width = ob_size
+    assert height > 0 and width > 0
+    return dict(
+        pixel_width=width,
+        pixel_height=height,
+        view_width=crop.w,
+        view_height=crop.h,
+        view_x=crop.x,
+        view_y=crop.y,
+        channels=1 if grayscale or ob_format == "indexed" else 3,
+    )
+
+
+def surface_options(surface_type, egl_device_index, async_readback, readback_delay):
+    """
+    Keyword arguments for `build_surface()` for the options that only some surfaces support
+    """
+    surface_kwargs = {}
+    if surface_type == "opengl":
+        surface_kwargs["egl_device_index"] = egl_device_index
+        surface_kwargs["async_readback"] = async_readback
+        surface_kwargs["readback_delay"] = readback_delay
+    elif async_readback or readback_delay != 0:
+        raise Exception("async readback is only supported by the opengl surface")
+    return surface_kwargs
 
 
 class SingleTennisEnv(gym3.Env):
-    def __init__(self, surface_type, num_players, egl_device_index):
-        # same buttons as retro atari
-        self.buttons = [
-            "BUTTON",
-            None,
-            "SELECT",
-            "RESET",
-            "UP",
-            "DOWN",
-            "LEFT",
-            "RIGHT",
-        ]
-        ob_space = gym3.types.TensorType(
-            eltype=gym3.types.Discrete(256, dtype_name="uint8"),
-            shape=(SCREEN_HEIGHT, SCREEN_WIDTH, 3),
+    def __init__(
+        self,
+        surface_type,
+        num_players,
+        egl_device_index,
+        async_readback=False,
+        readback_delay=0,
+        ob_mode="pixels",
+        frame_skip=1,
+        max_pool_last=1,
+        ob_size=None,
+        grayscale=False,
+        crop=None,
+        aspect_correct=False,
+        ob_format="rgb",
+        seed=None,
+        instrumentation=None,
+        frame_stack=1,
+    ):
+        self.buttons = BUTTONS
+        view_kwargs = view_options(
+            ob_size,
+            grayscale=grayscale,
+            crop=crop,
+            aspect_correct=aspect_correct,
+            ob_format=ob_format,
+        )
+        self.palette = make_palette(ob_format)
+        rgb_shape = (
+            view_kwargs["pixel_height"],
+            view_kwargs["pixel_width"],
+            view_kwargs["channels"],
         )
+        self._frame_stack = None
+        self._frame_stacked = False
+        if frame_stack > 1 and ob_mode != "state":
+            self._frame_stack = FrameStack(1, rgb_shape, frame_stack)
+            rgb_shape = (frame_stack,) + rgb_shape
+        ob_space = make_ob_space(ob_mode, rgb_shape=rgb_shape)
         ac_space = gym3.types.TensorType(
             eltype=gym3.types.Discrete(2, dtype_name="uint8"),
             shape=(len(self.buttons),),
@@ -98,34 +728,44 @@ class SingleTennisEnv(gym3.Env):
         self._viewer = None
 
         self._ball_pos = None
-        self._last_obs = None
-
-        surface_kwargs = {}
-        if surface_type == "opengl":
-            surface_kwargs["egl_device_index"] = egl_device_index
-
-        self._surface = build_surface(
-            surface_type,
-            pixel_width=SCREEN_WIDTH,
-            pixel_height=SCREEN_HEIGHT,
-            view_width=SCREEN_WIDTH,
-            view_height=SCREEN_HEIGHT,
-            origin_at_center=False,
-            **surface_kwargs,
-        )
+        self._last_rew = None
+        self._last_first = None
 
-        self._white_color = Color(236 / 255, 236 / 255, 236 / 255)
-        # self._bg_color = Color(144 / 255, 72 / 255, 17 / 255)
-        # self._p1_color = Color(92 / 255, 186 / 255, 92 / 255)
-        # self._p2_color = Color(213 / 255, 130 / 255, 74 / 255)
-        self._bg_color = Color(114 / 255, 106 / 255, 149 / 255)
-        self._p1_color = Color(246 / 255, 167 / 255, 193 / 255)
-        self._p2_color = Color(151 / 255, 242 / 255, 243 / 255)
+        self._ob_mode = ob_mode
+        self._frame_skip = frame_skip
+        self._max_pool_last = max_pool_last
+        self._frame = None
+        # positions from earlier steps that are max pooled with the current frame
+        self._pool_positions = []
+        self._pool_frame = None
+        self._colors = frame_colors(grayscale, ob_format)
+        self._surface = None
+        self._renderer = None
+        if ob_mode != "state":
+            surface_kwargs = surface_options(
+                surface_type,
+                egl_device_index=egl_device_index,
+                async_readback=async_readback,
+                readback_delay=readback_delay,
+            )
+            if surface_type == "numpy":
+                from computer_tennis.sprite_render import (
+                    IncrementalRenderer,
+                    get_sprite_cache,
+                )
 
-        self._ball_rect = Rect(0, 0, 2, 4)
-        self._paddle_rect = Rect(0, 0, 4, 16)
-        self._bottom_bar_rect = Rect(0, SCREEN_HEIGHT - 16, SCREEN_WIDTH, 16)
-        self._top_bar_rect = Rect(0, 24, SCREEN_WIDTH, 10)
+                # only redraw the parts of the frame that changed
+                self._renderer = IncrementalRenderer(
+                    get_sprite_cache(colors=self._colors, **view_kwargs)
+                )
+            else:
+                self._surface = build_surface(
+                    surface_type, origin_at_center=False, **view_kwargs, **surface_kwargs
+                )
+        self._ball_rect = BALL_RECT
+        self._paddle_rect = PADDLE_RECT
+        self._bottom_bar_rect = BOTTOM_BAR_RECT
+        self._top_bar_rect = TOP_BAR_RECT
 
         self._ball_pos = None
         self._ball_vel = None
@@ -142,137 +782,264 @@ class SingleTennisEnv(gym3.Env):
             # make computer a bit slower so it's easier to score
             self._p2_accel = 0.8
 
+        if seed is None:
+            seed = make_seeds(None, 1)[0]
+        self._rng = CounterRandom(seed)
         self._reset_state(2, full_reset=True)
 
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.wrap_methods(
+                self,
+                {
+                    "act": "act",
+                    "physics": "_step",
+                    "observe": "observe",
+                    "render": "_render",
+                },
+            )
+            for drawer in [self._surface, self._renderer]:
+                if drawer is not None:
+                    instrumentation.wrap_methods(drawer, drawer.PHASE_METHODS)
+
         self._p1_score = 0
         self._p2_score = 0
 
-        self._last_obs = (0.0, self._render(), True)
-
-    def _rect_to_vertices(self, rect):
-        return [
-            Vec2(rect.x, rect.y),
-            Vec2(rect.x + rect.w, rect.y),
-            Vec2(rect.x + rect.w, rect.y + rect.h),
-            Vec2(rect.x, rect.y + rect.h),
-        ]
+        self._last_rew = 0.0
+        self._last_first = True
 
     def _reset_state(self, serve_to_player, full_reset):
-        self._ball_pos = Vec2(
-            78, random.randrange(115 - SCREEN_HEIGHT // 4, 115 + SCREEN_HEIGHT // 4)
+        p1_y = None if self._p1_pos is None else self._p1_pos.y
+        self._ball_pos, self._ball_vel, new_p1_y, p2_y = random_serve(
+            self._rng, serve_to_player, p1_y=p1_y, full_reset=full_reset
         )
 
-        if serve_to_player == 1:
-            if self._p1_pos.y > 100:
-                start_angle = 0
-                end_angle = 45
-            else:
-                start_angle = 315
-                end_angle = 360
-        elif serve_to_player == 2:
-            start_angle = 135
-            end_angle = 225
-        else:
-            raise Exception("invalid player")
-
-        ball_angle = random.uniform(
-            start_angle / 180 * math.pi, end_angle / 180 * math.pi
-        )
-        ball_dir = Vec2(math.cos(ball_angle), math.sin(ball_angle))
-        self._ball_vel = ball_dir * random.uniform(0.5, 2.0)
-
         if full_reset:
-            self._p1_pos = Vec2(140, 168 + random.uniform(-10, 10))
+            self._p1_pos = Vec2(140, new_p1_y)
             self._p1_vel = Vec2(0, 0)
 
-        self._p2_pos = Vec2(16, 115 + random.uniform(-10, 10))
+        self._p2_pos = Vec2(16, p2_y)
         self._p2_vel = Vec2(0, 0)
 
-    def _lines_overlap(self, a1, a2, b1, b2):
-        assert a1 <= a2 and b1 <= b2
-        return a1 <= b2 and b1 <= a2
-
-    def _rects_overlap(self, a, b):
-        return self._lines_overlap(
-            a.x, a.x + a.w, b.x, b.x + b.w
-        ) and self._lines_overlap(a.y, a.y + a.h, b.y, b.y + b.h)
-
-    def _move_rect(self, p, r):
-        return Rect(p.x + r.x, p.y + r.y, r.w, r.h)
+    def _ball_overlaps(self, x, y, rect):
+        """
+        Check if the ball overlaps `rect` moved to (x, y)
+        """
+        ball_x = self._ball_pos.x + self._ball_rect.x
+        ball_y = self._ball_pos.y + self._ball_rect.y
+        x = x + rect.x
+        y = y + rect.y
+        return (
+            ball_x <= x + rect.w
+            and x <= ball_x + self._ball_rect.w
+            and ball_y <= y + rect.h
+            and y <= ball_y + self._ball_rect.h
+        )
 
-    def _draw_digit(self, digit, pos, color):
-        for rect in DIGITS[digit]:
-            vertices = [v + pos for v in self._rect_to_vertices(rect)]
-            self._surface.draw_polygon(vertices, color)
+    def _hit_paddle(self, player, pos):
+        # depending on where we collide with the paddle, send the ball back out
+        diff_y = pos.y + self._paddle_rect.h / 2 - (self._ball_pos.y + self._ball_rect.h / 2)
+        dist_y = abs(diff_y)
+        v_x = 1
+        if dist_y <= 2:
+            v_y = 0
+        elif dist_y <= 4:
+            v_y = 1
+        else:
+            v_y = 2
+        if diff_y > 0:
+            # send upward
+            v_y = -v_y
+        if player == 1:
+            # reverse x velocity
+            v_x = -v_x
+        self._ball_vel.set(v_x, v_y)
 
-    def _render(self):
-        self._surface.reset(color=self._bg_color)
+    def _get_positions(self):
+        return dict(
+            p1_score=self._p1_score,
+            p2_score=self._p2_score,
+            ball_pos=Vec2(self._ball_pos.x, self._ball_pos.y),
+            p1_pos=Vec2(self._p1_pos.x, self._p1_pos.y),
+            p2_pos=Vec2(self._p2_pos.x, self._p2_pos.y),
+        )
 
-        self._draw_digit(self._p1_score % 10, Vec2(116, 1), self._p1_color)
-        if self._p1_score >= 10:
-            self._draw_digit(
-                int(self._p1_score / 10) % 10, Vec2(100, 1), self._p1_color
-            )
+    def _render(self, positions=None, out=None):
+        if positions is None:
+            positions = self._get_positions()
+        if self._renderer is not None:
+            frame = self._renderer.render(**positions)
+            if out is None:
+                return frame.copy()
+            np.copyto(out, frame)
+            return out
+        draw_frame(self._surface, colors=self._colors, **positions)
+        return self._surface.get_image(out=out)
 
-        self._draw_digit(self._p2_score % 10, Vec2(36, 1), self._p2_color)
-        if self._p2_score >= 10:
-            self._draw_digit(int(self._p2_score / 10) % 10, Vec2(20, 1), self._p2_color)
+    def _render_rgb(self, out=None):
+        frame = self._render(out=out)
+        for positions in self._pool_positions:
+            if self._pool_frame is None:
+                self._pool_frame = np.empty_like(frame)
+            np.maximum(frame, self._render(positions, out=self._pool_frame), out=frame)
+        return frame
 
-        vertices = [v + self._ball_pos for v in self._rect_to_vertices(self._ball_rect)]
-        self._surface.draw_polygon(vertices, self._white_color)
+    def _get_rgb(self):
+        # frames are rendered lazily since many steps are never observed
+        if self._frame is None:
+            self._frame = self._render_rgb()
+        return self._frame
 
-        vertices = [v + self._p1_pos for v in self._rect_to_vertices(self._paddle_rect)]
-        self._surface.draw_polygon(vertices, self._p1_color)
+    def _get_ob_rgb(self):
+        if self._frame_stack is None:
+            return self._get_rgb()
+        if not self._frame_stacked:
+            self._frame_stack.push(self._get_rgb()[np.newaxis], [self._last_first])
+            self._frame_stacked = True
+        return self._frame_stack.get()[0]
 
-        vertices = [v + self._p2_pos for v in self._rect_to_vertices(self._paddle_rect)]
-        self._surface.draw_polygon(vertices, self._p2_color)
+    def _get_state(self):
+        return np.array(self._state_values()[:STATE_SIZE], dtype=np.float32)
 
-        self._surface.draw_polygon(
-            self._rect_to_vertices(self._bottom_bar_rect), self._white_color
-        )
-        self._surface.draw_polygon(
-            self._rect_to_vertices(self._top_bar_rect), self._white_color
+    def _state_values(self):
+        return (
+            self._ball_pos.x,
+            self._ball_pos.y,
+            self._ball_vel.x,
+            self._ball_vel.y,
+            self._p1_pos.x,
+            self._p1_pos.y,
+            self._p1_vel.x,
+            self._p1_vel.y,
+            self._p2_pos.x,
+            self._p2_pos.y,
+            self._p2_vel.x,
+            self._p2_vel.y,
+            self._p1_score,
+            self._p2_score,
+            self._last_rew,
+            self._last_first,
+            self._rng.seed,
+            self._rng.counter,
         )
 
-        img = self._surface.get_image()
-        return img
+    def get_state(self):
+        """
+        The state of the game as a (1, GAME_STATE_SIZE) float64 array
+        """
+        return np.array([self._state_values()], dtype=np.float64)
+
+    def set_state(self, state):
+        """
+        Restore a state from `get_state()`, the frame is not rendered until it is observed
+        """
+        assert state.shape == (1, GAME_STATE_SIZE)
+        values = state[0].tolist()
+        self._ball_pos = Vec2(values[0], values[1])
+        self._ball_vel = Vec2(values[2], values[3])
+        self._p1_pos = Vec2(values[4], values[5])
+        self._p1_vel = Vec2(values[6], values[7])
+        self._p2_pos = Vec2(values[8], values[9])
+        self._p2_vel = Vec2(values[10], values[11])
+        self._p1_score = int(values[12])
+        self._p2_score = int(values[13])
+        self._last_rew = values[14]
+        self._last_first = bool(values[15])
+        self._rng = CounterRandom(int(values[16]), counter=int(values[17]))
+        self._pool_positions = []
+        self._frame = None
+        if self._frame_stack is not None:
+            self._frame_stack.clear()
+            self._frame_stacked = False
 
     def observe(self):
-        rew, img, first = self._last_obs
+        rew = self._last_rew
+        first = self._last_first
+        ob = make_ob(self._ob_mode, get_rgb=self._get_ob_rgb, get_state=self._get_state)
         if self.num == 2:
             return (
                 np.array([rew, -rew], dtype=np.float32),
-                np.stack([img, img], axis=0),
-                np.array([first, first], dtype=np.bool),
+                types_np.stack([ob, ob]),
+                np.array([first, first], dtype=bool),
             )
         else:
             return (
                 np.array([rew], dtype=np.float32),
-                np.expand_dims(img, axis=0),
-                np.array([first], dtype=np.bool),
+                types_np.stack([ob]),
+                np.array([first], dtype=bool),
             )
 
+    def observe_into(self, rew, ob, first):
+        """
+        Write the observation into the arrays `rew`, `ob` and `first` instead of making new ones
+        """
+        rew[0] = self._last_rew
+        first[:] = self._last_first
+        if self.num == 2:
+            rew[1] = -self._last_rew
+        if self._ob_mode == "pixels":
+            rgb = ob
+        elif self._ob_mode == "state":
+            rgb = None
+            state = ob
+        else:
+            rgb = ob["rgb"]
+            state = ob["state"]
+        if rgb is not None:
+            if self._frame_stack is not None:
+                rgb[0] = self._get_ob_rgb()
+            elif self._frame is not None:
+                rgb[0] = self._frame
+            else:
+                self._render_rgb(out=rgb[0])
+            if self.num == 2:
+                rgb[1] = rgb[0]
+        if self._ob_mode != "pixels":
+            state[:] = self._state_values()[:STATE_SIZE]
+
     def act(self, ac):
-        action = ac[0]
-        if action[4] and action[5]:
-            pass
-        elif action[4]:
+        if self._frame_stack is not None:
+            # every frame is part of a later observation
+            self._get_ob_rgb()
+            self._frame_stacked = False
+        # read the buttons once so that the steps don't need to index into the array
+        p1_direction = _button_direction(ac, 0)
+        p2_direction = _button_direction(ac, 1) if self.num == 2 else 0
+        rew = 0.0
+        first = False
+        self._pool_positions.clear()
+        for step in range(self._frame_skip):
+            step_rew, first = self._step(p1_direction, p2_direction)
+            rew += step_rew
+            if first:
+                # don't pool frames from before the end of the episode
+                self._pool_positions.clear()
+                break
+            if self._frame_skip - self._max_pool_last <= step < self._frame_skip - 1:
+                self._pool_positions.append(self._get_positions())
+
+        self._last_rew = rew
+        self._last_first = first
+        self._frame = None
+
+    def _step(self, p1_direction, p2_direction):
+        """
+        Run a single step of physics, the directions come from `_button_direction()`
+        """
+        if p1_direction < 0:
             # up
-            self._p1_vel += Vec2(0, -self._p1_accel)
-        elif action[5]:
+            self._p1_vel.y -= self._p1_accel
+        elif p1_direction > 0:
             # down
-            self._p1_vel += Vec2(0, self._p1_accel)
+            self._p1_vel.y += self._p1_accel
 
         if self.num == 2:
-            p2_action = ac[1]
-            if p2_action[4] and p2_action[5]:
-                pass
-            elif p2_action[4]:
+            if p2_direction < 0:
                 # up
-                self._p2_vel += Vec2(0, -self._p2_accel)
-            elif p2_action[5]:
+                self._p2_vel.y -= self._p2_accel
+            elif p2_direction > 0:
                 # down
-                self._p2_vel += Vec2(0, self._p2_accel)
+                self._p2_vel.y += self._p2_accel
         else:
             # AI
             paddle_mid_y = self._p2_pos.y + self._paddle_rect.h / 2
@@ -282,9 +1049,9 @@ class SingleTennisEnv(gym3.Env):
                 # dead zone
                 pass
             elif paddle_mid_y > ball_mid_y:
-                self._p2_vel += Vec2(0, -self._p2_accel)
+                self._p2_vel.y -= self._p2_accel
             else:
-                self._p2_vel += Vec2(0, self._p2_accel)
+                self._p2_vel.y += self._p2_accel
 
         self._p1_vel.y *= 0.8
         self._p2_vel.y *= 0.8
@@ -298,43 +1065,16 @@ class SingleTennisEnv(gym3.Env):
         self._p1_pos.y = _clamp(self._p1_pos.y, 24, SCREEN_HEIGHT)
         self._p2_pos.y = _clamp(self._p2_pos.y, 24, SCREEN_HEIGHT)
 
-        objects = [
-            (1, self._p1_pos, self._paddle_rect),
-            (2, self._p2_pos, self._paddle_rect),
-            (0, Vec2(0, 0), self._bottom_bar_rect),
-            (0, Vec2(0, 0), self._top_bar_rect),
-        ]
-
-        for (player, pos, rect) in objects:
-            if self._rects_overlap(
-                self._move_rect(self._ball_pos, self._ball_rect),
-                self._move_rect(pos, rect),
-            ):
-                if player == 0:
-                    # bars are at the top and bottom, so just invert y velocity
-                    self._ball_vel.y = -self._ball_vel.y
-                else:
-                    # depending on where we collide with the paddle, send the ball back out
-                    diff_y = (
-                        pos.y
-                        + self._paddle_rect.h / 2
-                        - (self._ball_pos.y + self._ball_rect.h / 2)
-                    )
-                    dist_y = abs(diff_y)
-                    v_x = 1
-                    if dist_y <= 2:
-                        v_y = 0
-                    elif dist_y <= 4:
-                        v_y = 1
-                    else:
-                        v_y = 2
-                    if diff_y > 0:
-                        # send upward
-                        v_y = -v_y
-                    if player == 1:
-                        # reverse x velocity
-                        v_x = -v_x
-                    self._ball_vel = Vec2(v_x, v_y)
+        # check each object in turn without building any temporary objects
+        if self._ball_overlaps(self._p1_pos.x, self._p1_pos.y, self._paddle_rect):
+            self._hit_paddle(1, self._p1_pos)
+        if self._ball_overlaps(self._p2_pos.x, self._p2_pos.y, self._paddle_rect):
+            self._hit_paddle(2, self._p2_pos)
+        # bars are at the top and bottom, so just invert y velocity
+        if self._ball_overlaps(0, 0, self._bottom_bar_rect):
+            self._ball_vel.y = -self._ball_vel.y
+        if self._ball_overlaps(0, 0, self._top_bar_rect):
+            self._ball_vel.y = -self._ball_vel.y
 
         if self._ball_pos.x < 0 or self._ball_pos.x > 160:
             self._ball_vel.x = -self._ball_vel.x
@@ -354,7 +1094,15 @@ class SingleTennisEnv(gym3.Env):
                 first = True
             self._reset_state(serve_to_player=1, full_reset=first)
 
-        self._last_obs = (rew, self._render(), first)
+        return rew, first
+
+    def stats(self):
+        """
+        Time spent in each phase if this env is instrumented, see `Instrumentation.stats()`
+        """
+        if self._instrumentation is None:
+            return {}
+        return self._instrumentation.stats()
 
     def get_info(self):
         return [{} for _ in range(self.num)]
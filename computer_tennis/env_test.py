@@ -1,10 +1,22 @@
+import tracemalloc
+
+import numpy as np
 import pytest
 from gym3 import types_np
+from gym3.types import multimap
 
-from computer_tennis.env import TennisEnv
+from computer_tennis.batch_env_test import assert_equal
+from computer_tennis.env import (
+    BUTTONS,
+    GAME_STATE_SIZE,
+    MAX_SCORE,
+    STATE_SIZE,
+    Rect,
+    TennisEnv,
+)
 
 TEST_ENVS = [TennisEnv]
-SURFACE_TYPES = ["opengl", "cairo"]
+SURFACE_TYPES = ["opengl", "cairo", "numpy"]
 
 
 @pytest.mark.parametrize("make_env", TEST_ENVS)
@@ -34,5 +46,399 @@ def test_speed(benchmark, make_env, surface_type):
     def loop():
         for _ in range(1000):
             env.act(ac)
+            # frames are only rendered when observed
+            env.observe()
 
     benchmark(loop)
+
+
+def test_physics_speed(benchmark):
+    """
+    Test the speed of stepping without rendering
+    """
+    env = TennisEnv(ob_mode="state")
+    ac = types_np.zeros(env.ac_space, bshape=(env.num,))
+
+    def loop():
+        for _ in range(1000):
+            env.act(ac)
+
+    benchmark(loop)
+
+
+def test_step_allocations():
+    """
+    Stepping the physics should not allocate anything except when serving
+    """
+    env = TennisEnv(ob_mode="state", seed=0)
+    ac = np.zeros((1, len(BUTTONS)), dtype=np.uint8)
+    ac[0, BUTTONS.index("UP")] = 1
+
+    def measure(fn):
+        peaks = []
+        for _ in range(1000):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            fn()
+            peaks.append(tracemalloc.get_traced_memory()[1] - start)
+        return np.median(peaks)
+
+    tracemalloc.start()
+    try:
+        overhead = measure(lambda: None)
+        allocated = measure(lambda: env.envs[0].act(ac)) - overhead
+    finally:
+        tracemalloc.stop()
+    # act() itself allocates a few small objects, but nothing per step
+    assert allocated <= 64
+
+
+@pytest.mark.parametrize(
+    "env_kwargs",
+    [{}, dict(ob_size=(84, 84), grayscale=True, crop=Rect(0, 34, 160, 160))],
+)
+def test_numpy_surface_matches_opengl(env_kwargs):
+    """
+    The software renderer should cover exactly the same pixels as the opengl one
+    """
+    envs = []
+    for surface_type in ["opengl", "numpy"]:
+        envs.append(TennisEnv(num=2, surface_type=surface_type, seed=0, **env_kwargs))
+
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        _, expected, _ = envs[0].observe()
+        _, actual, _ = envs[1].observe()
+        assert np.array_equal(expected, actual)
+        ac = rng.randint(0, 2, size=(2, len(BUTTONS)), dtype=np.uint8)
+        for env in envs:
+            env.act(ac)
+
+
+@pytest.mark.parametrize("readback_delay", [0, 1])
+def test_async_readback(readback_delay):
+    """
+    Async readback should give the same frames as reading synchronously, just delayed
+    """
+    sync_env = TennisEnv(seed=0)
+    async_env = TennisEnv(async_readback=True, readback_delay=readback_delay, seed=0)
+
+    rng = np.random.RandomState(0)
+    sync_obs = []
+    for _ in range(100):
+        sync_obs.append(sync_env.observe()[1])
+        _, ob, _ = async_env.observe()
+        assert np.array_equal(ob, sync_obs[max(len(sync_obs) - 1 - readback_delay, 0)])
+        ac = rng.randint(0, 2, size=(1, len(BUTTONS)), dtype=np.uint8)
+        for env in [sync_env, async_env]:
+            env.act(ac)
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_state_ob_mode(batched):
+    """
+    State observations should match the game state and not need a surface
+    """
+    env = TennisEnv(num=2, ob_mode="state", batched=batched)
+    assert env.ob_space.shape == (STATE_SIZE,)
+    for _ in range(10):
+        ac = types_np.sample(env.ac_space, bshape=(env.num,))
+        env.act(ac)
+    _, ob, _ = env.observe()
+    assert ob.shape == (2, STATE_SIZE) and ob.dtype == np.float32
+    if batched:
+        assert env._renderer is None
+        assert np.array_equal(ob[:, 2:4], env._ball_vel.astype(np.float32))
+    else:
+        assert env.envs[0]._surface is None and env.envs[0]._renderer is None
+        ball_vel = env.envs[1]._ball_vel
+        assert np.array_equal(ob[1, 2:4], np.array([ball_vel.x, ball_vel.y], np.float32))
+
+
+@pytest.mark.parametrize(
+    "env_kwargs, shape",
+    [
+        ({}, (210, 160, 3)),
+        (dict(grayscale=True), (210, 160, 1)),
+        (dict(ob_size=(84, 84), crop=Rect(0, 34, 160, 160)), (84, 84, 3)),
+        (dict(aspect_correct=True), (210, 280, 3)),
+        (dict(aspect_correct=True, crop=Rect(0, 34, 160, 160)), (160, 280, 3)),
+    ],
+)
+def test_preprocessing(env_kwargs, shape):
+    """
+    Preprocessed observations should have the shape from the ob space
+    """
+    env = TennisEnv(surface_type="numpy", **env_kwargs)
+    assert env.ob_space.shape == shape
+    _, ob, _ = env.observe()
+    assert ob.shape == (1,) + shape
+    if env_kwargs.get("grayscale"):
+        # the background is the most common color
+        assert np.median(ob) == round(0.299 * 114 + 0.587 * 106 + 0.114 * 149)
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_get_set_state(batched):
+    """
+    Restoring a state should replay the same steps, including the serves
+    """
+    env = TennisEnv(num=4, surface_type="numpy", batched=batched, seed=0)
+    assert not np.array_equal(env.get_state()[0], env.get_state()[1])
+    rng = np.random.RandomState(0)
+    acs = rng.randint(0, 2, size=(600, 4, len(BUTTONS)), dtype=np.uint8)
+    for ac in acs[:100]:
+        env.act(ac)
+    state = env.get_state()
+    assert state.shape == (4, GAME_STATE_SIZE)
+    expected = []
+    for ac in acs[100:]:
+        env.act(ac)
+        expected.append(env.observe())
+    assert env.get_state()[:, 12:14].sum() > state[:, 12:14].sum()
+
+    env.set_state(state)
+    for ac, expected_ob in zip(acs[100:], expected):
+        env.act(ac)
+        for e, a in zip(expected_ob, env.observe()):
+            assert_equal(e, a)
+
+
+def test_frame_skip():
+    """
+    Frame skip should be the same as repeating the action and max pooling the last frames
+    """
+    env = TennisEnv(surface_type="numpy", ob_mode="both", seed=0)
+    skip_env = TennisEnv(
+        surface_type="numpy", ob_mode="both", frame_skip=4, max_pool_last=2, seed=0
+    )
+
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        ac = rng.randint(0, 2, size=(1, len(BUTTONS)), dtype=np.uint8)
+        total_rew = 0
+        frames = []
+        for _ in range(4):
+            env.act(ac)
+            rew, ob, _ = env.observe()
+            total_rew += rew
+            frames.append(ob["rgb"])
+        skip_env.act(ac)
+        skip_rew, skip_ob, _ = skip_env.observe()
+        assert np.array_equal(skip_rew, total_rew)
+        assert np.array_equal(skip_ob["state"], ob["state"])
+        assert np.array_equal(skip_ob["rgb"], np.maximum(frames[-2], frames[-1]))
+
+
+@pytest.mark.parametrize(
+    "env_kwargs",
+    [
+        dict(surface_type="numpy"),
+        dict(surface_type="opengl"),
+        dict(surface_type="numpy", batched=True),
+        dict(surface_type="opengl", batched=True),
+        dict(surface_type="numpy", batched=True, frame_skip=4, max_pool_last=2),
+        dict(surface_type="numpy", num_workers=2),
+    ],
+)
+@pytest.mark.parametrize("num_players", [1, 2])
+def test_ob_buffers(env_kwargs, num_players):
+    """
+    Observations from the ring of buffers should match the normal ones and stay valid until
+    the buffer is reused
+    """
+    num_ob_buffers = 3
+    envs = [
+        TennisEnv(
+            num=4,
+            num_players=num_players,
+            ob_mode="both",
+            seed=0,
+            num_ob_buffers=n,
+            **env_kwargs,
+        )
+        for n in [None, num_ob_buffers]
+    ]
+    rng = np.random.RandomState(0)
+    kept = []
+    try:
+        for step in range(50):
+            ac = rng.randint(0, 2, size=(4, len(BUTTONS)), dtype=np.uint8)
+            for env in envs:
+                env.act(ac)
+            if step == 25:
+                state = envs[0].get_state()
+                for env in envs:
+                    env.set_state(state)
+            expected, actual = [env.observe() for env in envs]
+            # batched envs return their frames without copying them
+            expected = [multimap(np.copy, x) for x in expected]
+            for e, a in zip(expected, actual):
+                assert_equal(e, a)
+            kept.append((expected, actual))
+            for e, a in zip(*kept[max(len(kept) - num_ob_buffers + 1, 0)]):
+                assert_equal(e, a)
+    finally:
+        for env in envs:
+            if hasattr(env, "close"):
+                env.close()
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_ob_buffers_allocations(batched):
+    """
+    With a ring of buffers, stepping and observing should not allocate any frames
+    """
+    env = TennisEnv(num=4, surface_type="numpy", batched=batched, num_ob_buffers=2)
+    ac = np.zeros((env.num, len(BUTTONS)), dtype=np.uint8)
+    ac[:, BUTTONS.index("UP")] = 1
+
+    def step():
+        env.act(ac)
+        env.observe()
+
+    for _ in range(10):
+        step()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(100):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            step()
+            peaks.append(tracemalloc.get_traced_memory()[1] - start)
+    finally:
+        tracemalloc.stop()
+    # the batched renderer makes small temporary arrays for the scores
+    ob_size = env.num * np.prod(env.ob_space.shape)
+    assert np.median(peaks) < ob_size / 10
+
+
+@pytest.mark.parametrize(
+    "env_kwargs",
+    [
+        dict(),
+        dict(batched=True),
+        dict(batched=True, num_players=2),
+        dict(batched=True, num_ob_buffers=2),
+        dict(num_ob_buffers=2),
+    ],
+)
+def test_frame_stack(env_kwargs):
+    """
+    Stacked frames should be the last frames of the episode, with zeros before the start
+    """
+    k = 4
+    num = 4
+    make_env_kwargs = dict(
+        num=num, surface_type="numpy", ob_size=(42, 42), grayscale=True, seed=0
+    )
+    make_env_kwargs.update(env_kwargs)
+    env = TennisEnv(**make_env_kwargs)
+    stack_env = TennisEnv(frame_stack=k, **make_env_kwargs)
+    assert stack_env.ob_space.shape == (k,) + env.ob_space.shape
+    # start near the end of the episode so that there are new episodes
+    state = env.get_state()
+    state[:, 12:14] = MAX_SCORE - 1
+    env.set_state(state)
+    stack_env.set_state(state)
+    rng = np.random.RandomState(0)
+    expected = np.zeros((num,) + stack_env.ob_space.shape, dtype=np.uint8)
+    num_firsts = 0
+    for step in range(300):
+        if step > 0:
+            ac = rng.randint(0, 2, size=(num, len(BUTTONS)), dtype=np.uint8)
+            env.act(ac)
+            stack_env.act(ac)
+        _, ob, first = env.observe()
+        expected[first] = 0
+        num_firsts += first.sum()
+        expected = np.concatenate([expected[:, 1:], ob[:, np.newaxis]], axis=1)
+        # frames that are not observed are still stacked
+        if step % 3 == 0:
+            continue
+        _, stack_ob, stack_first = stack_env.observe()
+        assert np.array_equal(first, stack_first)
+        assert np.array_equal(stack_ob, expected)
+    assert num_firsts > num
+
+
+@pytest.mark.parametrize(
+    "env_kwargs", [dict(), dict(batched=True), dict(num_workers=2, batched=True)]
+)
+def test_egl_devices(monkeypatch, env_kwargs):
+    """
+    Games spread over several devices should render the same frames as on a single device
+    """
+    from computer_tennis.opengl_draw import FAKE_EGL_DEVICES_VAR, egl_device_count
+
+    monkeypatch.setenv(FAKE_EGL_DEVICES_VAR, "3")
+    assert egl_device_count() == 3
+    envs = [
+        TennisEnv(
+            num=6,
+            surface_type="opengl",
+            seed=0,
+            egl_device_index=egl_device_index,
+            instrument=True,
+            **env_kwargs,
+        )
+        for egl_device_index in [None, "all"]
+    ]
+    rng = np.random.RandomState(0)
+    try:
+        for _ in range(20):
+            ac = rng.randint(0, 2, size=(6, len(BUTTONS)), dtype=np.uint8)
+            for env in envs:
+                env.act(ac)
+            expected, actual = [env.observe() for env in envs]
+            for e, a in zip(expected, actual):
+                assert_equal(e, a)
+        stats = envs[1].stats()
+    finally:
+        for env in envs:
+            if hasattr(env, "close"):
+                env.close()
+    # every device renders 2 of the 6 games for each step, with num_workers each worker
+    # renders 3 games on one device and also renders the first observation
+    if "num_workers" in env_kwargs:
+        counts = [63, 63, 0]
+    else:
+        counts = [40, 40, 40]
+    for device, count in enumerate(counts):
+        phase = stats.get(f"render/egl_device_{device}", dict(count=0))
+        assert phase["count"] == count
+
+
+@pytest.mark.parametrize("surface_type", ["numpy", "opengl"])
+@pytest.mark.parametrize(
+    "env_kwargs",
+    [
+        dict(),
+        dict(batched=True),
+        dict(batched=True, num_players=2),
+        dict(ob_size=(84, 84), crop=Rect(0, 34, 160, 160)),
+        dict(batched=True, aspect_correct=True, frame_skip=4),
+    ],
+)
+def test_indexed_ob_format(surface_type, env_kwargs):
+    """
+    Looking up indexed observations in the palette should give the rgb observations
+    """
+    envs = [
+        TennisEnv(
+            num=4, surface_type=surface_type, seed=0, ob_format=ob_format, **env_kwargs
+        )
+        for ob_format in ["rgb", "indexed"]
+    ]
+    assert envs[0].palette is None
+    palette = envs[1].palette
+    assert envs[1].ob_space.shape == envs[0].ob_space.shape[:-1] + (1,)
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        ac = rng.randint(0, 2, size=(4, len(BUTTONS)), dtype=np.uint8)
+        for env in envs:
+            env.act(ac)
+        (_, rgb_ob, _), (_, indexed_ob, _) = [env.observe() for env in envs]
+        assert indexed_ob.max() < len(palette)
+        assert np.array_equal(palette[indexed_ob[..., 0]], rgb_ob)
@@ -0,0 +1,125 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# upper bounds in seconds of the histogram buckets, from 1us to about 1s, durations longer than
+# the last bound go in an extra bucket at the end
+HISTOGRAM_BOUNDS = [1e-6 * 2 ** i for i in range(21)]
+
+
+class _Phase:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.seconds += duration
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, duration)] += 1
+
+
+class Instrumentation:
+    """
+    Records how long named phases take by wrapping the methods that run them, so objects that
+    are not instrumented run exactly the same code as before
+
+    `trace` is called with (name, start, duration) for every call, with times in seconds from
+    `time.perf_counter()`, see `ChromeTrace`.
+    """
+
+    def __init__(self, trace=None):
+        self._trace = trace
+        self._phases = {}
+
+    def wrap(self, name, fn):
+        """
+        Wrap `fn` so that each call is recorded as the phase `name`
+        """
+        if name not in self._phases:
+            self._phases[name] = _Phase()
+        phase = self._phases[name]
+        trace = self._trace
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            result = fn(*args, **kwargs)
+            duration = perf_counter() - start
+            phase.add(duration)
+            if trace is not None:
+                trace(name, start, duration)
+            return result
+
+        return wrapper
+
+    def wrap_methods(self, obj, phase_methods):
+        """
+        Replace methods of `obj` with wrapped versions, `phase_methods` maps each phase name to
+        the name of the method
+        """
+        for name, method in phase_methods.items():
+            setattr(obj, method, self.wrap(name, getattr(obj, method)))
+
+    def stats(self):
+        """
+        A dict of phase name to a dict with the number of calls, the total time in seconds and a
+        histogram of the call durations with buckets from `HISTOGRAM_BOUNDS`
+        """
+        return {
+            name: dict(
+                count=phase.count,
+                seconds=phase.seconds,
+                histogram=list(phase.histogram),
+            )
+            for name, phase in self._phases.items()
+        }
+
+
+def merge_stats(stats_list):
+    """
+    Add up results from `Instrumentation.stats()`
+    """
+    result = {}
+    for stats in stats_list:
+        for name, phase in stats.items():
+            if name not in result:
+                result[name] = dict(
+                    count=0, seconds=0.0, histogram=[0] * len(phase["histogram"])
+                )
+            total = result[name]
+            total["count"] += phase["count"]
+            total["seconds"] += phase["seconds"]
+            total["histogram"] = [
+                a + b for a, b in zip(total["histogram"], phase["histogram"])
+            ]
+    return result
+
+
+class ChromeTrace:
+    """
+    Trace callback for `Instrumentation` that saves every call as an event in the Chrome trace
+    format, which can be viewed with chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self):
+        self.events = []
+        self._pid = os.getpid()
+
+    def __call__(self, name, start, duration):
+        self.events.append(
+            dict(
+                name=name,
+                ph="X",
+                ts=start * 1e6,
+                dur=duration * 1e6,
+                pid=self._pid,
+                tid=threading.get_ident(),
+            )
+        )
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=self.events), f)
@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+import pytest
+
+from computer_tennis.env import BUTTONS, TennisEnv
+from computer_tennis.instrument import HISTOGRAM_BOUNDS, ChromeTrace, merge_stats
+
+
+@pytest.mark.parametrize(
+    "surface_type, batched, num_workers",
+    [
+        ("opengl", False, None),
+        ("opengl", True, None),
+        ("numpy", False, None),
+        ("numpy", True, None),
+        ("numpy", False, 2),
+    ],
+)
+def test_stats(surface_type, batched, num_workers):
+    num = 2
+    num_steps = 10
+    env = TennisEnv(
+        num=num,
+        surface_type=surface_type,
+        batched=batched,
+        num_workers=num_workers,
+        instrument=True,
+    )
+    ac = np.zeros((num, len(BUTTONS)), dtype=np.uint8)
+    for _ in range(num_steps):
+        env.act(ac)
+        env.observe()
+    stats = env.stats()
+    if num_workers is not None:
+        env.close()
+
+    # a batched env steps all of its games with each call
+    calls = num_steps * (1 if batched else num)
+    assert stats["act"]["count"] == calls
+    assert stats["physics"]["count"] == calls
+    for name in ["act", "physics", "observe", "render", "draw"]:
+        assert stats[name]["count"] > 0
+        assert stats[name]["seconds"] > 0
+        assert sum(stats[name]["histogram"]) == stats[name]["count"]
+        assert len(stats[name]["histogram"]) == len(HISTOGRAM_BOUNDS) + 1
+    if surface_type == "opengl":
+        assert stats["readback"]["count"] == num_steps * num
+    if not batched and num_workers is None:
+        assert stats["concat_act"]["count"] == num_steps
+
+
+def test_not_instrumented():
+    env = TennisEnv(num=2, surface_type="numpy")
+    assert env.stats() == {}
+    # nothing should be wrapped
+    assert "act" not in vars(env.envs[0])
+
+
+def test_chrome_trace(tmp_path):
+    trace = ChromeTrace()
+    env = TennisEnv(num=1, surface_type="numpy", trace=trace)
+    env.act(np.zeros((1, len(BUTTONS)), dtype=np.uint8))
+    env.observe()
+    path = tmp_path / "trace.json"
+    trace.write(path)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    names = {event["name"] for event in events}
+    assert {"act", "physics", "observe", "render", "draw"} <= names
+    assert all(event["dur"] >= 0 for event in events)
+
+
+def test_merge_stats():
+    a = dict(x=dict(count=1, seconds=1.0, histogram=[1, 0]))
+    b = dict(
+        x=dict(count=2, seconds=0.5, histogram=[1, 1]),
+        y=dict(count=1, seconds=2.0, histogram=[0, 1]),
+    )
+    assert merge_stats([a, b]) == dict(
+        x=dict(count=3, seconds=1.5, histogram=[2, 1]),
+        y=dict(count=1, seconds=2.0, histogram=[0, 1]),
+    )
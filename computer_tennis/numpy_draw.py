@@ -0,0 +1,118 @@
+import math
+
+import numpy as np
+
+from computer_tennis.types import Color
+
+
+def color_to_pixel(color):
+    return np.array(
+        [round(color.r * 255), round(color.g * 255), round(color.b * 255)],
+        dtype=np.uint8,
+    )
+
+
+def _snap(v):
+    # opengl rasterizers snap vertices to 1/256 of a pixel
+    return math.floor(v * 256 + 0.5) / 256
+
+
+def pixel_span(low, high, size):
+    # a pixel is covered if its center is inside the shape, the same as non-antialiased
+    # opengl and cairo
+    start = min(max(math.ceil(_snap(low) - 0.5), 0), size)
+    end = min(max(math.ceil(_snap(high) - 0.5), 0), size)
+    return start, end
+
+
+def pixel_spans(low, high, size):
+    """
+    Vectorized version of `pixel_span` for arrays of shape edges
+    """
+    low = np.floor(low * 256 + 0.5) / 256
+    high = np.floor(high * 256 + 0.5) / 256
+    start = np.clip(np.ceil(low - 0.5), 0, size).astype(np.intp)
+    end = np.clip(np.ceil(high - 0.5), 0, size).astype(np.intp)
+    return start, end
+
+
+class Surface:
+    """
+    Software renderer that writes directly into a numpy array, this only supports axis-aligned
+    rectangles since that's all the environment draws
+    """
+
+    # methods that `Instrumentation` times
+    PHASE_METHODS = {"draw": "draw_polygon", "readback": "get_image"}
+
+    def __init__(
+        self,
+        pixel_width,
+        pixel_height,
+        view_width,
+        view_height,
+        origin_at_center=True,
+        view_x=0,
+        view_y=0,
+        channels=3,
+    ):
+        self.data = np.zeros((pixel_height, pixel_width, channels), dtype=np.uint8)
+        self._channels = channels
+        # a point (x, y) is drawn at pixel ((x - origin_x) * scale_x, (y - origin_y) * scale_y)
+        self._scale_x = pixel_width / view_width
+        if origin_at_center:
+            assert view_x == 0 and view_y == 0
+            self._scale_y = -pixel_height / view_height
+            self._origin_x = -view_width / 2
+            self._origin_y = view_height / 2
+        else:
+            self._scale_y = pixel_height / view_height
+            self._origin_x = view_x
+            self._origin_y = view_y
+        # filled frames for each color we have been reset to, copying one of these is much
+        # faster than broadcasting a single pixel over the whole frame
+        self._fills = {}
+        self._pixels = {}
+
+    def _get_pixel(self, color):
+        key = (color.r, color.g, color.b)
+        pixel = self._pixels.get(key)
+        if pixel is None:
+            pixel = color_to_pixel(color)[: self._channels]
+            self._pixels[key] = pixel
+        return pixel
+
+    def reset(self, color=Color(1, 1, 1)):
+        key = (color.r, color.g, color.b)
+        fill = self._fills.get(key)
+        if fill is None:
+            fill = np.empty_like(self.data)
+            fill[:] = self._get_pixel(color)
+            self._fills[key] = fill
+        np.copyto(self.data, fill)
+
+    def get_image(self, out=None):
+        if out is None:
+            return self.data.copy()
+        np.copyto(out, self.data)
+        return out
+
+    def draw_polygon(self, vertices, color):
+        if len(vertices) != 4:
+            raise Exception("numpy surface can only draw axis-aligned rectangles")
+        for i in range(4):
+            a = vertices[i]
+            b = vertices[i - 1]
+            if a.x != b.x and a.y != b.y:
+                raise Exception("numpy surface can only draw axis-aligned rectangles")
+
+        v0 = vertices[0]
+        v2 = vertices[2]
+        x0 = (v0.x - self._origin_x) * self._scale_x
+        x1 = (v2.x - self._origin_x) * self._scale_x
+        y0 = (v0.y - self._origin_y) * self._scale_y
+        y1 = (v2.y - self._origin_y) * self._scale_y
+        height, width, _ = self.data.shape
+        x_start, x_end = pixel_span(min(x0, x1), max(x0, x1), width)
+        y_start, y_end = pixel_span(min(y0, y1), max(y0, y1), height)
+        self.data[y_start:y_end, x_start:x_end] = self._get_pixel(color)
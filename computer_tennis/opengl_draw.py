@@ -1,9 +1,52 @@
+import ctypes
+import ctypes.util
+import os
 import platform
+import threading
 
 import moderngl
 import numpy as np
 from computer_tennis.types import Color
 
+# x, y, r, g, b, a
+VERTEX_SIZE = 6
+INITIAL_VERTEX_CAPACITY = 256
+# set this environment variable to a number of devices to pretend that there are that many egl
+# devices, they all render on device 0 but each gets its own context, which makes it possible
+# to test spreading games over devices on a machine with a single gpu or software rendering
+FAKE_EGL_DEVICES_VAR = "COMPUTER_TENNIS_FAKE_EGL_DEVICES"
+
+
+def _fake_egl_devices():
+    value = os.environ.get(FAKE_EGL_DEVICES_VAR)
+    if not value:
+        return None
+    return int(value)
+
+
+def egl_device_count():
+    """
+    Number of egl devices on this machine, or the number from `FAKE_EGL_DEVICES_VAR` if it is set
+    """
+    fake = _fake_egl_devices()
+    if fake is not None:
+        return fake
+    if platform.system() != "Linux":
+        raise Exception("egl devices are only supported on linux")
+    egl = ctypes.CDLL(ctypes.util.find_library("EGL") or "libEGL.so.1")
+    egl.eglGetProcAddress.restype = ctypes.c_void_p
+    egl.eglGetProcAddress.argtypes = [ctypes.c_char_p]
+    address = egl.eglGetProcAddress(b"eglQueryDevicesEXT")
+    if address is None:
+        raise Exception("egl does not support listing devices")
+    query_devices = ctypes.CFUNCTYPE(
+        ctypes.c_uint, ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)
+    )(address)
+    count = ctypes.c_int()
+    if not query_devices(0, None, ctypes.byref(count)):
+        raise Exception("failed to list egl devices")
+    return count.value
+
 
 def get_scale_matrix(scale_x, scale_y):
     return np.array(
@@ -19,94 +62,277 @@ def get_translate_matrix(translate_x, translate_y):
     )
 
 
-class Surface:
-    def __init__(
-        self,
-        pixel_width,
-        pixel_height,
-        view_width,
-        view_height,
-        origin_at_center=True,
-        egl_device_index=None,
-    ):
+_VERTEX_SHADER = """
+#version 330
+uniform mat4 proj;
+in vec2 in_vert;
+in vec4 in_color;
+out vec4 color;
+void main() {
+    gl_Position = vec4(in_vert, 0.0, 1.0) * proj;
+    color = in_color;
+}
+"""
+
+_FRAGMENT_SHADER = """
+#version 330
+in vec4 color;
+out vec4 fragColor;
+void main() {
+    fragColor = color;
+}
+"""
+
+
+class _Framebuffer:
+    def __init__(self, fbo):
+        self.fbo = fbo
+        # the surface whose image is currently in the framebuffer
+        self.owner = None
+
+
+class SharedContext:
+    """
+    The GL objects that are shared by every `Surface` in this process that uses the same egl
+    device: the context, the shader program, the vertex buffer and one framebuffer for each
+    image size.
+
+    A surface only needs the framebuffer while `get_image()` runs, so surfaces take turns using
+    it and `lock` is held while they do.
+    """
+
+    def __init__(self, egl_device_index=None):
         context_kwargs = {"standalone": True}
         # we have to set the argument in this weird way because there doesn't appear to be
         # a way to tell create_context to use the default backend
         if platform.system() == "Linux":
             context_kwargs["backend"] = "egl"
             if egl_device_index is not None:
+                fake = _fake_egl_devices()
+                if fake is not None:
+                    assert 0 <= egl_device_index < fake
+                    egl_device_index = 0
                 context_kwargs["device_index"] = egl_device_index
         self.ctx = moderngl.create_context(**context_kwargs)
+        self.lock = threading.Lock()
+        self._framebuffers = {}
 
         with self.ctx:
-            self.fbo = self.ctx.simple_framebuffer((pixel_width, pixel_height), 4)
-            self.fbo.use()
             self.prog = self.ctx.program(
-                vertex_shader="""
-                #version 330
-                uniform mat4 proj;
-                in vec2 in_vert;
-                in vec4 in_color;
-                out vec4 color;
-                void main() {
-                    gl_Position = vec4(in_vert, 0.0, 1.0) * proj;
-                    color = in_color;
-                }
-                """,
-                fragment_shader="""
-                #version 330
-                in vec4 color;
-                out vec4 fragColor;
-                void main() {
-                    fragColor = color;
-                }
-            """,
+                vertex_shader=_VERTEX_SHADER, fragment_shader=_FRAGMENT_SHADER
             )
-            # convert from normalized device coordinates
-            proj = np.eye(4, dtype=np.float32)
-            if origin_at_center:
-                proj = proj.dot(
-                    get_scale_matrix(scale_x=2 / view_width, scale_y=-2 / view_height)
-                )
-                proj = proj.dot(get_translate_matrix(translate_x=0, translate_y=0))
-            else:
-                proj = proj.dot(
-                    get_scale_matrix(scale_x=2 / view_width, scale_y=2 / view_height)
-                )
-                proj = proj.dot(
-                    get_translate_matrix(
-                        translate_x=-view_width / 2, translate_y=-view_height / 2
-                    )
-                )
-            self.prog["proj"].write(proj)
             self.ctx.enable(moderngl.BLEND)
             self.ctx.blend_func = self.ctx.SRC_ALPHA, self.ctx.ONE_MINUS_SRC_ALPHA
+            # draws are sent to the gpu with a single render call, reusing the same buffer and
+            # vertex array for every frame
+            self.vbo = self.ctx.buffer(
+                reserve=INITIAL_VERTEX_CAPACITY * VERTEX_SIZE * 4, dynamic=True
+            )
+            self.vao = self.ctx.vertex_array(
+                self.prog, [(self.vbo, "2f 4f", "in_vert", "in_color")]
+            )
+
+    def framebuffer(self, size):
+        with self.lock:
+            framebuffer = self._framebuffers.get(size)
+            if framebuffer is None:
+                with self.ctx:
+                    framebuffer = _Framebuffer(self.ctx.simple_framebuffer(size, 4))
+                self._framebuffers[size] = framebuffer
+            return framebuffer
+
+
+_shared_contexts = {}
+_shared_contexts_lock = threading.Lock()
+
+
+def get_shared_context(egl_device_index=None):
+    """
+    The `SharedContext` for `egl_device_index`, created the first time it is used
+    """
+    with _shared_contexts_lock:
+        shared = _shared_contexts.get(egl_device_index)
+        if shared is None:
+            shared = SharedContext(egl_device_index)
+            _shared_contexts[egl_device_index] = shared
+        return shared
+
+
+class Surface:
+    """
+    All surfaces in a process that use the same egl device share one `SharedContext`, so a
+    surface doesn't create any GL objects of its own unless `async_readback` is set.  The
+    context is only created by the first call to `get_image()`, so making a surface is cheap
+    and doesn't touch the gpu.  Drawing
+    and clearing are queued and only sent to the gpu by `get_image()`, this means that after
+    `get_image()` the surface must be `reset()` before drawing on it again if another surface of
+    the same size has been drawn in the meantime.
+
+    If `async_readback` is set, frames are read back from the gpu into a ring of
+    `readback_delay + 1` pixel buffer objects, and `get_image()` returns the frame from
+    `readback_delay` calls ago, which lets the cpu keep going while the gpu finishes the most
+    recent frame.
+    """
+
+    # methods that `Instrumentation` times, draws are only sent to the gpu in `_flush()`
+    PHASE_METHODS = {"draw": "_flush", "readback": "_read"}
+
+    def __init__(
+        self,
+        pixel_width,
+        pixel_height,
+        view_width,
+        view_height,
+        origin_at_center=True,
+        egl_device_index=None,
+        async_readback=False,
+        readback_delay=0,
+        view_x=0,
+        view_y=0,
+        channels=3,
+    ):
+        assert readback_delay == 0 or async_readback
+        assert channels in (1, 3)
+        self._channels = channels
+        self._egl_device_index = egl_device_index
+        if egl_device_index is not None:
+            # time rendering on each device separately so that imbalance between them shows up
+            self.PHASE_METHODS = dict(
+                Surface.PHASE_METHODS,
+                **{f"render/egl_device_{egl_device_index}": "get_image"},
+            )
+        self._size = (pixel_width, pixel_height)
+        # set by `_connect()`
+        self._shared = None
+        self.ctx = None
+        self._framebuffer = None
+        self.fbo = None
+
+        # convert from normalized device coordinates
+        proj = np.eye(4, dtype=np.float32)
+        if origin_at_center:
+            assert view_x == 0 and view_y == 0
+            proj = proj.dot(
+                get_scale_matrix(scale_x=2 / view_width, scale_y=-2 / view_height)
+            )
+            proj = proj.dot(get_translate_matrix(translate_x=0, translate_y=0))
+        else:
+            proj = proj.dot(
+                get_scale_matrix(scale_x=2 / view_width, scale_y=2 / view_height)
+            )
+            proj = proj.dot(
+                get_translate_matrix(
+                    translate_x=-view_width / 2 - view_x,
+                    translate_y=-view_height / 2 - view_y,
+                )
+            )
+        self._proj = proj.astype(np.float32).tobytes()
+
+        # draws are queued here until `get_image()`
+        self._vertices = np.zeros(
+            (INITIAL_VERTEX_CAPACITY, VERTEX_SIZE), dtype=np.float32
+        )
+        self._num_vertices = 0
+        # a new framebuffer is all zeros
+        self._clear_color = Color(0, 0, 0)
+
+        self._pbos = None
+        self._async_readback = async_readback
+        self._readback_delay = readback_delay
+        self._num_frames = 0
+
+    def _connect(self):
+        self._shared = get_shared_context(self._egl_device_index)
+        self.ctx = self._shared.ctx
+        self._framebuffer = self._shared.framebuffer(self._size)
+        self.fbo = self._framebuffer.fbo
+        if self._async_readback:
+            width, height = self._size
+            with self._shared.lock, self.ctx:
+                self._pbos = [
+                    self.ctx.buffer(reserve=width * height * self._channels)
+                    for _ in range(self._readback_delay + 1)
+                ]
 
     def reset(self, color=Color(1, 1, 1)):
-        with self.ctx:
-            self.ctx.clear(red=color.r, green=color.g, blue=color.b, alpha=1.0)
+        # anything queued would be drawn over by the clear
+        self._num_vertices = 0
+        self._clear_color = color
 
-    def get_image(self):
-        with self.ctx:
-            data = self.fbo.read(components=3)
-            return (
-                np.frombuffer(data, dtype=np.uint8)
-                .reshape((self.fbo.size[1], self.fbo.size[0], 3))
-                .copy()
+    def _flush(self):
+        framebuffer = self._framebuffer
+        framebuffer.fbo.use()
+        if self._clear_color is not None:
+            color = self._clear_color
+            framebuffer.fbo.clear(red=color.r, green=color.g, blue=color.b, alpha=1.0)
+            framebuffer.owner = self
+            self._clear_color = None
+        elif framebuffer.owner is not self:
+            raise Exception(
+                "another surface has used the shared framebuffer, "
+                "reset() this surface before drawing on it"
             )
+        if self._num_vertices == 0:
+            return
+        shared = self._shared
+        shared.prog["proj"].write(self._proj)
+        data = self._vertices[: self._num_vertices]
+        # orphan the buffer so that we don't wait for the gpu to finish with the previous frame
+        if data.nbytes > shared.vbo.size:
+            shared.vbo.orphan(self._vertices.nbytes)
+        else:
+            shared.vbo.orphan()
+        shared.vbo.write(data)
+        shared.vao.render(moderngl.TRIANGLES, vertices=self._num_vertices)
+        self._num_vertices = 0
 
-    def _draw_vertices(self, vertices, color, kind, alpha=1.0):
-        with self.ctx:
-            data = []
-            for v in vertices:
-                data.extend([v.x, v.y, color.r, color.g, color.b, alpha])
-            vbo = self.ctx.buffer(np.array(data, dtype=np.float32))
-            vao = self.ctx.simple_vertex_array(self.prog, vbo, "in_vert", "in_color")
-            vao.render(kind)
+    def get_image(self, out=None):
+        """
+        Read the image into `out` if provided, which must be a contiguous uint8 array
+        """
+        if self._shared is None:
+            self._connect()
+        if out is None:
+            out = np.empty((self._size[1], self._size[0], self._channels), dtype=np.uint8)
+        with self._shared.lock, self.ctx:
+            self._flush()
+            self._read(out)
+        return out
+
+    def _read(self, out):
+        if self._pbos is None:
+            self.fbo.read_into(out, components=self._channels, alignment=1)
+        else:
+            frame = self._num_frames
+            self.fbo.read_into(
+                self._pbos[frame % len(self._pbos)],
+                components=self._channels,
+                alignment=1,
+            )
+            # until we have enough frames, return the oldest one we have
+            delay = min(self._readback_delay, frame)
+            self._pbos[(frame - delay) % len(self._pbos)].read_into(out)
+            self._num_frames += 1
+
+    def _draw_triangles(self, vertices, color, alpha=1.0):
+        start = self._num_vertices
+        end = start + len(vertices)
+        if end > len(self._vertices):
+            capacity = len(self._vertices)
+            while capacity < end:
+                capacity *= 2
+            grown = np.zeros((capacity, VERTEX_SIZE), dtype=np.float32)
+            grown[:start] = self._vertices[:start]
+            self._vertices = grown
+        out = self._vertices[start:end]
+        out[:, 0] = [v.x for v in vertices]
+        out[:, 1] = [v.y for v in vertices]
+        out[:, 2:] = (color.r, color.g, color.b, alpha)
+        self._num_vertices = end
 
     def draw_polygon(self, vertices, color):
         # vertex inputs are a series of points, convert to a series of triangles
         triangle_fan = []
         for i in range(1, len(vertices) - 1):
             triangle_fan.extend([vertices[0], vertices[i], vertices[i + 1]])
-        self._draw_vertices(vertices=triangle_fan, color=color, kind=moderngl.TRIANGLES)
+        self._draw_triangles(vertices=triangle_fan, color=color)
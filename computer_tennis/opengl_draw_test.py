@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from computer_tennis.opengl_draw import Surface
+from computer_tennis.types import Color, Vec2
+
+SQUARE = [Vec2(10, 10), Vec2(30, 10), Vec2(30, 30), Vec2(10, 30)]
+
+
+def make_surface(**kwargs):
+    return Surface(
+        pixel_width=40,
+        pixel_height=40,
+        view_width=40,
+        view_height=40,
+        origin_at_center=False,
+        **kwargs
+    )
+
+
+def test_shared_context():
+    """
+    Surfaces should share GL objects and take turns using the framebuffer
+    """
+    surfaces = [make_surface() for _ in range(1000)]
+    # the context is created by the first get_image()
+    assert all(s.ctx is None for s in surfaces)
+    for s in surfaces[:10]:
+        s.reset()
+        s.get_image()
+    assert len({id(s.ctx) for s in surfaces[:10]}) == 1
+    assert len({id(s.fbo) for s in surfaces[:10]}) == 1
+
+    a = make_surface()
+    a.reset(Color(0, 0, 0))
+    a.draw_polygon(SQUARE, Color(1, 0, 0))
+    # a different view, so the projection changes between surfaces
+    b = make_surface(view_x=10, view_y=10)
+    b.reset(Color(0, 0, 1))
+    b.draw_polygon(SQUARE, Color(0, 1, 0))
+    image_a = a.get_image()
+    image_b = b.get_image()
+    assert image_a[20, 20].tolist() == [255, 0, 0]
+    assert image_a[35, 35].tolist() == [0, 0, 0]
+    assert image_b[10, 10].tolist() == [0, 255, 0]
+    assert image_b[35, 35].tolist() == [0, 0, 255]
+    # without a reset, b can keep drawing until another surface uses the framebuffer
+    corner = [Vec2(40, 40), Vec2(50, 40), Vec2(50, 50), Vec2(40, 50)]
+    b.draw_polygon(corner, Color(1, 0, 0))
+    image = b.get_image()
+    assert image[35, 35].tolist() == [255, 0, 0]
+    assert np.array_equal(image[:20, :20], image_b[:20, :20])
+    a.reset()
+    a.get_image()
+    b.draw_polygon(SQUARE, Color(1, 0, 0))
+    with pytest.raises(Exception):
+        b.get_image()
+
+
+@pytest.mark.parametrize("async_readback", [False, True])
+def test_no_gl_objects_per_frame(async_readback):
+    """
+    Drawing frames should reuse the same GL objects instead of creating new ones
+    """
+    from computer_tennis.scripts.benchmark import count_gl_creations
+
+    surface = make_surface(async_readback=async_readback)
+
+    def draw_frame(i):
+        surface.reset(Color(0, 0, 0))
+        for j in range(i % 5 + 1):
+            offset = Vec2(i % 10, j)
+            square = [v + offset for v in SQUARE]
+            surface.draw_polygon(square, Color(1, 0, 0))
+        surface.get_image()
+
+    draw_frame(0)
+    with count_gl_creations() as created:
+        for i in range(200):
+            draw_frame(i)
+    assert created == []
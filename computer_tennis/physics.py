@@ -0,0 +1,207 @@
+"""
+Step kernel that advances a batch of games stored in arrays, compiled with Numba if it is
+installed
+"""
+
+import importlib.util
+import os
+import types
+
+import numpy as np
+
+from computer_tennis.env import (
+    BALL_RECT,
+    BOTTOM_BAR_RECT,
+    PADDLE_RECT,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    TOP_BAR_RECT,
+)
+
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+# set to 1 to use the array operations instead of the compiled kernel, this avoids the time
+# it takes to import numba and load the kernel, which matters for short-lived processes
+DISABLE_NUMBA_VAR = "COMPUTER_TENNIS_DISABLE_NUMBA"
+
+# plain floats so that the compiled kernel can use them as constants
+_BALL_X = float(BALL_RECT.x)
+_BALL_Y = float(BALL_RECT.y)
+_BALL_W = float(BALL_RECT.w)
+_BALL_H = float(BALL_RECT.h)
+_PADDLE_X = float(PADDLE_RECT.x)
+_PADDLE_Y = float(PADDLE_RECT.y)
+_PADDLE_W = float(PADDLE_RECT.w)
+_PADDLE_H = float(PADDLE_RECT.h)
+_BARS = np.array(
+    [
+        [BOTTOM_BAR_RECT.x, BOTTOM_BAR_RECT.y, BOTTOM_BAR_RECT.w, BOTTOM_BAR_RECT.h],
+        [TOP_BAR_RECT.x, TOP_BAR_RECT.y, TOP_BAR_RECT.w, TOP_BAR_RECT.h],
+    ],
+    dtype=np.float64,
+)
+_SCREEN_WIDTH = float(SCREEN_WIDTH)
+_SCREEN_HEIGHT = float(SCREEN_HEIGHT)
+
+
+def _clamp(v, low, high):
+    if v < low:
+        return low
+    elif v > high:
+        return high
+    else:
+        return v
+
+
+def _ball_overlaps(ball_x, ball_y, x, y, w, h):
+    ball_x = ball_x + _BALL_X
+    ball_y = ball_y + _BALL_Y
+    return (
+        ball_x <= x + w
+        and x <= ball_x + _BALL_W
+        and ball_y <= y + h
+        and y <= ball_y + _BALL_H
+    )
+
+
+def _paddle_velocity(paddle_y, ball_y, reverse):
+    # depending on where we collide with the paddle, send the ball back out
+    diff_y = paddle_y + _PADDLE_H / 2 - (ball_y + _BALL_H / 2)
+    dist_y = abs(diff_y)
+    if dist_y <= 2:
+        v_y = 0.0
+    elif dist_y <= 4:
+        v_y = 1.0
+    else:
+        v_y = 2.0
+    if diff_y > 0:
+        # send upward
+        v_y = -v_y
+    v_x = -1.0 if reverse else 1.0
+    return v_x, v_y
+
+
+def step_games(
+    ball_pos,
+    ball_vel,
+    p1_pos,
+    p1_vel,
+    p2_pos,
+    p2_vel,
+    p1_direction,
+    p2_direction,
+    computer_p2,
+    p1_accel,
+    p2_accel,
+    active,
+    scored,
+):
+    """
+    Run a single step of physics for every game where `active` is set, this does the same thing
+    as `SingleTennisEnv._step` except for the serves
+
+    The positions and velocities are (num_games, 2) float64 arrays that are updated in place,
+    the directions are from `_button_direction()` and `scored` is set to 1 if player 1 scored,
+    2 if player 2 scored and 0 otherwise.
+    """
+    for game in range(ball_pos.shape[0]):
+        scored[game] = 0
+        if not active[game]:
+            continue
+
+        if p1_direction[game] < 0:
+            p1_vel[game, 1] -= p1_accel
+        elif p1_direction[game] > 0:
+            p1_vel[game, 1] += p1_accel
+
+        if computer_p2:
+            paddle_mid_y = p2_pos[game, 1] + _PADDLE_H / 2
+            ball_mid_y = ball_pos[game, 1] + _BALL_H / 2
+            diff_mid_y = paddle_mid_y - ball_mid_y
+            if abs(diff_mid_y) < 2:
+                # dead zone
+                pass
+            elif paddle_mid_y > ball_mid_y:
+                p2_vel[game, 1] -= p2_accel
+            else:
+                p2_vel[game, 1] += p2_accel
+        elif p2_direction[game] < 0:
+            p2_vel[game, 1] -= p2_accel
+        elif p2_direction[game] > 0:
+            p2_vel[game, 1] += p2_accel
+
+        p1_vel[game, 1] = _clamp(p1_vel[game, 1] * 0.8, -2.0, 2.0)
+        p2_vel[game, 1] = _clamp(p2_vel[game, 1] * 0.8, -2.0, 2.0)
+
+        for i in range(2):
+            ball_pos[game, i] += ball_vel[game, i]
+            p1_pos[game, i] += p1_vel[game, i]
+            p2_pos[game, i] += p2_vel[game, i]
+
+        p1_pos[game, 1] = _clamp(p1_pos[game, 1], 24.0, _SCREEN_HEIGHT)
+        p2_pos[game, 1] = _clamp(p2_pos[game, 1], 24.0, _SCREEN_HEIGHT)
+
+        ball_x = ball_pos[game, 0]
+        ball_y = ball_pos[game, 1]
+        for reverse, pos in ((True, p1_pos), (False, p2_pos)):
+            if _ball_overlaps(
+                ball_x,
+                ball_y,
+                pos[game, 0] + _PADDLE_X,
+                pos[game, 1] + _PADDLE_Y,
+                _PADDLE_W,
+                _PADDLE_H,
+            ):
+                v_x, v_y = _paddle_velocity(pos[game, 1], ball_y, reverse)
+                ball_vel[game, 0] = v_x
+                ball_vel[game, 1] = v_y
+        for bar in range(_BARS.shape[0]):
+            if _ball_overlaps(
+                ball_x,
+                ball_y,
+                _BARS[bar, 0],
+                _BARS[bar, 1],
+                _BARS[bar, 2],
+                _BARS[bar, 3],
+            ):
+                # bars are at the top and bottom, so just invert y velocity
+                ball_vel[game, 1] = -ball_vel[game, 1]
+
+        if ball_x < 0 or ball_x > 160:
+            ball_vel[game, 0] = -ball_vel[game, 0]
+
+        if ball_x < 0:
+            scored[game] = 1
+        elif ball_x > _SCREEN_WIDTH:
+            scored[game] = 2
+
+
+def use_numba():
+    """
+    True if the compiled kernel should be used
+    """
+    return HAVE_NUMBA and os.environ.get(DISABLE_NUMBA_VAR, "0") == "0"
+
+
+_compiled_step_games = None
+
+
+def compiled_step_games():
+    """
+    `step_games()` compiled with Numba
+
+    Numba is imported and the kernel is compiled, or loaded from Numba's cache, the first time
+    this is called.  Numba caches the kernel next to this file, set `NUMBA_CACHE_DIR` to put it
+    somewhere else.
+    """
+    global _compiled_step_games
+    if _compiled_step_games is None:
+        import numba
+
+        # compile copies of the functions that call each other's compiled versions, so that the
+        # functions in this module stay plain python
+        namespace = dict(globals())
+        for fn in [_clamp, _ball_overlaps, _paddle_velocity, step_games]:
+            copy = types.FunctionType(fn.__code__, namespace, fn.__name__)
+            namespace[fn.__name__] = numba.njit(cache=True)(copy)
+        _compiled_step_games = namespace["step_games"]
+    return _compiled_step_games
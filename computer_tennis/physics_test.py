@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from computer_tennis import physics
+from computer_tennis.env import BUTTONS, TennisEnv
+
+IMPLEMENTATIONS = ["numpy", "python"]
+if physics.HAVE_NUMBA:
+    IMPLEMENTATIONS.append("numba")
+
+
+@pytest.mark.parametrize("implementation", IMPLEMENTATIONS)
+@pytest.mark.parametrize(
+    "num_players, env_kwargs",
+    [(1, {}), (2, {}), (1, dict(frame_skip=4, max_pool_last=2))],
+)
+def test_matches_reference(implementation, num_players, env_kwargs):
+    """
+    Each physics implementation should give exactly the same states as SingleTennisEnv.act()
+    """
+    num_games = 4
+    env_kwargs = dict(
+        num=num_games * num_players,
+        num_players=num_players,
+        ob_mode="state",
+        seed=0,
+        **env_kwargs,
+    )
+    reference_env = TennisEnv(**env_kwargs)
+    env = TennisEnv(batched=True, **env_kwargs)
+    env._use_numba = implementation == "numba"
+    if implementation == "python":
+        env._kernel = physics.step_games
+
+    rng = np.random.RandomState(0)
+    for _ in range(2000):
+        ac = rng.randint(0, 2, size=(env.num, len(BUTTONS)), dtype=np.uint8)
+        reference_env.act(ac)
+        env.act(ac)
+        assert np.array_equal(reference_env.get_state(), env.get_state())
+    assert env._first.sum() + env._p1_score.sum() + env._p2_score.sum() > 0
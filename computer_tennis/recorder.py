@@ -0,0 +1,252 @@
+"""
+Record games as the per-step game state and actions instead of frames, the frames can be
+rendered again from the state with `Replay`
+"""
+
+import functools
+import json
+import os
+
+import gym3
+import numpy as np
+
+from computer_tennis.env import SingleTennisEnv, TennisEnv
+
+FORMAT_VERSION = 1
+META_FILENAME = "meta.json"
+FIELDS = ["state", "ac", "rew", "first"]
+# the options needed to render the same observations again
+REPLAY_OPTIONS = [
+    "num_players",
+    "frame_skip",
+    "max_pool_last",
+    "ob_size",
+    "grayscale",
+    "ob_format",
+    "crop",
+    "aspect_correct",
+    "frame_stack",
+]
+
+
+def _chunk_path(directory, index, compress):
+    name = f"chunk_{index:06d}"
+    if compress:
+        name += ".npz"
+    return os.path.join(directory, name)
+
+
+class RecordingEnv(gym3.Wrapper):
+    """
+    Creates `TennisEnv(**env_kwargs)` and records every step to `directory`
+
+    For each step this saves the state of every game from `get_state()` before the action, the
+    action, and the reward and first flags for each agent, which come from that state.  That is
+    about 160 bytes per game per step instead of 100KB for an rgb frame.
+
+    Steps are written in chunks of `chunk_size` steps.  With `compress` each chunk is a
+    compressed .npz file, otherwise it is a directory of .npy files that `Recording` memory
+    maps.  Call `close()` to write the last chunk.
+    """
+
+    def __init__(self, directory, chunk_size=1000, compress=True, **env_kwargs):
+        super().__init__(TennisEnv(**env_kwargs))
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._chunk_size = chunk_size
+        self._compress = compress
+        self._num_players = env_kwargs.get("num_players", 1)
+        self._num_chunks = 0
+        self._num_steps = 0
+        self._steps = []
+        replay_kwargs = dict(num_players=self._num_players)
+        for key in REPLAY_OPTIONS:
+            if env_kwargs.get(key) is not None:
+                value = env_kwargs[key]
+                replay_kwargs[key] = list(value) if isinstance(value, tuple) else value
+        self._meta = dict(
+            version=FORMAT_VERSION,
+            num=self.num,
+            num_games=self.num // self._num_players,
+            chunk_size=chunk_size,
+            compress=compress,
+            env_kwargs=replay_kwargs,
+        )
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(os.path.join(self._directory, META_FILENAME), "w") as f:
+            json.dump(dict(num_steps=self._num_steps, **self._meta), f, indent=2)
+
+    def act(self, ac):
+        self._steps.append((self.env.get_state(), np.array(ac, dtype=np.uint8)))
+        self.env.act(ac)
+        if len(self._steps) == self._chunk_size:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if len(self._steps) == 0:
+            return
+        state = np.stack([state for state, _ in self._steps])
+        # each agent in a game gets the same first flag and the opposite reward
+        rew = state[:, :, 14:15] * np.array([1.0, -1.0][: self._num_players])
+        first = np.repeat(state[:, :, 15] != 0, self._num_players, axis=1)
+        arrays = dict(
+            state=state,
+            ac=np.stack([ac for _, ac in self._steps]),
+            rew=rew.reshape(len(self._steps), -1).astype(np.float32),
+            first=first,
+        )
+        path = _chunk_path(self._directory, self._num_chunks, self._compress)
+        if self._compress:
+            np.savez_compressed(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(os.path.join(path, name + ".npy"), arr)
+        self._num_chunks += 1
+        self._num_steps += len(self._steps)
+        self._steps = []
+        self._write_meta()
+
+    def close(self):
+        self._write_chunk()
+        if hasattr(self.env, "close"):
+            self.env.close()
+
+
+class Recording:
+    """
+    Reads a recording made by `RecordingEnv`, chunks are only loaded when a step in them is
+    read and the last `cache_chunks` compressed chunks are kept in memory, uncompressed chunks
+    are memory mapped and stay open
+
+    `read(name, steps)` returns the field `name` for an array of step indices:
+        "state": (len(steps), num_games, GAME_STATE_SIZE) float64 state before the action
+        "ac": (len(steps), num, len(BUTTONS)) uint8 action
+        "rew": (len(steps), num) float32 reward
+        "first": (len(steps), num) bool
+    """
+
+    def __init__(self, directory, cache_chunks=4):
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise Exception("unsupported recording version")
+        self.directory = directory
+        self.num_steps = meta["num_steps"]
+        self.num = meta["num"]
+        self.num_games = meta["num_games"]
+        self.chunk_size = meta["chunk_size"]
+        self.compress = meta["compress"]
+        self.env_kwargs = meta["env_kwargs"]
+        self._load_chunk = functools.lru_cache(
+            maxsize=cache_chunks if self.compress else None
+        )(self._read_chunk)
+
+    def _read_chunk(self, index):
+        path = _chunk_path(self.directory, index, self.compress)
+        if self.compress:
+            with np.load(path) as data:
+                return {name: data[name] for name in FIELDS}
+        return {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in FIELDS
+        }
+
+    def read(self, name, steps):
+        steps = np.asarray(steps)
+        assert ((0 <= steps) & (steps < self.num_steps)).all()
+        chunks = steps // self.chunk_size
+        result = None
+        for chunk in np.unique(chunks):
+            data = self._load_chunk(int(chunk))[name]
+            if result is None:
+                result = np.empty(steps.shape + data.shape[1:], dtype=data.dtype)
+            mask = chunks == chunk
+            result[mask] = data[steps[mask] - chunk * self.chunk_size]
+        return result
+
+    def nbytes(self):
+        """
+        Size of the recording on disk
+        """
+        total = 0
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                total += os.path.getsize(os.path.join(root, filename))
+        return total
+
+
+def stacked_steps(recording, steps, games, k):
+    """
+    The steps of the frames in the `frame_stack` of `k` frames for `games` at `steps`, a
+    (len(steps), k) array, oldest first, that is -1 for frames that are zero because they are
+    from before the start of the episode or the recording
+    """
+    num_players = recording.env_kwargs["num_players"]
+    result = np.full((len(steps), k), -1, dtype=np.int64)
+    alive = np.ones(len(steps), dtype=bool)
+    for offset in range(k):
+        frame_steps = steps - offset
+        alive &= frame_steps >= 0
+        result[alive, k - 1 - offset] = frame_steps[alive]
+        if alive.any():
+            first = recording.read("first", frame_steps[alive])[
+                np.arange(alive.sum()), games[alive] * num_players
+            ]
+            # an episode starts at this frame, so the older frames are zero
+            alive[alive] = ~first
+    return result
+
+
+class Replay:
+    """
+    Renders the observations of a `Recording` again by restoring the recorded state into a
+    `SingleTennisEnv`
+    """
+
+    def __init__(self, recording, surface_type="numpy"):
+        self.recording = recording
+        env_kwargs = dict(recording.env_kwargs)
+        # the frames are stacked by `render()`
+        self._frame_stack = env_kwargs.pop("frame_stack", 1)
+        self._env = SingleTennisEnv(
+            surface_type=surface_type,
+            egl_device_index=None,
+            **env_kwargs,
+        )
+        self._num_players = recording.env_kwargs["num_players"]
+
+    def render(self, step, game):
+        """
+        The pixel observation for `game` from before the action at `step`, with `frame_stack`
+        the older frames are rendered from their own steps
+        """
+        if self._frame_stack == 1:
+            return self.render_frame(step, game)
+        frame_steps = stacked_steps(
+            self.recording, np.array([step]), np.array([game]), self._frame_stack
+        )[0]
+        result = np.zeros((self._frame_stack,) + self._env.ob_space.shape, dtype=np.uint8)
+        for i, frame_step in enumerate(frame_steps):
+            if frame_step >= 0:
+                result[i] = self.render_frame(frame_step, game)
+        return result
+
+    def render_frame(self, step, game):
+        """
+        The newest frame of the observation for `game` at `step`, the same as `render()`
+        without `frame_stack`
+        """
+        env = self._env
+        if env._max_pool_last > 1 and step > 0:
+            # the pooled frames are from the steps taken by the previous action
+            env.set_state(self.recording.read("state", [step - 1])[0, game : game + 1])
+            ac = self.recording.read("ac", [step - 1])[0]
+            start = game * self._num_players
+            env.act(ac[start : start + self._num_players])
+        else:
+            env.set_state(self.recording.read("state", [step])[0, game : game + 1])
+        _, ob, _ = env.observe()
+        return ob[0]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from computer_tennis.env import BUTTONS
+from computer_tennis.recorder import Recording, RecordingEnv, Replay
+
+
+@pytest.mark.parametrize(
+    "compress, env_kwargs",
+    [
+        (True, dict(num=2)),
+        (False, dict(num=4, num_players=2)),
+        (True, dict(num=2, frame_skip=4, max_pool_last=2, ob_size=(84, 84))),
+        (False, dict(num=2, frame_skip=8, frame_stack=4, grayscale=True)),
+    ],
+)
+def test_replay(tmp_path, compress, env_kwargs):
+    """
+    Replaying a recording should give back the observations, rewards and firsts
+    """
+    num_steps = 300
+    env = RecordingEnv(
+        str(tmp_path),
+        chunk_size=64,
+        compress=compress,
+        surface_type="numpy",
+        seed=0,
+        **env_kwargs
+    )
+    rng = np.random.RandomState(0)
+    observations = []
+    for _ in range(num_steps):
+        observations.append(env.observe())
+        env.act(rng.randint(0, 2, size=(env.num, len(BUTTONS)), dtype=np.uint8))
+    env.close()
+
+    recording = Recording(str(tmp_path))
+    assert recording.num_steps == num_steps
+    steps = np.arange(num_steps)
+    rew = recording.read("rew", steps)
+    first = recording.read("first", steps)
+    assert np.array_equal(rew, np.array([o[0] for o in observations]))
+    assert np.array_equal(first, np.array([o[2] for o in observations]))
+    assert rew.any()
+
+    replay = Replay(recording)
+    num_players = env_kwargs.get("num_players", 1)
+    # include the steps after an episode starts, where the older stacked frames are zero
+    (first_steps,) = np.nonzero(first[1:].any(axis=1))
+    if "frame_stack" in env_kwargs:
+        assert len(first_steps) > 0
+    first_steps = np.concatenate([first_steps + 1, first_steps + 2])
+    first_steps = np.minimum(first_steps, num_steps - 1)
+    for step in np.concatenate([rng.choice(num_steps, size=50), first_steps]):
+        for game in range(recording.num_games):
+            _, ob, _ = observations[step]
+            assert np.array_equal(replay.render(step, game), ob[game * num_players])
+
+    frame_bytes = sum(o[1].nbytes for o in observations)
+    assert recording.nbytes() * 100 < frame_bytes
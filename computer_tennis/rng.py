@@ -0,0 +1,37 @@
+_MASK = (1 << 64) - 1
+_GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+
+def _mix(z):
+    # splitmix64 output function
+    z = (z + _GOLDEN_GAMMA) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+class CounterRandom:
+    """
+    Random number generator where each number is a hash of the seed and a counter, so the whole
+    state of the generator is (seed, counter) and it can be saved or restored by copying two
+    integers
+    """
+
+    def __init__(self, seed, counter=0):
+        self.seed = int(seed)
+        self.counter = int(counter)
+        self._key = _mix(self.seed)
+
+    def random(self):
+        """
+        Random float in [0, 1)
+        """
+        self.counter += 1
+        z = _mix((self._key + self.counter * _GOLDEN_GAMMA) & _MASK)
+        return (z >> 11) * 2.0 ** -53
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+    def randrange(self, start, stop):
+        return start + int(self.random() * (stop - start))
@@ -0,0 +1,386 @@
+"""
+Benchmarks for the environment, the results are written to a JSON file so that runs on the same
+machine can be compared:
+
+    python -m computer_tennis.scripts.benchmark --output before.json
+    python -m computer_tennis.scripts.benchmark --output after.json --baseline before.json
+
+Every result is a measurement where lower is better, when a baseline is given any result that is
+more than `--threshold` worse than the baseline is reported and the script exits with an error.
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from computer_tennis.env import BUTTONS, TennisEnv
+from computer_tennis.physics import DISABLE_NUMBA_VAR
+
+DEFAULT_NUMS = [1, 16, 256, 4096]
+
+# times a new process takes to import the package, create an env, get the first observation and
+# take the first step, and whether it imported moderngl and numba
+COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from computer_tennis import TennisEnv
+imported = time.perf_counter()
+batched = sys.argv[2] == "batched"
+if sys.argv[1] == "state":
+    env = TennisEnv(num=1, ob_mode="state", batched=batched)
+else:
+    env = TennisEnv(num=1, surface_type=sys.argv[1], batched=batched)
+constructed = time.perf_counter()
+env.observe()
+observed = time.perf_counter()
+import numpy as np
+env.act(np.zeros((env.num,) + env.ac_space.shape, dtype=np.uint8))
+acted = time.perf_counter()
+print(json.dumps(dict(
+    import_seconds=imported - start,
+    construct_seconds=constructed - imported,
+    first_observe_seconds=observed - constructed,
+    first_act_seconds=acted - observed,
+    moderngl_imported="moderngl" in sys.modules,
+    numba_imported="numba" in sys.modules,
+)))
+"""
+
+
+def surface_types():
+    result = ["opengl", "numpy"]
+    try:
+        import cairo  # noqa: F401
+
+        result.append("cairo")
+    except ImportError:
+        pass
+    return result
+
+
+def machine_info():
+    import moderngl
+
+    info = dict(
+        node=platform.node(),
+        machine=platform.machine(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        moderngl=moderngl.__version__,
+    )
+    try:
+        import numba
+
+        info["numba"] = numba.__version__
+    except ImportError:
+        info["numba"] = None
+    return info
+
+
+def time_per_call(fn, min_time):
+    """
+    Median time in seconds of a call to `fn()`, calling it for at least `min_time` seconds
+    """
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < 3 or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - call_start)
+    return float(np.median(times))
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes and macos reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss_bytes():
+    # only available on linux
+    if not os.path.exists("/proc/self/statm"):
+        return None
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+# the `moderngl.Context` methods that create GL objects
+GL_FACTORY_METHODS = [
+    "buffer",
+    "depth_renderbuffer",
+    "depth_texture",
+    "framebuffer",
+    "program",
+    "renderbuffer",
+    "simple_framebuffer",
+    "simple_vertex_array",
+    "texture",
+    "texture_array",
+    "vertex_array",
+]
+
+
+@contextlib.contextmanager
+def count_gl_creations():
+    """
+    Yields a list that gets the name of the `moderngl.Context` method for every GL object
+    created until the end of the `with` block
+
+    Objects that are dropped without `release()` are never freed, so they are counted when they
+    are created instead of while they are alive.
+    """
+    import moderngl
+
+    created = []
+    originals = {name: getattr(moderngl.Context, name) for name in GL_FACTORY_METHODS}
+
+    def counted(name, original):
+        def method(*args, **kwargs):
+            created.append(name)
+            return original(*args, **kwargs)
+
+        return method
+
+    for name, original in originals.items():
+        setattr(moderngl.Context, name, counted(name, original))
+    try:
+        yield created
+    finally:
+        for name, original in originals.items():
+            setattr(moderngl.Context, name, original)
+
+
+def env_cases(nums, surface_types):
+    """
+    The environment options for the step benchmarks, as (name, env_kwargs) pairs
+    """
+    cases = []
+    for num in nums:
+        for num_players in [1, 2]:
+            if num % num_players != 0:
+                continue
+            for batched in [False, True]:
+                name = f"num={num}/players={num_players}/" + (
+                    "batched" if batched else "unbatched"
+                )
+                kwargs = dict(num=num, num_players=num_players, batched=batched)
+                cases.append((f"state/{name}", dict(ob_mode="state", **kwargs)))
+                for surface_type in surface_types:
+                    cases.append(
+                        (
+                            f"{surface_type}/{name}",
+                            dict(surface_type=surface_type, **kwargs),
+                        )
+                    )
+    return cases
+
+
+def benchmark_steps(name, env_kwargs, min_time):
+    """
+    Time the physics, rendering and the overhead of observe() for an environment
+    """
+    env = TennisEnv(**env_kwargs)
+    ac = np.zeros((env.num, len(BUTTONS)), dtype=np.uint8)
+    # hold down one button so the paddles move
+    ac[:, BUTTONS.index("UP")] = 1
+    results = {}
+    if env_kwargs.get("ob_mode") == "state":
+        results[f"physics/{name}"] = time_per_call(lambda: env.act(ac), min_time)
+    else:
+
+        def step():
+            env.act(ac)
+            env.observe()
+
+        results[f"step/{name}"] = time_per_call(step, min_time)
+
+        # set_state() throws away the rendered frame without changing the game
+        state = env.get_state()
+
+        def render():
+            env.set_state(state)
+            env.observe()
+
+        results[f"render/{name}"] = time_per_call(render, min_time)
+    # once the frame has been rendered, observe() only has to build the observation
+    env.observe()
+    results[f"observe/{name}"] = time_per_call(env.observe, min_time)
+    return results
+
+
+def cold_start(surface_type, batched=False, disable_numba=False):
+    """
+    Run `COLD_START_SCRIPT` in a new process for `surface_type`, or "state" for `ob_mode="state"`,
+    with `disable_numba` the process has `DISABLE_NUMBA_VAR` set
+    """
+    env = dict(os.environ)
+    if disable_numba:
+        env[DISABLE_NUMBA_VAR] = "1"
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            COLD_START_SCRIPT,
+            surface_type,
+            "batched" if batched else "unbatched",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        env=env,
+    ).stdout
+    return json.loads(output)
+
+
+def cold_start_results(name, cold):
+    """
+    The benchmark results for the `cold_start()` output `cold`
+    """
+    return {
+        f"import/{name}/cold": cold["import_seconds"],
+        f"construct/{name}/cold": cold["construct_seconds"],
+        f"first_observe/{name}/cold": cold["first_observe_seconds"],
+        f"first_act/{name}/cold": cold["first_act_seconds"],
+    }
+
+
+def benchmark_construction(surface_types, min_time):
+    """
+    Time creating environments and, in a new process, importing the package, getting the first
+    observation and taking the first step, for opengl this includes creating the EGL context
+    """
+    results = {}
+    # the first environment in a process also has to import modules, set up EGL, load the numba
+    # kernel and fill caches
+    cold_cases = [
+        ("state", dict()),
+        ("state/batched", dict(batched=True)),
+        ("state/batched/no_numba", dict(batched=True, disable_numba=True)),
+    ]
+    for name, kwargs in cold_cases:
+        results.update(cold_start_results(name, cold_start("state", **kwargs)))
+    for surface_type in surface_types:
+        results.update(cold_start_results(surface_type, cold_start(surface_type)))
+        for num, batched in [(1, False), (16, False), (16, True)]:
+            name = f"construct/{surface_type}/num={num}/" + (
+                "batched" if batched else "unbatched"
+            )
+            results[name] = time_per_call(
+                lambda: TennisEnv(num=num, surface_type=surface_type, batched=batched),
+                min_time,
+            )
+    return results
+
+
+def benchmark_long_run(num_steps):
+    """
+    Memory use and GL objects created from stepping an opengl environment for a long time
+    """
+    env = TennisEnv(num=16, surface_type="opengl", batched=True)
+    ac = np.zeros((env.num, len(BUTTONS)), dtype=np.uint8)
+    env.observe()
+    rss = rss_bytes()
+    with count_gl_creations() as gl_created:
+        for _ in range(num_steps):
+            env.act(ac)
+            env.observe()
+    results = {
+        "long_run/gl_objects_created": len(gl_created),
+        "long_run/peak_rss_bytes": peak_rss_bytes(),
+    }
+    if rss is not None:
+        results["long_run/rss_growth_bytes"] = rss_bytes() - rss
+    return results
+
+
+def run_benchmarks(nums, surface_types, min_time, long_run_steps, log=print):
+    results = {}
+
+    def add(new_results):
+        for name, value in new_results.items():
+            log(f"{name:60} {value:.6g}")
+        results.update(new_results)
+
+    add(benchmark_construction(surface_types, min_time))
+    for name, env_kwargs in env_cases(nums, surface_types):
+        add(benchmark_steps(name, env_kwargs, min_time))
+        gc.collect()
+    if long_run_steps > 0 and "opengl" in surface_types:
+        add(benchmark_long_run(long_run_steps))
+    return results
+
+
+def compare_results(baseline, results, threshold):
+    """
+    Find results that are more than `threshold` worse than the baseline, returns a list of
+    (name, baseline value, new value)
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old_value = baseline[name]
+        # counts that start at zero are regressions as soon as they increase
+        if value - old_value > threshold * abs(old_value):
+            regressions.append((name, old_value, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to compare to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fraction that a result can be worse than the baseline",
+    )
+    parser.add_argument("--nums", type=int, nargs="+", default=DEFAULT_NUMS)
+    parser.add_argument("--surface-types", nargs="+", default=surface_types())
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.5,
+        help="minimum seconds to spend on each measurement",
+    )
+    parser.add_argument("--long-run-steps", type=int, default=100_000)
+    args = parser.parse_args()
+
+    info = machine_info()
+    results = run_benchmarks(
+        nums=args.nums,
+        surface_types=args.surface_types,
+        min_time=args.min_time,
+        long_run_steps=args.long_run_steps,
+    )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(machine=info, results=results), f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["machine"] != info:
+            print("warning: the baseline was run on a different machine or setup")
+        regressions = compare_results(baseline["results"], results, args.threshold)
+        for name, old_value, value in regressions:
+            print(f"regression: {name} {old_value:.6g} -> {value:.6g}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
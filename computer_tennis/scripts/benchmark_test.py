@@ -0,0 +1,37 @@
+from computer_tennis.physics import HAVE_NUMBA
+from computer_tennis.scripts.benchmark import cold_start, compare_results, run_benchmarks
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(
+        nums=[2],
+        surface_types=["numpy"],
+        min_time=0,
+        long_run_steps=0,
+        log=lambda message: None,
+    )
+    for prefix in ["physics/state", "step/numpy", "render/numpy", "observe/numpy"]:
+        assert f"{prefix}/num=2/players=2/batched" in results
+    assert all(value > 0 for value in results.values())
+
+
+def test_cold_start():
+    """
+    Environments that don't render with opengl should not import moderngl, and only batched
+    environments import numba unless it is disabled
+    """
+    for surface_type in ["state", "numpy"]:
+        assert not cold_start(surface_type)["moderngl_imported"]
+    assert cold_start("opengl")["moderngl_imported"]
+    assert not cold_start("state")["numba_imported"]
+    assert cold_start("state", batched=True)["numba_imported"] == HAVE_NUMBA
+    assert not cold_start("state", batched=True, disable_numba=True)["numba_imported"]
+
+
+def test_compare_results():
+    baseline = {"a": 1.0, "b": 1.0, "c": 0, "d": 1.0}
+    results = {"a": 1.05, "b": 1.2, "c": 1, "e": 5.0}
+    assert compare_results(baseline, results, threshold=0.1) == [
+        ("b", 1.0, 1.2),
+        ("c", 0, 1),
+    ]
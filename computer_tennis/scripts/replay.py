@@ -0,0 +1,46 @@
+"""
+Render the frames of one game from a recording made with `RecordingEnv`:
+
+    python -m computer_tennis.scripts.replay recording_dir --game 0 --output frames.npy
+"""
+
+import argparse
+
+import numpy as np
+
+from computer_tennis.recorder import Recording, Replay
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--game", type=int, default=0)
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--num-steps", type=int)
+    parser.add_argument("--surface-type", default="numpy")
+    parser.add_argument(
+        "--output", help="save the frames to this .npy file as (steps, h, w, c)"
+    )
+    args = parser.parse_args()
+
+    recording = Recording(args.directory)
+    print(
+        f"{recording.num_steps} steps of {recording.num_games} games, "
+        f"{recording.nbytes()} bytes on disk"
+    )
+    end = recording.num_steps
+    if args.num_steps is not None:
+        end = min(args.start + args.num_steps, end)
+    replay = Replay(recording, surface_type=args.surface_type)
+    frames = np.stack(
+        [replay.render_frame(step, args.game) for step in range(args.start, end)]
+    )
+    rew = recording.read("rew", np.arange(args.start, end))
+    print(f"rendered {len(frames)} frames, {frames.nbytes} bytes")
+    print(f"total reward for game {args.game}: {rew[:, args.game].sum()}")
+    if args.output is not None:
+        np.save(args.output, frames)
+
+
+if __name__ == "__main__":
+    main()
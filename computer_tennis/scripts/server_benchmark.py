@@ -0,0 +1,125 @@
+"""
+Loopback benchmark for `computer_tennis.server`, runs a server and client processes on this
+machine and reports the steps per second and the latency of `act()` for the clients:
+
+    python -m computer_tennis.scripts.server_benchmark --num-clients 4 --agents-per-client 16
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from computer_tennis.env import BUTTONS, TennisEnv
+from computer_tennis.server import EnvClient, ServerThread, ob_arrays
+
+
+def _client(address, num, num_steps, barrier, results):
+    env = EnvClient(num=num, address=address)
+    ac = np.zeros((num, len(BUTTONS)), dtype=np.uint8)
+    rng = np.random.RandomState(env.start)
+    latencies = []
+    # start stepping once every client is connected so that every step has all the clients
+    barrier.wait()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        ac[:] = rng.randint(0, 2, size=ac.shape)
+        act_start = time.perf_counter()
+        env.act(ac)
+        env.observe()
+        latencies.append(time.perf_counter() - act_start)
+    elapsed = time.perf_counter() - start
+    ob_bytes = sum(x.nbytes for x in ob_arrays(env.observe()[1]))
+    env.close()
+    results.put((latencies, elapsed, env.bytes_received, ob_bytes))
+
+
+def local_steps_per_second(env_kwargs, num_steps):
+    """
+    Steps per second for the same environment without the server
+    """
+    env = TennisEnv(**env_kwargs)
+    ac = np.zeros((env.num, len(BUTTONS)), dtype=np.uint8)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        env.act(ac)
+        env.observe()
+    return num_steps / (time.perf_counter() - start)
+
+
+def run_benchmark(num_clients, agents_per_client, num_steps, env_kwargs, unix_socket):
+    env_kwargs = dict(num=num_clients * agents_per_client, **env_kwargs)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if unix_socket:
+            address = os.path.join(tmpdir, "socket")
+        else:
+            address = ("localhost", 0)
+        server = ServerThread(TennisEnv(**env_kwargs), address)
+        ctx = mp.get_context("spawn")
+        barrier = ctx.Barrier(num_clients)
+        queue = ctx.Queue()
+        processes = [
+            ctx.Process(
+                target=_client,
+                args=(server.address, agents_per_client, num_steps, barrier, queue),
+                daemon=True,
+            )
+            for _ in range(num_clients)
+        ]
+        for process in processes:
+            process.start()
+        client_results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        server.close()
+
+    latencies = np.concatenate([r[0] for r in client_results])
+    elapsed = max(r[1] for r in client_results)
+    bytes_received = sum(r[2] for r in client_results)
+    ob_bytes = sum(r[3] for r in client_results)
+    steps_per_second = num_steps / elapsed
+    return {
+        "steps_per_second": steps_per_second,
+        "agent_steps_per_second": steps_per_second * env_kwargs["num"],
+        "local_steps_per_second": local_steps_per_second(env_kwargs, num_steps),
+        "latency_p50_seconds": float(np.percentile(latencies, 50)),
+        "latency_p99_seconds": float(np.percentile(latencies, 99)),
+        # how much of the full observation is sent each step
+        "ob_bytes_fraction": bytes_received / ((num_steps + 1) * ob_bytes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-clients", type=int, default=4)
+    parser.add_argument("--agents-per-client", type=int, default=16)
+    parser.add_argument("--num-steps", type=int, default=1000)
+    parser.add_argument("--unix-socket", action="store_true")
+    parser.add_argument(
+        "--env-kwargs",
+        default='{"surface_type": "numpy", "batched": true}',
+        help="JSON dict of keyword arguments for TennisEnv",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        num_clients=args.num_clients,
+        agents_per_client=args.agents_per_client,
+        num_steps=args.num_steps,
+        env_kwargs=json.loads(args.env_kwargs),
+        unix_socket=args.unix_socket,
+    )
+    for name, value in results.items():
+        print(f"{name:40} {value:.6g}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""
+Serve a `TennisEnv` over a TCP or unix socket so that actor processes, possibly on other hosts,
+can step games that are all run by one batched environment:
+
+    python -m computer_tennis.server --num 64 --port 5000 --env-kwargs '{"batched": true}'
+
+and in each actor:
+
+    env = EnvClient(num=16, address=("localhost", 5000))
+
+Each client owns `num` of the agents.  The server waits until every connected client has sent
+an action, takes a single step of the environment with all of the actions and sends each client
+its part of the observation.  Only the rows of the observation that changed since the last one
+sent to that client are sent, see `encode_observation()`.  The step runs on a separate thread
+so that the event loop keeps handling the other connections, and only one step runs at a time.
+
+A client that sends an unexpected message gets an ERROR message and is disconnected.
+
+Every message is a `HEADER` with the message type and payload length, followed by the payload:
+    HELLO: client -> server, uint32 number of agents
+    INFO: server -> client, JSON with the first agent and the observation space
+    ACT: client -> server, the uint8 actions for the client's agents
+    OBSERVATION: server -> client, see `encode_observation()`
+    ERROR: server -> client, a utf-8 error message
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import socket
+import struct
+import threading
+
+import gym3
+import numpy as np
+from gym3 import types_np
+
+from computer_tennis.env import BUTTONS, TennisEnv, make_ob_space
+
+HEADER = struct.Struct("<BI")
+HELLO = 0
+INFO = 1
+ACT = 2
+OBSERVATION = 3
+ERROR = 4
+
+
+def ob_arrays(ob):
+    """
+    The arrays of an observation in a fixed order
+    """
+    if isinstance(ob, dict):
+        return [ob[key] for key in sorted(ob.keys())]
+    return [ob]
+
+
+def _rows(arr):
+    # observations are compared in rows of the last two dimensions, for pixels that is one row
+    # of the image
+    num_rows = int(np.prod(arr.shape[1:-2]))
+    return arr.reshape(len(arr), num_rows, -1)
+
+
+def encode_observation(rew, ob, first, last_ob):
+    """
+    Payload of an OBSERVATION message, `last_ob` are the arrays from `ob_arrays()` that the
+    client already has and they are updated to `ob`
+
+    The payload is the float32 rewards, the uint8 firsts and then for each array a bit for
+    each row that is set if the row changed, packed with `np.packbits()`, followed by the
+    changed rows.
+    """
+    parts = [
+        np.asarray(rew, dtype=np.float32).tobytes(),
+        np.asarray(first, dtype=np.uint8).tobytes(),
+    ]
+    for arr, last in zip(ob_arrays(ob), last_ob):
+        rows = _rows(np.asarray(arr))
+        last_rows = _rows(last)
+        changed = (rows != last_rows).any(axis=2)
+        changed_rows = rows[changed]
+        last_rows[changed] = changed_rows
+        parts.append(np.packbits(changed).tobytes())
+        parts.append(changed_rows.tobytes())
+    return b"".join(parts)
+
+
+def decode_observation(payload, num, last_ob):
+    """
+    Apply an OBSERVATION payload to the arrays `last_ob` and return the rewards and firsts
+    """
+    offset = 0
+    rew = np.frombuffer(payload, dtype=np.float32, count=num, offset=offset)
+    offset += rew.nbytes
+    first = np.frombuffer(payload, dtype=np.uint8, count=num, offset=offset)
+    offset += num
+    for last in last_ob:
+        last_rows = _rows(last)
+        num_bits = last_rows.shape[0] * last_rows.shape[1]
+        mask_bytes = (num_bits + 7) // 8
+        changed = np.unpackbits(
+            np.frombuffer(payload, dtype=np.uint8, count=mask_bytes, offset=offset),
+            count=num_bits,
+        ).reshape(last_rows.shape[:2])
+        offset += mask_bytes
+        changed = changed.astype(bool)
+        num_changed = int(changed.sum())
+        rows = np.frombuffer(
+            payload,
+            dtype=last.dtype,
+            count=num_changed * last_rows.shape[2],
+            offset=offset,
+        )
+        offset += rows.nbytes
+        last_rows[changed] = rows.reshape(num_changed, -1)
+    assert offset == len(payload)
+    return rew.copy(), first.astype(bool)
+
+
+def describe_ob_space(ob_space):
+    """
+    The `make_ob_space()` arguments for `ob_space` as a JSON-compatible dict
+    """
+    if isinstance(ob_space, gym3.types.DictType):
+        return dict(ob_mode="both", rgb_shape=list(ob_space["rgb"].shape))
+    if ob_space.eltype.dtype_name == "float32":
+        return dict(ob_mode="state", rgb_shape=None)
+    return dict(ob_mode="pixels", rgb_shape=list(ob_space.shape))
+
+
+def _make_ob_space(description):
+    if description["rgb_shape"] is None:
+        return make_ob_space(description["ob_mode"])
+    return make_ob_space(
+        description["ob_mode"], rgb_shape=tuple(description["rgb_shape"])
+    )
+
+
+class _Client:
+    def __init__(self, start, num, writer, last_ob):
+        self.start = start
+        self.num = num
+        self.writer = writer
+        self.last_ob = last_ob
+        self.pending = False
+
+
+class EnvServer:
+    """
+    Steps `env` with the actions from all of the connected clients, see the module docstring
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self._ac = types_np.zeros(env.ac_space, bshape=(env.num,))
+        self._taken = np.zeros(env.num, dtype=bool)
+        self._clients = []
+        self._server = None
+        self.num_steps = 0
+        # the env is stepped on this thread, the lock keeps new clients from observing the env
+        # while it is stepping
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._env_lock = None
+        self._stepping = False
+
+    async def start(self, address):
+        """
+        Listen on `address`, a (host, port) tuple or the path of a unix socket
+        """
+        self._env_lock = asyncio.Lock()
+        if isinstance(address, str):
+            self._server = await asyncio.start_unix_server(self._handle, path=address)
+        else:
+            self._server = await asyncio.start_server(self._handle, *address)
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        for client in self._clients:
+            client.writer.close()
+        await self._server.wait_closed()
+        self._executor.shutdown()
+
+    def _allocate(self, num):
+        # first range of `num` agents that is not taken
+        free = 0
+        for agent, taken in enumerate(self._taken):
+            free = 0 if taken else free + 1
+            if free == num:
+                start = agent + 1 - num
+                self._taken[start : agent + 1] = True
+                return start
+        return None
+
+    def _slice(self, x, client):
+        return x[client.start : client.start + client.num]
+
+    def _encode(self, client, rew, ob, first):
+        payload = encode_observation(
+            self._slice(rew, client),
+            gym3.types.multimap(lambda x: self._slice(x, client), ob),
+            self._slice(first, client),
+            client.last_ob,
+        )
+        return HEADER.pack(OBSERVATION, len(payload)) + payload
+
+    def _step(self, ac, clients):
+        """
+        Step the env and encode the observation for each of `clients`, this runs on the
+        executor thread
+        """
+        self.env.act(ac)
+        rew, ob, first = self.env.observe()
+        return [self._encode(client, rew, ob, first) for client in clients]
+
+    def _ready(self):
+        return len(self._clients) > 0 and all(c.pending for c in self._clients)
+
+    async def _step_if_ready(self):
+        # a step that is running checks again when it is done
+        if self._stepping:
+            return
+        self._stepping = True
+        try:
+            loop = asyncio.get_running_loop()
+            while self._ready():
+                clients = list(self._clients)
+                async with self._env_lock:
+                    # clients that disconnect during the step change the actions
+                    messages = await loop.run_in_executor(
+                        self._executor, self._step, self._ac.copy(), clients
+                    )
+                self.num_steps += 1
+                for client, message in zip(clients, messages):
+                    client.pending = False
+                    if not client.writer.is_closing():
+                        client.writer.write(message)
+                # wait for every client's buffer to drain before the next step
+                await asyncio.gather(
+                    *[client.writer.drain() for client in clients],
+                    return_exceptions=True,
+                )
+        finally:
+            self._stepping = False
+
+    async def _handle(self, reader, writer):
+        client = None
+        try:
+            msg_type, payload = await _read_message(reader)
+            if msg_type != HELLO or len(payload) != 4:
+                raise Exception("expected a HELLO message")
+            (num,) = struct.unpack("<I", payload)
+            start = self._allocate(num) if num > 0 else None
+            if start is None:
+                raise Exception(f"can't allocate {num} agents")
+            last_ob = ob_arrays(types_np.zeros(self.env.ob_space, bshape=(num,)))
+            client = _Client(start, num, writer, last_ob)
+            info = dict(start=start, **describe_ob_space(self.env.ob_space))
+            palette = getattr(self.env, "palette", None)
+            info["palette"] = None if palette is None else palette.tolist()
+            info = json.dumps(info).encode()
+            writer.write(HEADER.pack(INFO, len(info)) + info)
+            async with self._env_lock:
+                writer.write(self._encode(client, *self.env.observe()))
+                self._clients.append(client)
+            await writer.drain()
+
+            ac_shape = (num,) + self.env.ac_space.shape
+            ac_dtype = self.env.ac_space.eltype.dtype_name
+            ac_bytes = int(np.prod(ac_shape)) * np.dtype(ac_dtype).itemsize
+            while True:
+                msg_type, payload = await _read_message(reader)
+                if msg_type != ACT or client.pending:
+                    raise Exception("expected one ACT message per step")
+                if len(payload) != ac_bytes:
+                    raise Exception(
+                        f"expected {ac_bytes} bytes of actions, got {len(payload)}"
+                    )
+                ac = np.frombuffer(payload, dtype=ac_dtype).reshape(ac_shape)
+                self._slice(self._ac, client)[:] = ac
+                client.pending = True
+                await self._step_if_ready()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client disconnected
+            pass
+        except Exception as e:
+            message = str(e).encode()
+            writer.write(HEADER.pack(ERROR, len(message)) + message)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        finally:
+            if client is not None:
+                if client in self._clients:
+                    self._clients.remove(client)
+                self._slice(self._taken, client)[:] = False
+                self._slice(self._ac, client)[:] = 0
+                # the other clients may have been waiting for this one
+                await self._step_if_ready()
+            writer.close()
+
+
+async def _read_message(reader):
+    msg_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msg_type, await reader.readexactly(length)
+
+
+class ServerThread:
+    """
+    Runs an `EnvServer` for `env` on `address` with an event loop on a background thread, the
+    actual address is in `address` which is useful with port 0
+    """
+
+    def __init__(self, env, address):
+        self.server = EnvServer(env)
+        self._loop = asyncio.new_event_loop()
+        started = concurrent.futures.Future()
+        self._thread = threading.Thread(
+            target=self._run, args=(address, started), daemon=True
+        )
+        self._thread.start()
+        started.result()
+        self.address = self.server.address
+
+    def _run(self, address, started):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self.server.start(address))
+        except Exception as e:
+            started.set_exception(e)
+            return
+        started.set_result(None)
+        self._loop.run_forever()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class EnvClient(gym3.Env):
+    """
+    A gym3 environment for `num` agents of an `EnvServer` at `address`, a (host, port) tuple or
+    the path of a unix socket
+
+    `act()` waits until the server has stepped with the actions of every client.
+    `bytes_received` counts the observation bytes received from the server.
+    """
+
+    def __init__(self, num, address):
+        if isinstance(address, str):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.connect(address)
+        self._send(HELLO, struct.pack("<I", num))
+        info = json.loads(self._recv(INFO))
+        ob_space = _make_ob_space(info)
+        ac_space = gym3.types.TensorType(
+            eltype=gym3.types.Discrete(2, dtype_name="uint8"),
+            shape=(len(BUTTONS),),
+        )
+        super().__init__(ob_space=ob_space, ac_space=ac_space, num=num)
+        self.buttons = BUTTONS
+        self.start = info["start"]
+        self.palette = None
+        if info["palette"] is not None:
+            self.palette = np.array(info["palette"], dtype=np.uint8)
+        self._ob = types_np.zeros(ob_space, bshape=(num,))
+        self._last_ob = ob_arrays(self._ob)
+        self.bytes_received = 0
+        self._receive_observation()
+
+    def _send(self, msg_type, payload):
+        self._sock.sendall(HEADER.pack(msg_type, len(payload)) + payload)
+
+    def _recv_exactly(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = self._sock.recv_into(view[received:])
+            if n == 0:
+                raise Exception("server closed the connection")
+            received += n
+        return data
+
+    def _recv(self, expected_type):
+        msg_type, length = HEADER.unpack(self._recv_exactly(HEADER.size))
+        payload = self._recv_exactly(length)
+        if msg_type == ERROR:
+            raise Exception("server error: " + payload.decode())
+        assert msg_type == expected_type
+        return payload
+
+    def _receive_observation(self):
+        payload = self._recv(OBSERVATION)
+        self.bytes_received += len(payload)
+        self._rew, self._first = decode_observation(payload, self.num, self._last_ob)
+
+    def observe(self):
+        return (
+            self._rew.copy(),
+            gym3.types.multimap(lambda x: x.copy(), self._ob),
+            self._first.copy(),
+        )
+
+    def act(self, ac):
+        ac = np.ascontiguousarray(ac, dtype=np.uint8)
+        assert ac.shape == (self.num,) + self.ac_space.shape
+        self._send(ACT, ac.tobytes())
+        self._receive_observation()
+
+    def close(self):
+        self._sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num", type=int, default=64)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--unix-socket", help="listen on this unix socket instead of TCP"
+    )
+    parser.add_argument(
+        "--env-kwargs",
+        default="{}",
+        help="JSON dict of keyword arguments for TennisEnv",
+    )
+    args = parser.parse_args()
+
+    env = TennisEnv(num=args.num, **json.loads(args.env_kwargs))
+    address = args.unix_socket or (args.host, args.port)
+
+    async def serve():
+        server = EnvServer(env)
+        await server.start(address)
+        print(f"serving {args.num} agents on {server.address}")
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import concurrent.futures
+import os
+import struct
+
+import numpy as np
+import pytest
+from gym3.types import multimap
+
+from computer_tennis.batch_env_test import assert_equal
+from computer_tennis.env import BUTTONS, TennisEnv
+from computer_tennis.server import ACT, HELLO, OBSERVATION, EnvClient, ServerThread
+
+NUM_STEPS = 50
+
+
+def run_client(env, acs):
+    results = [env.observe()]
+    for ac in acs:
+        env.act(ac)
+        results.append(env.observe())
+    return results, env.bytes_received
+
+
+@pytest.mark.parametrize("ob_mode", ["pixels", "both"])
+@pytest.mark.parametrize("unix_socket", [False, True])
+def test_matches_local_env(tmp_path, ob_mode, unix_socket):
+    """
+    Clients of a server should see the same observations as a local environment
+    """
+    env_kwargs = dict(num=4, surface_type="numpy", batched=True, ob_mode=ob_mode, seed=0)
+    local_env = TennisEnv(**env_kwargs)
+    address = os.path.join(tmp_path, "socket") if unix_socket else ("localhost", 0)
+    server = ServerThread(TennisEnv(**env_kwargs), address)
+    rng = np.random.RandomState(0)
+    acs = rng.randint(0, 2, size=(NUM_STEPS, 4, len(BUTTONS)), dtype=np.uint8)
+    try:
+        # the server steps as soon as every connected client has acted, so connect both first
+        clients = [EnvClient(num=2, address=server.address) for _ in range(2)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(run_client, client, acs[:, start : start + 2])
+                for client, start in zip(clients, [0, 2])
+            ]
+            client_results = [f.result() for f in futures]
+        for client in clients:
+            client.close()
+    finally:
+        server.close()
+    assert server.server.num_steps == NUM_STEPS
+
+    # batched envs return their frames without copying them
+    expected = [[multimap(np.copy, x) for x in local_env.observe()]]
+    for ac in acs:
+        local_env.act(ac)
+        expected.append([multimap(np.copy, x) for x in local_env.observe()])
+    for (results, bytes_received), start in zip(client_results, [0, 2]):
+        for (rew, ob, first), (e_rew, e_ob, e_first) in zip(results, expected):
+            assert_equal(rew, e_rew[start : start + 2])
+            assert_equal(first, e_first[start : start + 2])
+            if ob_mode == "both":
+                ob = ob["rgb"]
+                e_ob = e_ob["rgb"]
+            assert_equal(ob, e_ob[start : start + 2])
+        # only the changed rows are sent
+        frame_bytes = ob.nbytes
+        assert bytes_received < (NUM_STEPS + 1) * frame_bytes / 5
+
+
+@pytest.mark.parametrize(
+    "msg_type, payload, message",
+    [
+        (ACT, b"\x00", "bytes of actions"),
+        (HELLO, struct.pack("<I", 2), "expected one ACT message"),
+    ],
+)
+def test_protocol_error(msg_type, payload, message):
+    """
+    The server should tell a client what was wrong with a message and keep serving the others
+    """
+    server = ServerThread(TennisEnv(num=4, surface_type="numpy"), ("localhost", 0))
+    try:
+        bad_client = EnvClient(num=2, address=server.address)
+        bad_client._send(msg_type, payload)
+        with pytest.raises(Exception, match=message):
+            bad_client._recv(OBSERVATION)
+        bad_client.close()
+        client = EnvClient(num=2, address=server.address)
+        client.act(np.zeros((2, len(BUTTONS)), dtype=np.uint8))
+        client.close()
+    finally:
+        server.close()
+    assert server.server.num_steps == 1
+
+
+def test_not_enough_agents():
+    server = ServerThread(TennisEnv(num=2, surface_type="numpy"), ("localhost", 0))
+    try:
+        with pytest.raises(Exception, match="allocate"):
+            EnvClient(num=3, address=server.address)
+    finally:
+        server.close()
@@ -0,0 +1,180 @@
+import functools
+
+import numpy as np
+
+from computer_tennis import numpy_draw
+from computer_tennis.env import (
+    BALL_RECT,
+    BOTTOM_BAR_RECT,
+    COLORS,
+    PADDLE_RECT,
+    SCREEN_WIDTH,
+    TOP_BAR_RECT,
+    Rect,
+    draw_bars,
+    draw_scores,
+)
+
+# once a score has two digits, the image only depends on the last two digits
+NUM_SCORE_KEYS = 200
+
+
+def score_keys(score):
+    return np.where(score < 100, score, 100 + score % 100)
+
+
+def _score_key(score):
+    return score if score < 100 else 100 + score % 100
+
+
+def _intersect(a, b):
+    """
+    Intersection of two (rows, cols) regions
+    """
+    return tuple(
+        slice(max(x.start, y.start), max(min(x.stop, y.stop), max(x.start, y.start)))
+        for x, y in zip(a, b)
+    )
+
+
+class SpriteCache:
+    """
+    The parts of the frame that only change when someone scores, pre-rendered with
+    `numpy_draw.Surface`: the background with the bars, and an image of the score area for
+    every score.
+
+    This is read only once it is built, so use `get_sprite_cache()` to share one between
+    renderers.
+    """
+
+    def __init__(
+        self,
+        pixel_width,
+        pixel_height,
+        view_width,
+        view_height,
+        view_x=0,
+        view_y=0,
+        channels=3,
+        colors=COLORS,
+    ):
+        self.scale_x = pixel_width / view_width
+        self.scale_y = pixel_height / view_height
+        self.view_x = view_x
+        self.view_y = view_y
+        surface = numpy_draw.Surface(
+            pixel_width=pixel_width,
+            pixel_height=pixel_height,
+            view_width=view_width,
+            view_height=view_height,
+            origin_at_center=False,
+            view_x=view_x,
+            view_y=view_y,
+            channels=channels,
+        )
+
+        surface.reset(color=colors.bg)
+        draw_bars(surface, colors=colors)
+        self.background = surface.get_image()
+        self.bar_regions = [
+            self.rect_region(rect) for rect in [BOTTOM_BAR_RECT, TOP_BAR_RECT]
+        ]
+
+        # the scores are drawn above the top bar, player 2 on the left and player 1 on the right
+        self.p2_score_region = self.rect_region(
+            Rect(0, 0, SCREEN_WIDTH / 2, TOP_BAR_RECT.y)
+        )
+        self.p1_score_region = self.rect_region(
+            Rect(SCREEN_WIDTH / 2, 0, SCREEN_WIDTH / 2, TOP_BAR_RECT.y)
+        )
+        p1_scores = []
+        p2_scores = []
+        for key in range(NUM_SCORE_KEYS):
+            surface.reset(color=colors.bg)
+            draw_scores(surface, p1_score=key, p2_score=key, colors=colors)
+            p1_scores.append(surface.data[self.p1_score_region].copy())
+            p2_scores.append(surface.data[self.p2_score_region].copy())
+        self.p1_scores = np.stack(p1_scores)
+        self.p2_scores = np.stack(p2_scores)
+
+        self.white_pixel = numpy_draw.color_to_pixel(colors.white)[:channels]
+        self.p1_pixel = numpy_draw.color_to_pixel(colors.p1)[:channels]
+        self.p2_pixel = numpy_draw.color_to_pixel(colors.p2)[:channels]
+
+    def rect_region(self, rect, pos_x=0, pos_y=0):
+        """
+        The (rows, cols) slices covered by `rect` moved to (pos_x, pos_y), using the same math
+        as drawing the rect on a `numpy_draw.Surface`
+        """
+        height, width, _ = self.background.shape
+        row_start, row_end = numpy_draw.pixel_span(
+            ((rect.y + pos_y) - self.view_y) * self.scale_y,
+            (((rect.y + rect.h) + pos_y) - self.view_y) * self.scale_y,
+            height,
+        )
+        col_start, col_end = numpy_draw.pixel_span(
+            ((rect.x + pos_x) - self.view_x) * self.scale_x,
+            (((rect.x + rect.w) + pos_x) - self.view_x) * self.scale_x,
+            width,
+        )
+        return slice(row_start, row_end), slice(col_start, col_end)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sprite_cache(**kwargs):
+    return SpriteCache(**kwargs)
+
+
+class IncrementalRenderer:
+    """
+    Renders a single game into `frame`, only redrawing what changed since the last frame
+
+    The background for the current scores is built from the `SpriteCache` when the scores
+    change.  Otherwise the ball and paddles are erased by copying the background over where
+    they were drawn last time and are then drawn at their new positions, so a frame is a few
+    small copies and fills.
+    """
+
+    # methods that `Instrumentation` times
+    PHASE_METHODS = {"draw": "render"}
+
+    def __init__(self, sprites):
+        self._sprites = sprites
+        self._score_background = sprites.background.copy()
+        self._scores = None
+        self.frame = sprites.background.copy()
+        # regions that have been drawn over since the background was copied to the frame
+        self._dirty = []
+
+    def _stamp(self, rect, pos, pixel):
+        region = self._sprites.rect_region(rect, pos.x, pos.y)
+        self.frame[region] = pixel
+        self._dirty.append(region)
+        # the bars are drawn on top of everything else
+        for bar_region in self._sprites.bar_regions:
+            overlap = _intersect(region, bar_region)
+            self.frame[overlap] = self._score_background[overlap]
+
+    def render(self, p1_score, p2_score, ball_pos, p1_pos, p2_pos):
+        """
+        Update and return `frame`, the positions should be `Vec2`s
+        """
+        sprites = self._sprites
+        if self._scores != (p1_score, p2_score):
+            self._scores = (p1_score, p2_score)
+            self._score_background[sprites.p1_score_region] = sprites.p1_scores[
+                _score_key(p1_score)
+            ]
+            self._score_background[sprites.p2_score_region] = sprites.p2_scores[
+                _score_key(p2_score)
+            ]
+            np.copyto(self.frame, self._score_background)
+        else:
+            for region in self._dirty:
+                self.frame[region] = self._score_background[region]
+        self._dirty.clear()
+
+        self._stamp(BALL_RECT, ball_pos, sprites.white_pixel)
+        self._stamp(PADDLE_RECT, p1_pos, sprites.p1_pixel)
+        self._stamp(PADDLE_RECT, p2_pos, sprites.p2_pixel)
+        return self.frame
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from computer_tennis import numpy_draw
+from computer_tennis.env import (
+    COLORS,
+    GRAYSCALE_COLORS,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    draw_frame,
+    view_options,
+)
+from computer_tennis.sprite_render import IncrementalRenderer, get_sprite_cache
+from computer_tennis.types import Vec2
+
+
+@pytest.mark.parametrize(
+    "view_kwargs, colors",
+    [
+        (view_options(None, False, None, False), COLORS),
+        (view_options((84, 84), True, (0, 34, 160, 160), False), GRAYSCALE_COLORS),
+    ],
+)
+def test_matches_surface(view_kwargs, colors):
+    """
+    Redrawing only what changed should give the same frames as drawing everything
+    """
+    surface = numpy_draw.Surface(origin_at_center=False, **view_kwargs)
+    renderer = IncrementalRenderer(get_sprite_cache(colors=colors, **view_kwargs))
+    rng = np.random.RandomState(0)
+    p1_score = 0
+    p2_score = 0
+    for _ in range(1000):
+        # scores change now and then, including past 100
+        if rng.rand() < 0.05:
+            p1_score = rng.randint(0, 120)
+            p2_score = rng.randint(0, 20)
+        # positions go a little past the edges of the screen
+        positions = dict(
+            p1_score=p1_score,
+            p2_score=p2_score,
+            ball_pos=Vec2(
+                rng.uniform(-4, SCREEN_WIDTH + 4), rng.uniform(-4, SCREEN_HEIGHT + 4)
+            ),
+            p1_pos=Vec2(140, rng.uniform(24, SCREEN_HEIGHT)),
+            p2_pos=Vec2(16, rng.uniform(24, SCREEN_HEIGHT)),
+        )
+        draw_frame(surface, colors=colors, **positions)
+        assert np.array_equal(renderer.render(**positions), surface.data)
@@ -0,0 +1,377 @@
+import multiprocessing as mp
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+import gym3
+import numpy as np
+
+from computer_tennis.env import (
+    BUTTONS,
+    GAME_STATE_SIZE,
+    ObservationBuffers,
+    assign_devices,
+    make_palette,
+    make_seeds,
+)
+from computer_tennis.instrument import merge_stats
+
+# commands for the workers, stored in a shared value so that stepping doesn't send any messages
+_ACT = 0
+_CALL = 1
+_CLOSE = 2
+
+
+class _WorkerError:
+    def __init__(self, message):
+        self.message = message
+
+
+def _shard_sizes(num_games, num_workers):
+    return [len(games) for games in np.array_split(np.arange(num_games), num_workers)]
+
+
+class _SharedArrays:
+    """
+    Numpy arrays stored in `shared_memory` blocks, `specs` maps names to (shape, dtype)
+
+    The parent process creates the blocks and the workers attach to them using `block_names`
+    """
+
+    def __init__(self, specs, block_names=None):
+        self.specs = specs
+        self.block_names = {}
+        self.arrays = {}
+        self._blocks = []
+        for name, (shape, dtype) in specs.items():
+            if block_names is None:
+                size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=block_names[name])
+            self._blocks.append(block)
+            self.block_names[name] = block.name
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def close(self, unlink):
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self._blocks = []
+
+
+def _ob_names(ob_space):
+    """
+    Names of the shared arrays for each part of the observation
+    """
+    if isinstance(ob_space, gym3.types.DictType):
+        return {key: "ob_" + key for key in ob_space.keys()}
+    else:
+        return "ob"
+
+
+def _shared_ob_buffers(arrays, ob_names):
+    if isinstance(ob_names, dict):
+        ob = {key: arrays[name] for key, name in ob_names.items()}
+    else:
+        ob = arrays[ob_names]
+    return ObservationBuffers(rew=arrays["rew"], ob=ob, first=arrays["first"])
+
+
+def _worker(env_kwargs, num, seeds, start, conn, barrier, command):
+    from computer_tennis.env import build_env
+
+    shared = None
+    try:
+        env = build_env(num=num, seeds=seeds, **env_kwargs)
+        conn.send((env.ob_space, env.ac_space))
+        specs, block_names = conn.recv()
+        shared = _SharedArrays(specs, block_names=block_names)
+        ob_buffers = _shared_ob_buffers(shared.arrays, _ob_names(env.ob_space))
+        end = start + num
+
+        def write_observation():
+            rew, ob, first = env.observe()
+            buf_rew, buf_ob, buf_first = ob_buffers.current()
+            buf_rew[start:end] = rew
+            buf_first[start:end] = first
+            if isinstance(ob, dict):
+                for key, value in ob.items():
+                    buf_ob[key][start:end] = value
+            else:
+                buf_ob[start:end] = ob
+
+        write_observation()
+        barrier.wait()
+        while True:
+            barrier.wait()
+            if command.value == _ACT:
+                env.act(shared.arrays["ac"][start:end])
+                ob_buffers.advance()
+                write_observation()
+            elif command.value == _CALL:
+                method, args, kwargs = conn.recv()
+                result = getattr(env, method)(*args, **kwargs)
+                if method == "set_state":
+                    ob_buffers.advance()
+                    write_observation()
+                conn.send(result)
+            elif command.value == _CLOSE:
+                break
+            barrier.wait()
+    except Exception:
+        try:
+            conn.send(_WorkerError(traceback.format_exc()))
+        except BrokenPipeError:
+            # the parent has already stopped listening
+            pass
+        # wake up the parent so that it sees the error instead of waiting forever
+        barrier.abort()
+    finally:
+        if shared is not None:
+            shared.close(unlink=False)
+
+
+class SubprocTennisEnv(gym3.Env):
+    """
+    Runs the games of a `TennisEnv` in `num_workers` worker processes, each worker steps its
+    share of the games with a regular `TennisEnv`.
+
+    Actions, rewards, observations and firsts are stored in `shared_memory` arrays that the
+    workers read and write directly, and the workers are started and waited on with a barrier,
+    so that `act()` doesn't pickle anything.  `get_info()` and `callmethod()` send messages to
+    the workers since they are not called every step.
+
+    The workers render their observations as part of `act()` so that rendering is done in
+    parallel.  `act_async()` starts a step without waiting for the workers to finish it, and
+    `observe_wait()` waits for the step and returns the observation.  Call `close()` to stop the
+    workers.
+
+    The observations are stored in a ring of `num_ob_buffers` `ObservationBuffers` in shared
+    memory.  With `num_ob_buffers` set, `observe()` returns the current buffer without copying
+    it, otherwise it returns a copy.
+
+    If `egl_device_index` is a list of devices, the workers are assigned devices round-robin.
+    """
+
+    def __init__(
+        self,
+        num,
+        num_workers,
+        num_players=1,
+        seeds=None,
+        batched=False,
+        num_ob_buffers=None,
+        **env_kwargs,
+    ):
+        assert num % num_players == 0
+        num_games = num // num_players
+        assert 1 <= num_workers <= num_games
+        if seeds is None:
+            seeds = make_seeds(None, num_games)
+        assert len(seeds) == num_games
+        self._num_players = num_players
+        self._closed = False
+        self._stepping = False
+        self._shared = None
+
+        # opengl contexts do not survive a fork, so start the workers from scratch
+        ctx = mp.get_context("spawn")
+        self._barrier = ctx.Barrier(num_workers + 1)
+        self._command = ctx.RawValue("i", _ACT)
+        self._conns = []
+        self._processes = []
+        self._sizes = []
+        self._game_sizes = []
+        start = 0
+        game_start = 0
+        devices = assign_devices(env_kwargs.pop("egl_device_index", None), num_workers)
+        for shard_games, device in zip(_shard_sizes(num_games, num_workers), devices):
+            shard_num = shard_games * num_players
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                kwargs=dict(
+                    env_kwargs=dict(
+                        num_players=num_players,
+                        batched=batched,
+                        egl_device_index=device,
+                        **env_kwargs,
+                    ),
+                    num=shard_num,
+                    seeds=seeds[game_start : game_start + shard_games],
+                    start=start,
+                    conn=child_conn,
+                    barrier=self._barrier,
+                    command=self._command,
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+            self._sizes.append(shard_num)
+            self._game_sizes.append(shard_games)
+            start += shard_num
+            game_start += shard_games
+
+        ob_space, ac_space = self._recv_all()[0]
+        super().__init__(ob_space=ob_space, ac_space=ac_space, num=num)
+        self.buttons = BUTTONS
+        self.palette = make_palette(env_kwargs.get("ob_format", "rgb"))
+
+        self._copy_ob = num_ob_buffers is None
+        if num_ob_buffers is None:
+            num_ob_buffers = 1
+        bshape = (num_ob_buffers, num)
+
+        def spec(space, bshape=bshape):
+            return (bshape + space.shape, space.eltype.dtype_name)
+
+        specs = dict(
+            ac=spec(ac_space, bshape=(num,)),
+            rew=(bshape, np.float32),
+            first=(bshape, bool),
+        )
+        ob_names = _ob_names(ob_space)
+        if isinstance(ob_names, dict):
+            for key, name in ob_names.items():
+                specs[name] = spec(ob_space[key])
+        else:
+            specs[ob_names] = spec(ob_space)
+        self._shared = _SharedArrays(specs)
+        self._ac = self._shared.arrays["ac"]
+        self._ob_buffers = _shared_ob_buffers(self._shared.arrays, ob_names)
+
+        for conn in self._conns:
+            conn.send((specs, self._shared.block_names))
+        self._wait()
+
+    def _recv_all(self):
+        results = []
+        for conn in self._conns:
+            try:
+                result = conn.recv()
+            except EOFError:
+                result = _WorkerError("worker exited unexpectedly")
+            if isinstance(result, _WorkerError):
+                self._fail([result])
+            results.append(result)
+        return results
+
+    def _wait(self):
+        try:
+            self._barrier.wait()
+        except threading.BrokenBarrierError:
+            self._fail([conn.recv() for conn in self._conns if conn.poll()])
+
+    def _fail(self, errors):
+        self._barrier.abort()
+        self.close()
+        raise Exception("worker failed:\n" + "\n".join(e.message for e in errors))
+
+    def _run(self, command):
+        self._command.value = command
+        self._wait()
+
+    def _finish_step(self):
+        if self._stepping:
+            self._stepping = False
+            self._wait()
+
+    def observe(self):
+        self._finish_step()
+        rew, ob, first = self._ob_buffers.current()
+        if not self._copy_ob:
+            return rew, ob, first
+        return rew.copy(), gym3.types.multimap(lambda x: x.copy(), ob), first.copy()
+
+    def act_async(self, ac):
+        self._finish_step()
+        self._ac[:] = ac
+        self._ob_buffers.advance()
+        self._run(_ACT)
+        self._stepping = True
+
+    def observe_wait(self):
+        return self.observe()
+
+    def act(self, ac):
+        self.act_async(ac)
+        self._finish_step()
+
+    def _call(self, method, args_per_worker, kwargs_per_worker):
+        self._finish_step()
+        self._run(_CALL)
+        for conn, args, kwargs in zip(self._conns, args_per_worker, kwargs_per_worker):
+            conn.send((method, args, kwargs))
+        results = self._recv_all()
+        self._wait()
+        return results
+
+    def get_info(self):
+        results = self._call(
+            "get_info", [()] * len(self._conns), [{}] * len(self._conns)
+        )
+        return [info for infos in results for info in infos]
+
+    def callmethod(self, method, *args, **kwargs):
+        bounds = np.cumsum([0] + self._sizes)
+        args_per_worker = []
+        kwargs_per_worker = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            args_per_worker.append((method,) + tuple(arg[start:end] for arg in args))
+            kwargs_per_worker.append({k: v[start:end] for k, v in kwargs.items()})
+        results = self._call("callmethod", args_per_worker, kwargs_per_worker)
+        return [r for worker_results in results for r in worker_results]
+
+    def get_state(self):
+        results = self._call(
+            "get_state", [()] * len(self._conns), [{}] * len(self._conns)
+        )
+        return np.concatenate(results)
+
+    def set_state(self, state):
+        assert state.shape == (sum(self._game_sizes), GAME_STATE_SIZE)
+        sections = np.split(state, np.cumsum(self._game_sizes)[:-1])
+        self._ob_buffers.advance()
+        self._call("set_state", [(s,) for s in sections], [{}] * len(self._conns))
+
+    def stats(self):
+        """
+        Time spent in each phase by all the workers if `instrument` was set, see
+        `Instrumentation.stats()`
+        """
+        results = self._call("stats", [()] * len(self._conns), [{}] * len(self._conns))
+        return merge_stats(results)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._barrier.broken:
+            self._finish_step()
+            self._command.value = _CLOSE
+            self._barrier.wait()
+        # closing the pipes wakes up any workers that are still waiting for a message
+        for conn in self._conns:
+            conn.close()
+        for process in self._processes:
+            process.join()
+        if self._shared is not None:
+            self._shared.close(unlink=True)
+
+    def keys_to_act(self, keys_list):
+        result = []
+        for keys in keys_list:
+            act = np.zeros(shape=self.ac_space.shape, dtype=np.uint8)
+            key_to_button = {"UP": "UP", "DOWN": "DOWN"}
+            for key, button in key_to_button.items():
+                if key in keys:
+                    act[self.buttons.index(button)] = 1
+                    break
+            result.append(np.expand_dims(act, axis=0))
+        return result
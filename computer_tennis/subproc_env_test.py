@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from gym3 import types_np
+
+from computer_tennis.batch_env_test import assert_equal
+from computer_tennis.env import STATE_SIZE, TennisEnv
+
+
+@pytest.mark.parametrize("surface_type", ["opengl", "numpy"])
+@pytest.mark.parametrize("num_players", [1, 2])
+def test_works(surface_type, num_players):
+    """
+    Make sure the workers step their games and write the observations back
+    """
+    env = TennisEnv(
+        num=6,
+        num_workers=2,
+        num_players=num_players,
+        surface_type=surface_type,
+        ob_mode="both",
+    )
+    try:
+        assert env.ob_space["rgb"].shape == (210, 160, 3)
+        rew, ob, first = env.observe()
+        assert first.all()
+        total_rew = np.zeros(6, dtype=np.float32)
+        for _ in range(1000):
+            env.act(types_np.sample(env.ac_space, bshape=(env.num,)))
+            rew, ob, first = env.observe()
+            total_rew += rew
+        assert ob["rgb"].shape == (6, 210, 160, 3)
+        assert ob["state"].shape == (6, STATE_SIZE)
+        # rewards add up to the difference in the scores since no game has ended yet
+        score_diff = ob["state"][:, 12] - ob["state"][:, 13]
+        assert np.array_equal(total_rew[0::num_players], score_diff[0::num_players])
+        assert np.abs(total_rew).sum() > 0
+        if num_players == 2:
+            assert np.array_equal(ob["state"][0::2], ob["state"][1::2])
+        assert env.get_info() == [{}] * 6
+        assert len(env.callmethod("keys_to_act", [["UP"]] * 6)) == 6
+    finally:
+        env.close()
+
+
+def test_worker_error():
+    """
+    Errors in the workers should be raised in the parent process
+    """
+    with pytest.raises(Exception, match="invalid surface type"):
+        TennisEnv(num=2, num_workers=2, surface_type="invalid")
+
+
+def test_matches_local_env():
+    """
+    With the same seed the workers should run the same games as a local env
+    """
+    env_kwargs = dict(num=4, surface_type="numpy", ob_mode="both", seed=0)
+    local_env = TennisEnv(**env_kwargs)
+    env = TennisEnv(num_workers=2, **env_kwargs)
+    try:
+        rng = np.random.RandomState(0)
+        for _ in range(300):
+            for expected, actual in zip(local_env.observe(), env.observe()):
+                assert_equal(expected, actual)
+            ac = rng.randint(0, 2, size=(4, len(env.buttons)), dtype=np.uint8)
+            local_env.act(ac)
+            env.act(ac)
+        state = local_env.get_state()
+        assert np.array_equal(env.get_state(), state)
+        local_env.act(ac)
+        local_env.set_state(state)
+        env.set_state(state)
+        for expected, actual in zip(local_env.observe(), env.observe()):
+            assert_equal(expected, actual)
+    finally:
+        env.close()
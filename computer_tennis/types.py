@@ -1,4 +1,6 @@
 class Color:
+    __slots__ = ("r", "g", "b", "a")
+
     def __init__(self, r, g, b, a=1.0):
         self.r = r
         self.g = g
@@ -7,6 +9,8 @@ class Color:
 
 
 class Vec2:
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -22,3 +26,13 @@ class Vec2:
             return Vec2(x=self.x + other.x, y=self.y + other.y)
         else:
             raise Exception("invalid operation")
+
+    def __iadd__(self, other):
+        # update in place so that stepping the physics doesn't allocate
+        self.x += other.x
+        self.y += other.y
+        return self
+
+    def set(self, x, y):
+        self.x = x
+        self.y = y
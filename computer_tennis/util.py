@@ -1,13 +1,18 @@
-from computer_tennis import opengl_draw
-
-
 def build_surface(surface_type, **kwargs):
+    # backends are imported when they are first used so that processes that don't render with
+    # opengl never import moderngl
     if surface_type == "opengl":
+        from computer_tennis import opengl_draw
+
         return opengl_draw.Surface(**kwargs)
     elif surface_type == "cairo":
         # late import in case pycairo is not installed
         from computer_tennis import cairo_draw
 
         return cairo_draw.Surface(**kwargs)
+    elif surface_type == "numpy":
+        from computer_tennis import numpy_draw
+
+        return numpy_draw.Surface(**kwargs)
     else:
         raise Exception("invalid surface type")
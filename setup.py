@@ -27,8 +27,10 @@ setup_dict = dict(
         # pycairo cannot be a dependency because it often fails to install
         # as it is lacking binary wheels
         "cairo": ["pycairo>=1.19.0,<2.0.0"],
+        # optional, compiles the physics for batched environments
+        "numba": ["numba"],
     },
-    python_requires=">=3.7.0",
+    python_requires=">=3.8.0",
 )
 
 setup(**setup_dict)